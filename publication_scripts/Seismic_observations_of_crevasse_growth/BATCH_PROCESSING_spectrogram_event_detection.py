@@ -10,14 +10,24 @@ uses spectrum files saved from spectrum_generation.
 
 import datetime
 import glob
+import os
 import numpy as np
 import obspy
 import matplotlib.pyplot as plt
 
+from spectrum_store import read_spectra
+from detection_engine import (band_energy_sets, band_ratio_triggers, make_triggers,
+                              associate_triggers, cut_events, TRIGGER_DTYPE)
+from event_catalogue import open_catalogue, add_event, remove_events
+
 import argparse
 
 parser = argparse.ArgumentParser()
 parser.add_argument("-p","--path", type=str, help="Enter folder path")
+parser.add_argument("-s","--sweep", action="store_true",
+                    help="Detect events for all TYPES and thresholds in one pass, saving each to path/TYPE_X/threshold/")
+parser.add_argument("-t","--thresholds", type=float, nargs="+", default=[3, 4, 5],
+                    help="Trigger thresholds to sweep")
 args = parser.parse_args()
 
 TYPES = [[1, 20, 0, 10, 0, 10], [50, 100, 0, 2, 0, 60], [50, 100, 2, 20, 0, 5],\
@@ -25,16 +35,25 @@ TYPES = [[1, 20, 0, 10, 0, 10], [50, 100, 0, 2, 0, 60], [50, 100, 2, 20, 0, 5],\
 TYPE_LETTERS = ['A', 'B', 'C', 'D']
 
 path = args.path
-TYPE = path.split('/')[-2][-1]
-TYPE_INDEX = TYPE_LETTERS.index(TYPE)
+
+# Each parameter set is a TYPE letter, trigger threshold and output directory.
+# Without sweeping, the TYPE and threshold are read from the folder path.
+
+if args.sweep == True:
+    
+    parameter_sets = [[TYPE, threshold, path + '/TYPE_' + TYPE + '/' + '{:g}'.format(threshold) + '/']
+                      for TYPE in TYPE_LETTERS for threshold in args.thresholds]
+    
+else:
+    
+    parameter_sets = [[path.split('/')[-2][-1], float(path.split('/')[-1]), path + '/']]
 
 # Set parameters
 
-## Directory to save event files to
+## Save one .MSEED file per event in each output directory
+## (events are always saved to an event catalogue in each output directory)
 
-#event_output_directory = '/media/sam/61D05F6577F6DB39/SCIENCE/FDD/'
-#event_output_directory = '/home/samto/PERSONAL_SCIENCE/EVENTS/TYPE_D/'
-event_output_directory = path + '/'
+write_event_files = False
 
 ## Directory to load spectrum files from (all spectrum files in one folder)
 
@@ -65,35 +84,22 @@ end_year = '2017'
 end_month = '08'
 end_day = '01'
 
-## Set signal and noise frequency bands
+## Set signal and noise frequency bands, trigger threshold, trigger
+## length range (in FFT windows) and event length range for each parameter set
 
-#signal_bands = [[10, 20]]
-#noise_bands = [[10, 20]]
-
-signal_bands = [TYPES[TYPE_INDEX][0:2]]
-noise_bands = signal_bands
+for parameter_set in parameter_sets:
+    
+    TYPE_INDEX = TYPE_LETTERS.index(parameter_set[0])
+    
+    parameter_set.append({'signal_bands': [TYPES[TYPE_INDEX][0:2]],
+                          'trigger_min_len': TYPES[TYPE_INDEX][2],
+                          'trigger_max_len': TYPES[TYPE_INDEX][3],
+                          'event_min_len': TYPES[TYPE_INDEX][4],
+                          'event_max_len': TYPES[TYPE_INDEX][5]})
 
-## Set weighting for each band
+## Set weighting for each band (noise bands are the signal bands)
 
 signal_band_weights = [1]
-noise_band_weights = [1]
-
-## Set threshold required to trigger detection consideratio
-
-#trigger_threshold = 2
-trigger_threshold = float(path.split('/')[-1])
-
-## Set trigger length range for a trigger to be register
-## NOTE: this in in FFT windows
-
-#trigger_min_len = 1
-#trigger_max_len = 6
-
-trigger_min_len = TYPES[TYPE_INDEX][2]
-trigger_max_len = TYPES[TYPE_INDEX][3]
-
-event_min_len = TYPES[TYPE_INDEX][4]
-event_max_len = TYPES[TYPE_INDEX][5]
 
 ## Set pre and post event time (s) for event files
 
@@ -118,8 +124,38 @@ station_threshold = 3
 
 FFT_window_len = 1
 
-print(path)
-print(TYPES[TYPE_INDEX])
+# Distinct signal band definitions: band energies are calculated once per
+# band definition and triggers once per band definition and threshold.
+# Band indices are offset by one as in earlier versions of this script.
+
+distinct_bands = []
+
+for parameter_set in parameter_sets:
+    
+    bands = [[band[0] - 1, band[1] - 1] for band in parameter_set[3]['signal_bands']]
+    
+    if bands not in distinct_bands:
+        
+        distinct_bands.append(bands)
+        
+    parameter_set[3]['band_index'] = distinct_bands.index(bands)
+
+distinct_thresholds = sorted(set([parameter_set[1] for parameter_set in parameter_sets]))
+
+# Open an event catalogue for each parameter set
+
+catalogues = []
+
+for parameter_set in parameter_sets:
+    
+    print(parameter_set[2])
+    print(TYPES[TYPE_LETTERS.index(parameter_set[0])], parameter_set[1])
+    
+    if not os.path.exists(parameter_set[2]):
+        
+        os.makedirs(parameter_set[2])
+        
+    catalogues.append(open_catalogue(parameter_set[2] + 'event_catalogue.sqlite'))
 
 # Convert start and end dates into datetime objects, and get them as julian days in their respective years
     
@@ -131,7 +167,7 @@ end_date_doy = end_date.timetuple().tm_yday
 
 # Look through data in all streams within the processing window
 
-years = range(int(start_year), int(start_year) + int(end_year) - int(start_year))
+years = range(int(start_year), int(end_year) + 1)
 
 times = []
 
@@ -143,18 +179,19 @@ for year in years:
         elif (year == int(end_year)) and (doy > int(end_date_doy)): continue            
         else:
             
-            spectrum_files = glob.glob(spectrum_directory + '*' + str(year) + '*' + str(doy) + '*spectrums.npy')
+            # Spectrum files are named after their stream files, which end in
+            # the year and zero-padded day of the year (e.g. day 12 is 012)
+            
+            day_spectrum_files = spectrum_directory + '*.' + str(year) + '.' + '{:03d}'.format(doy) + '_spectrums'
+            spectrum_files = glob.glob(day_spectrum_files + '.npy') + glob.glob(day_spectrum_files + '.dat')
             stream_files = glob.glob(stream_root_directory + 'Y' + str(year) + '/R' + str(doy) + '.01/*')
                         
             # Apply component and station filtering
 
-            triggers = []
-            band_ratios = []
-            trigger_durations = []
-            trigger_SNRs = []
-            event_durations = []
-            event_trigger_SNRs = []
-            all_event_triggers = []
+            # Triggers for each band definition and threshold
+            
+            sweep_triggers = dict([((b, threshold), []) for b in range(len(distinct_bands))
+                                   for threshold in distinct_thresholds])
             
             for spectrum_file in spectrum_files:
                 
@@ -165,46 +202,19 @@ for year in years:
                 if component != stream_component: continue
                 if station not in stream_stations: continue
                 
-                # Load the spectrum file
+                # Load the spectrum file (chronological midtimes and spectra)
+                # once for all parameter sets
             
-                spectrum_list = np.load(spectrum_file).tolist()
-                
-                # Join spectra lists together
-                
-                times = []
-                spectrums = []
-                for i in range(len(spectrum_list)):
-                    for j in range(len(spectrum_list[i])):
-                        if len(spectrum_list[i][j]) > 0:
-                            times.append([])
-                            spectrums.append([])
-                            times[-1] = (spectrum_list[i][j][0])
-                            # Miss the first frequency entry as it is not representative of
-                            # particular harmonics.
-                            spectrums[-1] = np.absolute(spectrum_list[i][j][1][1:].real)
-                            
-                # Ensure times are chronological
-                # Unsorting may result from multithreading during spectrum generation
-                times, spectrums = zip(*sorted(zip(times, spectrums)))
-                
-                times = np.array(times)
-                spectrums = np.array(spectrums)
+                times, spectrums = read_spectra(spectrum_file)
                 
                 # Calculate trigger section:
                 
                 print('Generating triggers for station ' + station + ' on day ' + str(doy) + ' in ' + str(year))
                 
-                trigger_on = False
-                
-                # Generate first noise value
+                # Band energies of every band definition from one pass over the spectra
                 
-                noise = 0
+                signals = band_energy_sets(spectrums, distinct_bands, [signal_band_weights] * len(distinct_bands))
                 
-                for noise_band in noise_bands:
-                        
-                    noise += sum(abs(spectrums[0][noise_band[0] - 1: noise_band[1] - 1])) * noise_band_weights[noise_bands.index(noise_band)] \
-                            / (noise_band[1] - noise_band[0])
-                            
                 # Compare signal values to noise values and generate triggers
                 # Each signal value is compared to the previous "signal" value
                 # (noise value) until the signal/noise threshold is passed,
@@ -213,214 +223,103 @@ for year in years:
                 # triggers to occur which is useful for separating different
                 # spectral signatures.
                 
-                for i in range(1, len(spectrums)):
+                for b in range(len(distinct_bands)):
+                    for threshold in distinct_thresholds:
                     
-                    midtime = times[i]
-                    spectrum = spectrums[i]
-                
-                    signal = 0
-                    
-                    # Calculate band ratios (normalise by length of band)
-                    
-                    for signal_band in signal_bands:
-                        
-                        signal += sum(abs(spectrum[signal_band[0] - 1 : signal_band[1] - 1])) * signal_band_weights[signal_bands.index(signal_band)] \
-                                    / (signal_band[1] - signal_band[0])
-                    
-                    try:
-                        
-                        band_ratio = signal / noise
-                        band_ratios.append(100 * band_ratio)
+                        ratios, trigger_indices, trigger_SNRs = band_ratio_triggers(signals[b], signals[b][0], threshold)
                         
-                    except:
+                        sweep_triggers[(b, threshold)].append(make_triggers(times, trigger_indices, 100 * trigger_SNRs,
+                                                                            stream_stations.index(station)))
                         
-                        print('Signal:noise calculation failed at index ' + str(i) + ' !')
-                        continue
+            # Find coincident triggers for each parameter set
+            
+            print('Locating coincident triggers')
+            
+            day_triggers = []
+            day_events = []
+            day_members = []
+            
+            for parameter_set in parameter_sets:
+                
+                parameters = parameter_set[3]
+                triggers = sweep_triggers[(parameters['band_index'], parameter_set[1])]
+            
+                if len(triggers) > 0:
                     
-                    # Determine and save triggers
+                    triggers = np.concatenate(triggers)
                     
-                    if (trigger_on == False) and (band_ratio >= trigger_threshold):
-                        
-                        trigger_on = True    
-                        trigger_on_index = i
-                        
-                    elif (trigger_on == True) and (band_ratio < trigger_threshold):
-        
-                        trigger_on = False
-                        noise = signal
-                        trigger_off_index = i
-                        trigger_durations.append(trigger_off_index - trigger_on_index)
-#                        print(trigger_on_index, trigger_off_index)
-#                        print(times[trigger_on_index], times[trigger_off_index])
-                        triggers.append([times[trigger_on_index],
-                                         times[trigger_off_index],
-                                         station])
-                                         
-#                        print(triggers[-1])        
-                        
-                    elif (trigger_on == False):
-                        
-                        noise = signal
-                        
-                    if band_ratio >= trigger_threshold:
-                        
-                        trigger_SNRs.append(100 * band_ratio)
-                        
-            # Sort all the day's triggers chronologically                    
+                else:
+                    
+                    triggers = np.zeros(0, dtype = TRIGGER_DTYPE)
             
-            triggers.sort()
-
-            # Find coincident triggers and write event files
+                triggers, events, event_members = associate_triggers(triggers, station_threshold, delay_time, interevent_time,
+                                                                     parameters['trigger_min_len'], parameters['trigger_max_len'],
+                                                                     parameters['event_min_len'], parameters['event_max_len'],
+                                                                     inclusive_trigger_min = False,
+                                                                     inclusive_event_len = True)
+                
+                day_triggers.append(triggers)
+                day_events.append(events)
+                day_members.append(event_members)
+                
+            # Cut the events of all parameter sets from one read of each station's day-long stream
             
-            print('Locating coincident triggers')
-        
-            last_off = 0 # Set the end time of the previous trigger
-            coincidence_triggers = []
+            print('Saving event files')
+            
+            day_stream_files = {}
             
-            count = -1
-            while count < (len(triggers) - 1):
+            for stream_file in stream_files:
                 
-                count += 1
+                stream_file_metadata = stream_file.split('/')[-1].split('.')
                 
-                event = False
-
-                # Get the first trigger
-                 
-                on, off, station = triggers[count]
-                trigger_SNR = trigger_SNRs[count]
+                if stream_file_metadata[0] not in stream_stations: continue
+                if stream_file_metadata[3][-1] != stream_component: continue
                 
-                # Avoid overlapping events
-                              
-                if on < last_off + interevent_time: continue
+                day_stream_files.setdefault(stream_file_metadata[0], stream_file)
             
-                # Check trigger duration is desired
-                
-                if not (trigger_min_len < (off - on) <= trigger_max_len): continue
+            all_members = []
+            offset = 0
             
-                # Prepare the event output
+            for p in range(len(parameter_sets)):
+                
+                all_members.extend([members + offset for members in day_members[p]])
+                offset += len(day_triggers[p])
                 
-                event_on_time = on
-                event_stations = [station]
-                event_SNRs = [trigger_SNR]
-                event_triggers = [triggers[count]]
-                coincidence_sum = 1
+            event_streams = cut_events(day_stream_files, np.concatenate(day_triggers), all_members,
+                                       stream_stations, FFT_window_len)
+            
+            # Save each parameter set's events to its own catalogue, replacing
+            # its events from earlier runs over the day (days without spectra
+            # keep theirs)
+            
+            e = 0
+            
+            for p in range(len(parameter_sets)):
                 
-                # Compare current trigger with temporally-nearby triggers
+                events = day_events[p]
                 
-                for later_trigger in triggers[count + 1:]:
+                if len(spectrum_files) > 0:
                     
-                    lt_on, lt_off, lt_station = later_trigger
-                    lt_trigger_SNR = trigger_SNRs[triggers.index(later_trigger)]
-
-                    # Check trigger duration is desired
-
-                    if not (trigger_min_len < (lt_off - lt_on) <= trigger_max_len): continue
-
-                    # Check triggers are appropriately temporally clustered
+                    day_start = obspy.UTCDateTime(year = year, julday = doy)
+                    remove_events(catalogues[p], day_start, day_start + 86400, parameter_sets[p][0], parameter_sets[p][1])
+                
+                for k in range(len(events)):
                     
-                    if lt_on > off + delay_time: break
-
-                    # Only allow one trigger per station
-        
-                    if lt_station in event_stations: continue
-
-                    # Update event data for new trigger
+                    event_triggers = [[stream_stations[trigger['station']], trigger['on'], trigger['off'], trigger['snr']]
+                                      for trigger in day_triggers[p][day_members[p][k]]]
                     
-                    event_stations.append(lt_station)
-                    event_triggers.append(later_trigger)
-                    event_SNRs.append(lt_trigger_SNR)
-                    coincidence_sum += 1
-                    event_off_time = max([off, lt_off])        
-                    event_length = event_off_time - event_on_time                
-                    last_off = event_off_time
+                    print('Saving ' + str([obspy.UTCDateTime(events['on'][k]), obspy.UTCDateTime(events['off'][k]),
+                                           [trigger[0] for trigger in event_triggers], events['length'][k]]))
                     
-                    # If the coincidence sum is high enough, save event data
+                    add_event(catalogues[p], events['on'][k], events['off'][k], event_triggers,
+                              event_type = parameter_sets[p][0], threshold = parameter_sets[p][1],
+                              event_stream = event_streams[e])
                     
-                    if coincidence_sum >= station_threshold:
-
-                        event = True
+                    if write_event_files == True:
                         
-                if event == True:
-                    
-                        if (event_min_len <= event_length <= event_max_len):
-                    
-                            coincidence_triggers.append([event_on_time,
-                                    event_off_time,
-                                    event_stations,
-                                    event_length])
-        
-                            event_durations.append(event_length)
-                            event_trigger_SNRs.extend(event_SNRs)
-                            
-                            # Save trigger details for alternative uses
-                            # such as trimming streams before xcorr
-                            
-                            all_event_triggers.append(event_triggers)
-                                    
-                            print(coincidence_triggers[-1])
+                        event_streams[e].write(parameter_sets[p][2] + str(obspy.UTCDateTime(events['on'][k])) + \
+                                               '.MSEED', format = 'MSEED', cencoding = 'STEIM2')
                         
-            # Save event files:
-            
-#            plt.figure()
-#            plt.subplot(221)
-#            plt.hist(band_ratios, range(0, 1000))   
-#            plt.title('Band ratio distribution', fontsize = 10)
-#            plt.subplot(222)
-#            plt.hist(trigger_durations, range(0, 20))
-#            plt.title('Trigger duration distribution', fontsize = 10)
-#            plt.subplot(223)
-#            plt.hist(event_trigger_SNRs, range(0, 1000))
-#            plt.title('Event trigger band ratio distribution', fontsize = 10)
-#            plt.subplot(224)
-#            plt.hist(event_durations, range(0, 20))
-#            plt.title('Event duration distribution', fontsize = 10)
-#            plt.show()
-            
-            # Build seismic stream
-            # NOTE: contains all components and stations available in stream files
-
-            print('Saving event files')
-
-            # Mode I: save events with pre- and post-event time
-            # with data from all triggered stations
-            
-            # suffers from same issue as mode 2 ! seemingly random
-            # stations with very poor time cropping!!
-                
-            stream = obspy.Stream()
-                
-#            for stream_file in stream_files:
-#                    
-#                stream += obspy.read(stream_file)
-#        
-#            for coincidence_trigger in coincidence_triggers:
-#               
-#                event_stream = obspy.Stream()
-#                
-#                print('Saving ' + str(coincidence_trigger))
-#                
-#                for trace in stream:
-#                        
-#                    if (trace.stats.station in coincidence_trigger[2]) and (trace.stats.channel[-1] == stream_component):
-#
-#                        event_stream += trace.copy().trim(starttime = coincidence_trigger[0] - pre_event_time,
-#                                           endtime = coincidence_trigger[1] + post_event_time)
-#
-#                event_stream.write(event_output_directory + str(coincidence_trigger[0]) + '.MSEED',
-#                             format = 'MSEED', cencoding = 'STEIM2')
-
-#            # Mode II: save events with each stream trimmed to its trigger duration
-
-            for event_triggers in all_event_triggers:
-                
-                print('Saving ' + str(coincidence_triggers[all_event_triggers.index(event_triggers)]))
-                
-                event_stream = obspy.Stream()
-                
-                for event_trigger in event_triggers:
+                    e += 1
                     
-                    event_stream += obspy.read(glob.glob(stream_root_directory + 'Y' + str(year) + '/R' + str(doy) + '.01/' + event_trigger[2] + '*' + stream_component + '*')[0],
-                                               starttime = event_trigger[0] - FFT_window_len, endtime = event_trigger[1] + FFT_window_len)
-    
-                event_stream.write(event_output_directory + str(coincidence_triggers[all_event_triggers.index(event_triggers)][0]) + \
-                                   '.MSEED', format = 'MSEED', cencoding = 'STEIM2')
\ No newline at end of file
+                catalogues[p].commit()
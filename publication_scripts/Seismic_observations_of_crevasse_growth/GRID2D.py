@@ -5,36 +5,48 @@
 epicentre. Designed to use the outputs of spectrogram_event_detection.py.
 """
 
-import concurrent.futures
 import datetime
+import itertools
 import obspy
 import os
+import time
 import numpy as np
-import math
 import matplotlib.pyplot as plt
 
-def calculate_distance(x1, y1, x2, y2):
-    
-    '''
-    Calculate distance between two points in a two-dimensional
-    cartesian coordinate system.
-    '''
-    
-    distance = math.sqrt((x2 - x1)**2 + (y2 - y1)**2)
-    
-    return distance
+from event_catalogue import find_events, open_catalogue, read_waveform, event_triggers
+from backprojection import trigger_envelopes, backproject, backproject_lags, share_arrays, attach_arrays
+from task_scheduler import run_tasks
+from travel_time_table import travel_time_table
 
 
 
 
-def xcorr_location(event):
+def load_event(event):
     
     '''
-    Functionsied version of main body code to do event location.
-    Saves xcorr grid to a .npy file.
+    Load an event's waveforms and its station trigger times, from the
+    event catalogue if the event is in it, otherwise from the event's
+    .MSEED and .csv files.
     '''
     
-    print('Processing event ' + event)
+    stations = []
+    trigger_on = []
+    trigger_off = []
+    
+    if event in catalogue_events:
+        
+        catalogue = open_catalogue(catalogue_file)
+        
+        stream = read_waveform(catalogue, catalogue_events[event])
+        
+        for trigger in event_triggers(catalogue, catalogue_events[event]):
+            stations.append(trigger[0])
+            trigger_on.append(trigger[1].datetime)
+            trigger_off.append(trigger[2].datetime)
+        
+        catalogue.close()
+        
+        return stream, stations, trigger_on, trigger_off
     
     # Load events into python as streams
     # Note: this will fail if streams are corrupted
@@ -48,157 +60,257 @@ def xcorr_location(event):
     
     # Parse pre and post trigger times into reference lists
     
-    stations = []
-    trigger_on = []
-    trigger_off = []
     with open(event_directory + event[:-6] + '.csv', 'r') as openfile:
         for row in openfile:
             stations.append(row.split(',')[0])
             trigger_on.append(datetime.datetime.strptime(row.split(',')[1], '%Y-%m-%dT%H:%M:%S.%fZ'))
             trigger_off.append(datetime.datetime.strptime(row.split(',')[2][:-1], '%Y-%m-%dT%H:%M:%S.%fZ'))
     
+    return stream, stations, trigger_on, trigger_off
+
+
+
+
+def prepare_event(event):
+    
+    '''
+    Load an event, filter it and cut each trace to its triggered data as
+    normalised absolute values, aligned so their relative sample timing is
+    kept. Returns the waveforms and the index of each waveform's station.
+    '''
+    
+    # Load the event waveforms and pre and post trigger times
+    
+    stream, trigger_stations, trigger_on, trigger_off = load_event(event)
+    
     # Filter the waveform to remove noise outside of the signal spectral band
     
     stream.filter('bandpass', freqmin = filter_band[0], freqmax = filter_band[-1])
     stream.detrend(type = 'demean')
     stream.detrend(type = 'simple')
     
-    start_times = []
-    end_times = []
-    waveforms = []
+    waveforms, waveform_stations = trigger_envelopes(stream, trigger_stations, trigger_on, trigger_off, sampling_rate)
     
-    # Smooth the data to cross correlate better
+    return waveforms, [stations.index(station) for station in waveform_stations]
+
+
+
+
+def score_grid(waveforms, station_indices):
+    
+    '''
+    Shift the position of each waveform by the negative travel time between
+    the waveform's recording station and a position in the grid, then calculate
+    the mean cross-correlation coefficient between the shifted waveforms,
+    for all grid cells at once.
+    '''
     
-    for trace in stream:
+    if location_mode == 'lag':
         
-        # Get pre and post trigger times
+        return backproject_lags(waveforms, sample_shifts[:, :, station_indices])
         
-        station = trace.stats.station
-        start_times.append(trace.stats.starttime)
-        end_times.append(trace.stats.endtime)
+    return backproject(waveforms, sample_shifts[:, :, station_indices])
+
+
+
+
+def xcorr_location(event):
+    
+    '''
+    Functionsied version of main body code to do event location.
+    Saves xcorr grid to a .npy file.
+    '''
+    
+    print('Processing event ' + event)
+    
+    waveforms, station_indices = prepare_event(event)
+    
+    xcorr_value_grid = score_grid(waveforms, station_indices)
+    
+    np.save(event_directory + event[:-6] + '.xcorrvaluegrid.npy', xcorr_value_grid)
+
+
+
+
+def locate_chunk(chunk_events):
+    
+    '''
+    Prepare and locate a chunk of events. The chunk's prepared waveforms
+    are written to one shared memory block and scored from views of it, so
+    they are held once and released as soon as the chunk is done.
+    Returns, for each event, the event name, its xcorr grid (None if
+    preparation or location failed), the preparation and location times (s)
+    and any error message.
+    '''
+    
+    results = []
+    prepared = []
+    chunk_waveforms = []
+    chunk_station_indices = []
+    
+    for event in chunk_events:
         
-        pre_trigger_time = (trigger_on[stations.index(station)] - start_times[-1].datetime).total_seconds()
-        post_trigger_time = (end_times[-1].datetime - trigger_off[stations.index(station)]).total_seconds()
+        start = time.time()
         
-        pre_trigger_samples = int(sampling_rate * pre_trigger_time)
-        post_trigger_samples = int(sampling_rate * post_trigger_time) 
-#        plt.plot(trace.data, color = 'red')
-        # Cut the trace to only the triggered data
+        try:
+            
+            waveforms, station_indices = prepare_event(event)
+            
+        except Exception as error:
+            
+            results.append([event, None, time.time() - start, 0, str(error)])
+            continue
+        
+        results.append([event, None, time.time() - start, 0, ''])
+        prepared.append(len(results) - 1)
+        chunk_waveforms.append(waveforms)
+        chunk_station_indices.append(station_indices)
     
-        trace_data = [0] * (pre_trigger_samples) + \
-                      trace.data[pre_trigger_samples : - post_trigger_samples].tolist() + \
-                      [0] * (post_trigger_samples)
+    if len(prepared) == 0:
         
-        for i in range(len(trace_data)):
-           
-           trace_data[i] = abs(trace_data[i])
+        return results
+    
+    block, layout = share_arrays(chunk_waveforms)
     
-        smoothed_trace_data = trace_data
+    del chunk_waveforms
     
-        # Smooth the trace data with a running mean (applied to absolute data)
+    try:
         
-#        plt.plot(trace_data, color = 'blue', alpha = 0.5)
+        shared, chunk_waveforms = attach_arrays(block.name, layout)
         
-#        smoothed_trace_data = [0] * len(trace.data)
-#
-#        for i in range(pre_trigger_samples, 
-#                       len(trace_data) - post_trigger_samples):
-#            
-#            smoothed_trace_data[i] = sum(trace_data[i - smooth_length : i + smooth_length]) / (2 * smooth_length + 1)
+        for r, waveforms, station_indices in zip(prepared, chunk_waveforms, chunk_station_indices):
+            
+            start = time.time()
+            
+            try:
+                
+                results[r][1] = score_grid(waveforms, station_indices)
+                
+            except Exception as error:
+                
+                results[r][4] = str(error)
+                
+            results[r][3] = time.time() - start
         
-        # Normalise the data so cross-correlations aren't bias
-#        plt.plot(smoothed_trace_data, color = 'green'); plt.show()
-        maxval = max(max(smoothed_trace_data), abs(min(smoothed_trace_data)))
+        # Release the views before closing the shared memory
         
-        normalised_STD = []
-        for k in range(len(smoothed_trace_data)):
-                    
-            normalised_STD.append(smoothed_trace_data[k] / maxval)
+        del chunk_waveforms
+        shared.close()
         
-        trace_data = normalised_STD
+    finally:
         
-        waveforms.append(trace_data)
+        block.close()
+        block.unlink()
+    
+    return results
+
+
+
+
+def located_events(day):
+    
+    '''
+    Events already located in a day's stacked xcorr grid output, from its
+    index file (event, stack index, preparation and location times, error).
+    '''
     
-    # Extend the trace_data so their relative sample timing is kept
+    index_file = event_directory + day + '.xcorrvaluegrids.csv'
     
-    start_time = min(start_times)
-    end_time = max(end_times)
+    if not os.path.exists(index_file):
+        
+        return []
+    
+    with open(index_file, 'r') as openfile:
+        
+        return [row.split(',')[0] for row in openfile if int(row.split(',')[1]) >= 0]
 
-    for w in range(len(waveforms)):
-#        plt.plot(waveforms[w], color = 'red')
-        waveform_start_time = start_times[w]
-        waveform_end_time = end_times[w]
 
-        start_padding = int(sampling_rate * (waveform_start_time - start_time))
-        end_padding = int(sampling_rate * (end_time - waveform_end_time))
+
+
+def save_chunk(task, chunk_results):
+    
+    '''
+    Record a located chunk's results, and save its day's grids (see
+    save_day_grids) once every chunk of the day has finished.
+    '''
+    
+    day = task['key'][0]
+    
+    for result in chunk_results:
         
-        if start_padding > 0:
-            
-            for p in range(start_padding):
-            
-                waveforms[w].insert(0, 0)
-            
-        if end_padding > 0:
-            
-            for p in range( end_padding):
-            
-                waveforms[w].append(0)
-#        plt.plot(waveforms[w], color = 'blue', alpha = 0.5); plt.show()
-    # Shift the position of each waveform by the negative travel time between
-    # the waveform's recording station and a position in the grid, then calculate
-    # the cross-correlation coefficient between the shifted waveforms.
+        day_results[day][result[0]] = result
     
-    xcorr_value_grid = np.zeros(gridx.shape)
+    day_chunks[day] -= 1
     
-    for i in range(len(gridx)):
-        for j in range(len(gridx[i])):
-            
-            shifted_waveforms = []
-            
-            # Shift waveforms
-            
-            for w in range(len(waveforms)):
-                
-                travel_time = [travel_times[j][i][stations.index(stream[w].stats.station)]]
-                
-                shifted_waveform = [0] * len(waveforms[w])
-#                plt.plot(waveforms[w], color = 'red')                
-                for k in range(len(waveforms[w])):
-                    
-                    # This will fail if the shift goes outside the original data window
-                    # Fix it by expanding the original data window!
-
-                    try:
-                        
-                        shifted_waveform[k] = waveforms[w][k - int(round(travel_time[0] * sampling_rate))]
-                        
-                    except:
-                        
-                        pass
-#                plt.plot(shifted_waveform, color = 'blue', alpha = 0.5); plt.show()
-                shifted_waveforms.append(np.asarray(shifted_waveform))
-                
-            # Calculate cross-correlation coefficients
+    if day_chunks[day] > 0: return
+    
+    results = day_results.pop(day)
+    
+    for event in results:
+        
+        if results[event][1] is None:
             
-            shifted_waveforms = np.asarray(shifted_waveforms)
+            print('Failed to locate event ' + event + ': ' + results[event][4])
+    
+    save_day_grids(day, [results[event] for event in results])
+
+
+
+
+def fail_chunk(task, error):
+    
+    '''
+    Record every event of a chunk whose worker failed as failed.
+    '''
+    
+    save_chunk(task, [[event, None, 0, 0, 'worker failed'] for event in task['args'][0]])
+
+
+
+
+def save_day_grids(day, day_results):
+    
+    '''
+    Append a day's xcorr grids to its stacked output array (events x grid)
+    and record every event's stack index (-1 if it failed), preparation and
+    location times and error in the day's index file.
+    '''
+    
+    stack_file = event_directory + day + '.xcorrvaluegrids.npy'
+    index_file = event_directory + day + '.xcorrvaluegrids.csv'
+    
+    grids = []
+    
+    if os.path.exists(stack_file):
+        
+        grids = list(np.load(stack_file))
+    
+    rows = []
+    
+    for event, grid, prepare_time, locate_time, error in day_results:
+        
+        if grid is not None:
             
-            correlation_coefficients = np.corrcoef(shifted_waveforms)
+            grids.append(grid)
+            rows.append([event, len(grids) - 1, prepare_time, locate_time, error])
             
-            # Calculate mean cross-correlation coefficient
+        else:
             
-            mean_cc = 0
-            num_cc = 0
-            for row in correlation_coefficients:
-                for col in row:
-                    if float(col) != 1:
-                        mean_cc += col
-                        num_cc += 1
-                        
-            mean_cc /= num_cc
+            rows.append([event, -1, prepare_time, locate_time, error])
+    
+    if len(grids) > 0:
+        
+        with open(stack_file + '.part', 'wb') as openfile:
+            np.save(openfile, np.array(grids))
             
-            xcorr_value_grid[i][j] = mean_cc
+        os.replace(stack_file + '.part', stack_file)
+    
+    with open(index_file, 'a') as openfile:
+        
+        for row in rows:
             
-    np.save(event_directory + event[:-6] + '.xcorrvaluegrid.npy', xcorr_value_grid)
+            openfile.write(row[0] + ',' + str(row[1]) + ',' + '{:.3f}'.format(row[2]) + ',' + \
+                           '{:.3f}'.format(row[3]) + ',' + row[4].replace(',', ';').replace('\n', ' ') + '\n')
 
 
 
@@ -229,6 +341,10 @@ velocity = 1.65
 
 sampling_rate = 250
 
+## Directory to cache travel time and sample shift tables in (None to calculate them each run)
+
+travel_time_directory = '/home/sam/TRAVEL_TIME_TABLES/'
+
 event_directory = '/home/sam/EVENTS_IT3/TYPE_A/4/'
 
 # Set smoothing length (in samples) to use in running mean smoothing of waveforms
@@ -239,56 +355,88 @@ smooth_length = 25
 
 filter_band = [1, 25]
 
-# Parse event file paths
+## Set how grid cells are scored: 'shift' correlates the shifted waveforms
+## for every cell, 'lag' looks up each station pair's cross-correlation
+## function (calculated once per event) at the cell's differential travel
+## time, which is much faster for dense grids and only differs where
+## shifts move data out of the event window
+
+location_mode = 'shift'
+
+## Save xcorr grids stacked into one array per day (DAY.xcorrvaluegrids.npy,
+## indexed by DAY.xcorrvaluegrids.csv) rather than one .npy file per event
+
+stack_outputs = True
+
+## Number of events per worker task, number of worker processes (None uses
+## all CPUs) and retries for failed tasks
+
+chunk_size = 16
+max_workers = None
+retries = 1
+
+## Time range of events to locate when using an event catalogue (None for all events)
+
+starttime = None
+endtime = None
+
+# Find events in the event catalogue if there is one, otherwise in event
+# files, skipping events already located to individual grid files
+
+catalogue_file, catalogue_events, events = find_events(event_directory, starttime, endtime)
 
-files = os.listdir(event_directory)
-events = []
-for event in files:
-    if (event[-6:] == '.MSEED') and (event[:-6] + '.xcorrvaluegrid.npy' not in files):
-        events.append(event)
+events = [event for event in events if not os.path.exists(event_directory + event[:-6] + '.xcorrvaluegrid.npy')]
     
 # Make grid
     
-gridx, gridy = np.meshgrid(np.linspace(xmin, xmax, (xmax - xmin + 1) / xstep), np.linspace(ymin, ymax, (ymax - ymin + 1) / ystep))
+gridx, gridy = np.meshgrid(np.linspace(xmin, xmax, int(round((xmax - xmin + 1) / xstep))),
+                           np.linspace(ymin, ymax, int(round((ymax - ymin + 1) / ystep))))
 
-# Generate travel times from each station to each grid point
+# Load the travel times (relative to the first station) and integer sample
+# shifts from each grid point to each station, indexed [i][j] like the grid.
+# The cached tables are memory-mapped once here and shared with the workers.
 
-travel_times = [[[] for i in range(len(gridx))] for j in range(len(gridx[0]))]
-
-for i in range(len(gridx)):
-    for j in range(len(gridx[i])):
-        
-        x = gridx[i][j]
-        y = gridy[i][j]
-        
-        for station_position in station_positions:
-            
-            distance = calculate_distance(x, y, station_position[0], station_position[1])
-            
-            travel_times[j][i].append(distance / velocity)
-            
-        # Make travel times relative
-        
-        relative_tt = [[] for k in range(len(travel_times[j][i]))]
-        for k in range(len(travel_times[j][i])):
-            
-            relative_tt[k] = travel_times[j][i][k] - travel_times[j][i][0]
-            
-        travel_times[j][i] = relative_tt
+travel_times, sample_shifts = travel_time_table(gridx, gridy, station_positions, velocity,
+                                                sampling_rate = sampling_rate, relative = True,
+                                                cache_directory = travel_time_directory)
             
     
 # Locate events
+
+if stack_outputs == False:
     
-with concurrent.futures.ProcessPoolExecutor() as executor:
+    run_tasks([{'key': event, 'args': (event,), 'size': 1} for event in events], xcorr_location,
+              max_workers = max_workers, retries = retries)
+    
+else:
+    
+    # Locate events in chunks from every day, each worker preparing its
+    # chunk's waveforms, and save each day's grids once its chunks are done
+    
+    day_results = {}
+    day_chunks = {}
+    tasks = []
+    
+    # Events are sorted by time, so each day's events are consecutive
+    
+    for day, day_group in itertools.groupby(events, key = lambda event: event[:10]):
         
-    executor.map(xcorr_location, events)
+        done = set(located_events(day))
+        day_events = [event for event in day_group if event not in done]
         
-#for event in events:
-    
-#    xcorr_location(event)
-                    
-
+        if len(day_events) == 0: continue
         
+        print('Locating ' + str(len(day_events)) + ' events on ' + day)
         
+        day_results[day] = dict([(event, None) for event in day_events])
+        day_chunks[day] = 0
         
-    
\ No newline at end of file
+        for start in range(0, len(day_events), chunk_size):
+            
+            chunk_events = day_events[start : start + chunk_size]
+            
+            tasks.append({'key': (day, start), 'args': (chunk_events,), 'size': len(chunk_events)})
+            day_chunks[day] += 1
+    
+    run_tasks(tasks, locate_chunk, max_workers = max_workers, retries = retries,
+              on_success = save_chunk, on_failure = fail_chunk, keep_results = False)
@@ -0,0 +1,279 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+Back-projection of event waveforms onto a location grid: waveform
+envelopes are shifted by the predicted travel time from each grid cell
+to each station, and each cell is scored by the mean cross-correlation
+coefficient between the shifted envelopes. Shifts for all cells and
+stations are held as one integer array, and cells are scored in blocks
+with batched matrix products instead of cell-by-cell Python loops.
+
+Alternatively (backproject_lags), each station pair's full
+cross-correlation function is computed once per event by FFT and every
+cell is scored by looking up each pair's correlation at the cell's
+differential shift.
+
+Envelopes for batches of events can be passed to worker processes
+through shared memory (share_arrays, attach_arrays).
+"""
+
+from multiprocessing import shared_memory
+
+import numpy as np
+
+
+
+
+def trigger_envelopes(stream, stations, trigger_on, trigger_off, sampling_rate):
+
+    '''
+    Cut each trace of an (already filtered) event stream to its station's
+    trigger window, take absolute values and normalise by the maximum, as
+    done before cross-correlation location.
+
+    stations, trigger_on and trigger_off list each station's trigger
+    (times as datetimes). Traces are aligned on a common sample axis
+    starting at the earliest trace start, with zeros outside each trace.
+    Returns the envelopes (one row per trace), and the station of each row.
+    '''
+
+    start_time = min([trace.stats.starttime for trace in stream])
+
+    rows = []
+    offsets = []
+    trace_stations = []
+
+    for trace in stream:
+
+        station = trace.stats.station
+        npts = len(trace.data)
+
+        # Get pre and post trigger times
+
+        pre_trigger_time = (trigger_on[stations.index(station)] - trace.stats.starttime.datetime).total_seconds()
+        post_trigger_time = (trace.stats.endtime.datetime - trigger_off[stations.index(station)]).total_seconds()
+
+        pre_trigger_samples = min(max(int(sampling_rate * pre_trigger_time), 0), npts)
+        post_trigger_samples = min(max(int(sampling_rate * post_trigger_time), 0), npts - pre_trigger_samples)
+
+        # Keep only the triggered data
+
+        envelope = np.zeros(npts)
+        envelope[pre_trigger_samples : npts - post_trigger_samples] = \
+            np.abs(trace.data[pre_trigger_samples : npts - post_trigger_samples])
+
+        # Normalise the data so cross-correlations aren't bias
+
+        with np.errstate(divide = 'ignore', invalid = 'ignore'):
+
+            envelope /= np.max(envelope)
+
+        rows.append(envelope)
+        offsets.append(max(int(sampling_rate * (trace.stats.starttime - start_time)), 0))
+        trace_stations.append(station)
+
+    # Extend the envelopes so their relative sample timing is kept
+
+    envelopes = np.zeros((len(rows), max([offsets[w] + len(rows[w]) for w in range(len(rows))])))
+
+    for w in range(len(rows)):
+
+        envelopes[w, offsets[w] : offsets[w] + len(rows[w])] = rows[w]
+
+    return envelopes, trace_stations
+
+
+
+
+def shift_envelopes(envelopes, shifts):
+
+    '''
+    Shift the envelopes for a block of cells: row w of cell c is the
+    envelope delayed by shifts[c, w] samples, with zeros where the shift
+    moves data in from outside the envelope window.
+    Returns an array of shape (cells, envelopes, samples).
+    '''
+
+    num_envelopes, num_samples = envelopes.shape
+
+    # Pad either side so every shift is a window into the padded envelopes
+
+    shifts = np.clip(shifts, -num_samples, num_samples)
+    padded = np.zeros((num_envelopes, 3 * num_samples))
+    padded[:, num_samples : 2 * num_samples] = envelopes
+
+    windows = np.lib.stride_tricks.sliding_window_view(padded, num_samples, axis = 1)
+
+    return windows[np.arange(num_envelopes)[np.newaxis, :], num_samples - shifts]
+
+
+
+
+def mean_correlations(shifted):
+
+    '''
+    Mean off-diagonal Pearson correlation coefficient between the shifted
+    envelopes of each cell, for an array of shape (cells, envelopes, samples).
+    '''
+
+    num_envelopes = shifted.shape[1]
+
+    centred = shifted - shifted.mean(axis = 2)[:, :, np.newaxis]
+    covariance = np.matmul(centred, centred.transpose(0, 2, 1))
+    deviation = np.sqrt(np.diagonal(covariance, axis1 = 1, axis2 = 2))
+
+    with np.errstate(divide = 'ignore', invalid = 'ignore'):
+
+        correlations = covariance / (deviation[:, :, np.newaxis] * deviation[:, np.newaxis, :])
+
+    off_diagonal_sum = correlations.sum(axis = (1, 2)) - np.trace(correlations, axis1 = 1, axis2 = 2)
+
+    return off_diagonal_sum / (num_envelopes * (num_envelopes - 1))
+
+
+
+
+def backproject(envelopes, shifts, block_size = 256):
+
+    '''
+    Score every grid cell by the mean cross-correlation coefficient of the
+    envelopes shifted by the negative travel time from the cell to each
+    envelope's station.
+
+    shifts holds the sample shift of each envelope for each cell, with
+    shape (grid dimensions..., envelopes). Cells are processed in blocks
+    of block_size to bound memory use. Returns an array of the grid
+    dimensions.
+    '''
+
+    grid_shape = shifts.shape[:-1]
+    shifts = shifts.reshape(-1, shifts.shape[-1])
+
+    values = np.zeros(len(shifts))
+
+    for start in range(0, len(shifts), block_size):
+
+        values[start : start + block_size] = mean_correlations(shift_envelopes(envelopes, shifts[start : start + block_size]))
+
+    return values.reshape(grid_shape)
+
+
+
+
+def pair_correlations(envelopes):
+
+    '''
+    Calculate the full normalised cross-correlation function of every
+    pair of envelopes with one batch of real FFTs.
+
+    Returns the envelope pairs (a, b) with a < b, and for each pair the
+    Pearson correlation coefficient of envelope a delayed by d samples
+    relative to envelope b, stored at index d (negative delays wrap
+    around to the end). Coefficients use each envelope's
+    mean and variance over the whole window, i.e. they assume no data is
+    shifted out of the window.
+    '''
+
+    num_envelopes, num_samples = envelopes.shape
+    num_fft = 2 * num_samples - 1
+
+    pairs = np.array([[a, b] for a in range(num_envelopes) for b in range(a + 1, num_envelopes)], dtype = int).reshape(-1, 2)
+
+    spectra = np.fft.rfft(envelopes, n = num_fft, axis = 1)
+    cross = np.fft.irfft(np.conj(spectra[pairs[:, 0]]) * spectra[pairs[:, 1]], n = num_fft, axis = 1)
+
+    # Remove the means and normalise by the standard deviations
+
+    sums = envelopes.sum(axis = 1)
+    variances = (envelopes ** 2).sum(axis = 1) - sums ** 2 / num_samples
+
+    with np.errstate(divide = 'ignore', invalid = 'ignore'):
+
+        correlations = (cross - (sums[pairs[:, 0]] * sums[pairs[:, 1]] / num_samples)[:, np.newaxis]) / \
+                       np.sqrt(variances[pairs[:, 0]] * variances[pairs[:, 1]])[:, np.newaxis]
+
+    return pairs, correlations
+
+
+
+
+def backproject_lags(envelopes, shifts):
+
+    '''
+    Score every grid cell by the mean correlation coefficient between
+    pairs of shifted envelopes, looked up from each pair's full
+    cross-correlation function at the differential shift predicted for
+    the cell (see pair_correlations). The cost per cell is one lookup
+    per station pair, so dense grids are affordable.
+
+    shifts is as for backproject. Scores differ from backproject only
+    where a cell's shifts move envelope data out of the window.
+    '''
+
+    num_samples = envelopes.shape[1]
+    grid_shape = shifts.shape[:-1]
+    shifts = shifts.reshape(-1, shifts.shape[-1])
+
+    pairs, correlations = pair_correlations(envelopes)
+    num_fft = correlations.shape[1]
+
+    values = np.zeros(len(shifts))
+
+    for p in range(len(pairs)):
+
+        # Envelope a is delayed by shifts[a] - shifts[b] relative to envelope b.
+        # Beyond the window length the envelopes no longer overlap, which
+        # the last lag of the correlation function already represents.
+
+        lags = np.clip(shifts[:, pairs[p, 0]] - shifts[:, pairs[p, 1]], 1 - num_samples, num_samples - 1)
+
+        values += correlations[p][lags % num_fft]
+
+    return (values / len(pairs)).reshape(grid_shape)
+
+
+
+
+def share_arrays(arrays):
+
+    '''
+    Copy float arrays into one new shared memory block. Returns the block
+    (to be closed and unlinked by the caller once workers are done) and
+    the layout (offset and shape of each array) needed to attach to them.
+    '''
+
+    sizes = [int(np.prod(array.shape)) for array in arrays]
+    block = shared_memory.SharedMemory(create = True, size = max(8 * sum(sizes), 8))
+    buffer = np.ndarray((sum(sizes),), dtype = np.float64, buffer = block.buf)
+
+    layout = []
+    offset = 0
+
+    for array, size in zip(arrays, sizes):
+
+        buffer[offset : offset + size] = np.ravel(array)
+        layout.append((offset, tuple(array.shape)))
+        offset += size
+
+    return block, layout
+
+
+
+
+def attach_arrays(block_name, layout):
+
+    '''
+    Attach to arrays shared with share_arrays, without copying them.
+    Returns the block (to be closed, not unlinked, when done) and the arrays.
+    Intended for workers forked from the creating process, which share its
+    resource tracker.
+    '''
+
+    block = shared_memory.SharedMemory(name = block_name)
+
+    total = sum([int(np.prod(shape)) for offset, shape in layout])
+    buffer = np.ndarray((total,), dtype = np.float64, buffer = block.buf)
+
+    arrays = [buffer[offset : offset + int(np.prod(shape))].reshape(shape) for offset, shape in layout]
+
+    return block, arrays
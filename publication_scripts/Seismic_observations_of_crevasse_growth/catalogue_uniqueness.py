@@ -6,20 +6,6 @@ Works by events having second-decimated start times.
 NOTE: this version assumes the lowest directory is the threshold value dir.
 """
 
-def forward_difference(data):
-    
-    '''
-    Calculate forward difference
-    '''
-    
-    diff = []
-    for i in range(1, len(data)):
-        diff.append(float(data[i]) - float(data[i - 1]))
-    return diff
-
-
-
-
 import os
 import datetime
 import matplotlib.pyplot as plt
@@ -38,6 +24,9 @@ catalogues_to_purify = catalogues
 import numpy as np
 import scipy.optimize as linefit
 
+from event_catalogue import find_catalogue, open_catalogue, event_file_index
+from series_kernels import cumulative_counts
+
 def func(x,m,c):
     # function for line fit optimisation
     return m*x+c
@@ -47,28 +36,30 @@ def func(x,m,c):
 events = [[] for i in range(len(catalogues))]
 for i in range(len(catalogues)):
     
-    events[i] = os.listdir(catalogue_root_dir + catalogues[i] + '/' + thresholds[i] + '/')
+    catalogue_directory = catalogue_root_dir + catalogues[i] + '/' + thresholds[i] + '/'
+    catalogue_file = find_catalogue(catalogue_directory)
     
-for event_series in events:
+    # Take event names from the event catalogue if there is one
     
-    cumulative_event_sum = 0
-    cumulative_event_sums = []
-    event_times = []
+    if catalogue_file is not None:
+        
+        catalogue = open_catalogue(catalogue_file)
+        events[i] = list(event_file_index(catalogue))
+        catalogue.close()
+        
+    else:
+        
+        events[i] = os.listdir(catalogue_directory)
+    
+for event_series in events:
     
     # Generate cumulative sum list
     # and list of event times
     
-    sorted_PE = sorted(event_series)
-    
-    for event in sorted_PE:
-        
-        if event[-6:] != '.MSEED': continue
-        
-        cumulative_event_sum += 1
-        cumulative_event_sums.append(cumulative_event_sum)
+    sorted_PE = sorted([event for event in event_series if event[-6:] == '.MSEED'])
     
-        event_time = datetime.datetime.strptime(event[:event.index('.')], '%Y-%m-%dT%H:%M:%S')
-        event_times.append(event_time)
+    cumulative_event_sums = cumulative_counts(np.ones(len(sorted_PE), dtype = int))
+    event_times = np.array([event[:event.index('.')] for event in sorted_PE], dtype = 'datetime64[s]')
         
     plt.plot(event_times, cumulative_event_sums)
     plt.xlim(datetime.datetime.strptime('2016-05-01', '%Y-%m-%d'),
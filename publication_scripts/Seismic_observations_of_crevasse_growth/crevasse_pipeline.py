@@ -0,0 +1,115 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+Run the crevasse event processing chain as one pipeline: spectrum
+generation (one node per day), spectrogram event detection, event trigger
+refinement, GRID2D location and Plot_GRID2D location plotting. Each stage
+runs the existing script with the parameters below in place of its own,
+and stages whose script, parameters and inputs are unchanged since their
+last successful run are skipped.
+"""
+
+import datetime
+
+from pipeline import run_pipeline
+
+## Directories
+
+stream_root_directory = '/media/sam/61D05F6577F6DB39/SCIENCE/day_volumes_S/'
+spectrum_directory = '/home/sam/Spectrums_PIPELINE/'
+event_directory = '/home/sam/EVENTS_PIPELINE/TYPE_A/'
+
+## Define where the pipeline keeps its manifest, the parameterised stage
+## scripts and their logs (Plot_GRID2D writes its location files here too)
+
+pipeline_directory = '/home/sam/PIPELINE/'
+
+## Define date range (inclusive)
+
+start_date = datetime.date(2016, 4, 29)
+end_date = datetime.date(2016, 6, 1)
+
+## Define stations
+
+stream_component = 'Z'
+stream_stations = ['TSNC1', 'TSNC3', 'TSNL2', 'TSNL3', 'TSNR2', 'TSNR3']
+
+## Define the number of stage scripts run at once and how many times a
+## failed stage is retried
+
+max_workers = None
+retries = 0
+
+## Define stages to rerun even if they are up to date
+
+force = []
+
+## Define stages. Day stages run once per day, with the script's start_*
+## and end_* date parameters set to that day and {year}, {doy}, {jday} and
+## {date} filled in their parameters, inputs and outputs (see
+## pipeline.format_day)
+
+date_parameters = {'start_year': start_date.strftime('%Y'), 'start_month': start_date.strftime('%m'),
+                   'start_day': start_date.strftime('%d'), 'end_year': end_date.strftime('%Y'),
+                   'end_month': end_date.strftime('%m'), 'end_day': end_date.strftime('%d')}
+
+stages = [
+
+    # Day nodes run in parallel, so each uses one process and its own manifest
+
+    {'name': 'spectra',
+     'script': 'spectrum_genetation.py',
+     'split': 'day',
+     'parameters': {'stream_root_directory': stream_root_directory,
+                    'spectrum_output_directory': spectrum_directory,
+                    'stream_component': stream_component,
+                    'stream_stations': stream_stations,
+                    'manifest_file': spectrum_directory + '{date}.spectrum_manifest.json',
+                    'max_workers': 1},
+     'inputs': [stream_root_directory + 'Y{year}/R{doy}.01/'],
+     'outputs': [spectrum_directory + '*.{year}.{jday}_spectrums.dat']},
+
+    # Detection runs over the whole range into one catalogue (station days
+    # are run in parallel by the script itself). A rerun replaces each day's
+    # events in the catalogue rather than adding to them (see
+    # event_catalogue.remove_events)
+
+    {'name': 'detection',
+     'script': 'spectrogram_event_detection.py',
+     'depends': ['spectra'],
+     'parameters': dict(date_parameters, **{'event_output_directory': event_directory,
+                                            'spectrum_directory': spectrum_directory,
+                                            'stream_root_directory': stream_root_directory,
+                                            'stream_component': stream_component,
+                                            'stream_stations': stream_stations}),
+     'outputs': [event_directory + 'event_catalogue.sqlite']},
+
+    {'name': 'refinement',
+     'script': 're_spectrogram_event_detection.py',
+     'depends': ['detection'],
+     'parameters': {'event_input_directory': event_directory,
+                    'stations': stream_stations}},
+
+    {'name': 'location',
+     'script': 'GRID2D.py',
+     'depends': ['refinement'],
+     'parameters': {'event_directory': event_directory,
+                    'stations': stream_stations},
+     'outputs': [event_directory + '*.xcorrvaluegrid*']},
+
+    {'name': 'plot',
+     'script': 'Plot_GRID2D.py',
+     'depends': ['location'],
+     'parameters': dict(date_parameters, event_output_directory = event_directory),
+     'outputs': [pipeline_directory + 'plot/location_file.csv']}
+
+]
+
+ran, skipped, failed = run_pipeline(stages, start_date, end_date, pipeline_directory,
+                                    max_workers = max_workers, retries = retries, force = force)
+
+print(str(len(ran)) + ' stages run, ' + str(len(skipped)) + ' up to date, ' + str(len(failed)) + ' failed or not run')
+
+for node_id in failed:
+
+    print('  ' + node_id)
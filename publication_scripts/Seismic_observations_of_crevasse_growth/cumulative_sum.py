@@ -5,29 +5,22 @@ Generate cumulative sum plot for events
 """
 
 import os
-import datetime
+import numpy as np
 import matplotlib.pyplot as plt
 
+from series_kernels import cumulative_counts
+
 # Get list of events
 
 event_dir = '/home/samto/PERSONAL_SCIENCE/EVENTS/TYPE_D/'
 events = os.listdir(event_dir)
 events.sort()
 
-cumulative_event_sum = 0
-cumulative_event_sums = []
-event_times = []
-
 # Generate cumulative sum list
 # and list of event times
 
-for event in events:
-    
-    cumulative_event_sum += 1
-    cumulative_event_sums.append(cumulative_event_sum)
-
-    event_time = datetime.datetime.strptime(event[:event.index('.')], '%Y-%m-%dT%H:%M:%S')
-    event_times.append(event_time)
+cumulative_event_sums = cumulative_counts(np.ones(len(events), dtype = int))
+event_times = np.array([event[:event.index('.')] for event in events], dtype = 'datetime64[s]')
     
 # Plot cumulative event sum over time
     
@@ -0,0 +1,402 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+Array-based spectrogram detection: band-ratio triggering of
+spectrum files produced by spectrum_genetation.py and coincidence
+association of triggers into network events, and cutting event
+waveforms from day-long streams. Station-day triggering and day-long
+event cutting are also provided as process pool workers.
+"""
+
+import numpy as np
+import obspy
+
+from spectrum_store import read_spectra
+from event_catalogue import pack_waveform
+
+# Triggers are kept as structured arrays: on and off times (POSIX seconds),
+# the index of the triggered station in the station list, and the trigger SNR
+
+TRIGGER_DTYPE = np.dtype([('on', 'f8'), ('off', 'f8'), ('station', 'i4'), ('snr', 'f8')])
+
+# Network events: on and off times, event length and number of stations
+
+EVENT_DTYPE = np.dtype([('on', 'f8'), ('off', 'f8'), ('length', 'f8'), ('num_stations', 'i4')])
+
+
+
+
+def band_energies(spectrums, bands, band_weights):
+
+    '''
+    Calculate the weighted band energy of every spectrum at once.
+    Each band [start, end] contributes the sum of the spectrum values
+    in spectrum[start : end] normalised by the band length (taken from
+    cumulative sums over the frequency axis), and single-index bands
+    [index] contribute that spectrum value.
+    '''
+
+    return band_energy_sets(spectrums, [bands], [band_weights])[0]
+
+
+
+
+def band_energy_sets(spectrums, band_sets, band_weight_sets):
+
+    '''
+    Calculate the weighted band energies of every spectrum for several
+    band definitions (as in band_energies) from one cumulative sum over
+    the frequency axis. Returns an array of shape
+    (number of band definitions, number of spectra).
+    '''
+
+    spectrums = np.abs(np.asarray(spectrums, dtype = np.float64))
+    num_frequencies = spectrums.shape[1]
+
+    cumulative = np.zeros((spectrums.shape[0], num_frequencies + 1))
+    np.cumsum(spectrums, axis = 1, out = cumulative[:, 1:])
+
+    energies = np.zeros((len(band_sets), spectrums.shape[0]))
+
+    for b in range(len(band_sets)):
+        for band, weight in zip(band_sets[b], band_weight_sets[b]):
+
+            if len(band) > 1:
+
+                # Clip band edges to the spectrum as slicing would
+
+                start = min(max(band[0], 0), num_frequencies)
+                end = min(max(band[1], 0), num_frequencies)
+
+                energies[b] += (cumulative[:, end] - cumulative[:, start]) * weight / (band[1] - band[0])
+
+            else:
+
+                energies[b] += spectrums[:, band[0]] * weight
+
+    return energies
+
+
+
+
+def band_ratio_triggers(signal, noise, trigger_threshold, trigger_overload = np.inf):
+
+    '''
+    Generate triggers from signal band energies of successive spectra.
+
+    Each signal value is compared to the previous signal value (the
+    first is compared to the noise value) until the signal/noise
+    threshold is passed. From then on each successive signal value is
+    compared to the noise value at the time of triggering, until the
+    band ratio drops back below the threshold. This allows long triggers
+    to occur which is useful for separating different spectral signatures.
+
+    Band ratios outside triggers are calculated for all spectra at once,
+    so only the stateful part (finding where each trigger ends) is
+    scanned, trigger by trigger.
+
+    Returns the band ratio of each spectrum (NaN for the first), an array
+    of trigger on and off indices, and the maximum band ratio within each
+    trigger.
+    '''
+
+    signal = np.asarray(signal, dtype = np.float64)
+    num_spectra = len(signal)
+
+    ratios = np.full(num_spectra, np.nan)
+    trigger_indices = []
+    trigger_SNRs = []
+
+    if num_spectra < 2:
+
+        return ratios, np.zeros((0, 2), dtype = int), np.zeros(0)
+
+    # Noise value for each spectrum when no trigger is on
+
+    reference = np.empty(num_spectra)
+    reference[0] = np.nan
+    reference[1] = noise
+    reference[2:] = signal[1:-1]
+
+    with np.errstate(divide = 'ignore', invalid = 'ignore'):
+
+        ratios[1:] = signal[1:] / reference[1:]
+        onsets = np.flatnonzero((ratios >= trigger_threshold) & (ratios < trigger_overload))
+
+        position = 1
+
+        while True:
+
+            # Next trigger on index at or after the current position
+
+            c = np.searchsorted(onsets, position)
+
+            if c == len(onsets): break
+
+            on_index = onsets[c]
+            trigger_noise = reference[on_index]
+
+            # Scan forward in growing blocks for the first band ratio
+            # below the threshold, relative to the noise at triggering
+
+            off_index = None
+            start = on_index + 1
+            block = 16
+
+            while start < num_spectra:
+
+                block_ratios = signal[start : start + block] / trigger_noise
+                ratios[start : start + block] = block_ratios
+                below = np.flatnonzero(block_ratios < trigger_threshold)
+
+                if len(below) > 0:
+
+                    off_index = start + below[0]
+                    break
+
+                start += block
+                block *= 2
+
+            # A trigger still on at the end of the data is not saved
+
+            if off_index is None: break
+
+            # Band ratios after the trigger are relative to the previous spectrum again
+
+            ratios[off_index + 1 : start + block] = signal[off_index + 1 : start + block] / \
+                                                   reference[off_index + 1 : start + block]
+
+            trigger_indices.append([on_index, off_index])
+            trigger_SNRs.append(np.max(ratios[on_index : off_index]))
+
+            position = off_index + 1
+
+    return ratios, np.array(trigger_indices, dtype = int).reshape(-1, 2), np.array(trigger_SNRs)
+
+
+
+
+def spectrum_file_triggers(spectrum_file, station_index, signal_bands, signal_band_weights,
+                           noise_bands, noise_band_weights, trigger_threshold, trigger_overload = np.inf):
+
+    '''
+    Generate the triggers of one station-day from its spectrum file.
+    Returns a compact trigger array (SNRs as percentages) so it can be
+    passed cheaply from a worker process.
+    '''
+
+    times, spectrums = read_spectra(spectrum_file)
+
+    if len(times) == 0:
+
+        return np.zeros(0, dtype = TRIGGER_DTYPE)
+
+    signal = band_energies(spectrums, signal_bands, signal_band_weights)
+    noise = band_energies(spectrums[:1], noise_bands, noise_band_weights)[0]
+
+    ratios, trigger_indices, trigger_SNRs = band_ratio_triggers(signal, noise, trigger_threshold, trigger_overload)
+
+    return make_triggers(times, trigger_indices, 100 * trigger_SNRs, station_index)
+
+
+
+
+def make_triggers(times, trigger_indices, trigger_SNRs, station_index):
+
+    '''
+    Build a trigger array for one station from the spectrum midtimes and
+    the trigger on/off indices and SNRs from band_ratio_triggers.
+    '''
+
+    triggers = np.zeros(len(trigger_indices), dtype = TRIGGER_DTYPE)
+
+    if len(trigger_indices) > 0:
+
+        triggers['on'] = times[trigger_indices[:, 0]]
+        triggers['off'] = times[trigger_indices[:, 1]]
+
+    triggers['station'] = station_index
+    triggers['snr'] = trigger_SNRs
+
+    return triggers
+
+
+
+
+def associate_triggers(triggers, station_threshold, delay_time, interevent_time,
+                       trigger_min_len, trigger_max_len, event_min_len, event_max_len,
+                       inclusive_trigger_min = True, inclusive_event_len = False):
+
+    '''
+    Find coincident triggers across stations with a sweep over triggers
+    sorted by on time.
+
+    Each trigger of acceptable duration that starts at least
+    interevent_time after the end of the previous event opens a candidate
+    event. Later triggers of acceptable duration starting within
+    delay_time of its off time (found by binary search on the sorted on
+    times) are added, one per station. Candidates with at least
+    station_threshold stations and an acceptable event length are kept.
+
+    Durations are compared with trigger_min_len <= duration <= trigger_max_len
+    (trigger_min_len < duration if not inclusive_trigger_min) and event
+    lengths with event_min_len < length < event_max_len (inclusive of both
+    limits if inclusive_event_len).
+
+    Returns the triggers sorted by on time, an event array, and for each
+    event the indices of its triggers in the sorted trigger array.
+    '''
+
+    triggers = np.sort(np.asarray(triggers, dtype = TRIGGER_DTYPE), order = ['on', 'off', 'station'])
+
+    durations = triggers['off'] - triggers['on']
+
+    if inclusive_trigger_min == True:
+
+        valid = (trigger_min_len <= durations) & (durations <= trigger_max_len)
+
+    else:
+
+        valid = (trigger_min_len < durations) & (durations <= trigger_max_len)
+
+    # Index after the last trigger that could join each trigger's event
+
+    window_ends = np.searchsorted(triggers['on'], triggers['off'] + delay_time, side = 'right')
+
+    # Sweep using plain lists: the inner windows are short
+
+    ons = triggers['on'].tolist()
+    offs = triggers['off'].tolist()
+    stations = triggers['station'].tolist()
+    valids = valid.tolist()
+    window_ends = window_ends.tolist()
+
+    events = []
+    event_members = []
+    last_off = -np.inf
+
+    for k in np.flatnonzero(valid).tolist():
+
+        on = ons[k]
+        off = offs[k]
+
+        # Avoid overlapping events
+
+        if on < last_off + interevent_time: continue
+
+        # Add temporally-nearby triggers, allowing only one trigger per station
+
+        members = [k]
+        event_stations = set([stations[k]])
+
+        for m in range(k + 1, window_ends[k]):
+
+            if (valids[m] == False) or (stations[m] in event_stations): continue
+
+            members.append(m)
+            event_stations.add(stations[m])
+
+        if len(members) > 1:
+
+            event_off = max(off, offs[members[-1]])
+            last_off = event_off
+
+        else:
+
+            event_off = off
+
+        if len(members) < station_threshold: continue
+
+        event_length = event_off - on
+
+        if inclusive_event_len == True:
+
+            if not (event_min_len <= event_length <= event_max_len): continue
+
+        else:
+
+            if not (event_min_len < event_length < event_max_len): continue
+
+        events.append((on, event_off, event_length, len(members)))
+        event_members.append(np.array(members))
+
+    return triggers, np.array(events, dtype = EVENT_DTYPE), event_members
+
+
+
+
+def cut_events(stream_files, triggers, event_members, stations, pre_post_time):
+
+    '''
+    Cut every event's waveforms from day-long stream files, with each
+    station's stream trimmed to its trigger duration plus pre_post_time
+    seconds either side.
+
+    stream_files maps station names to their day-long stream file. Each
+    file is read once and all event windows for that station are sliced
+    from it, rather than reading the file again for every trigger.
+    Returns one stream per event, with traces in trigger order.
+    '''
+
+    # Collect the (event, position in event, trigger) slices needed from each station
+
+    station_slices = {}
+
+    for e in range(len(event_members)):
+        for p in range(len(event_members[e])):
+
+            trigger = triggers[event_members[e][p]]
+            station_slices.setdefault(int(trigger['station']), []).append((e, p, trigger))
+
+    event_traces = [[None] * len(members) for members in event_members]
+
+    for station_index in sorted(station_slices):
+
+        station = stations[station_index]
+
+        if station not in stream_files:
+
+            print('No stream file found for station ' + station)
+            continue
+
+        stream = obspy.read(stream_files[station])
+
+        for e, p, trigger in station_slices[station_index]:
+
+            # Copy the slices so the day-long stream can be released
+
+            event_traces[e][p] = stream.slice(starttime = obspy.UTCDateTime(trigger['on']) - pre_post_time,
+                                              endtime = obspy.UTCDateTime(trigger['off']) + pre_post_time).copy()
+
+        del stream
+
+    event_streams = []
+
+    for traces in event_traces:
+
+        event_stream = obspy.Stream()
+
+        for trace_stream in traces:
+
+            if trace_stream is not None:
+
+                event_stream += trace_stream
+
+        event_streams.append(event_stream)
+
+    return event_streams
+
+
+
+
+def cut_packed_events(stream_files, triggers, event_members, stations, pre_post_time):
+
+    '''
+    Cut a day's event waveforms as in cut_events and return them as
+    miniSEED bytes (see event_catalogue.pack_waveform), for passing from
+    a worker process to the process writing the event catalogue.
+    '''
+
+    event_streams = cut_events(stream_files, triggers, event_members, stations, pre_post_time)
+
+    return [pack_waveform(event_stream) for event_stream in event_streams]
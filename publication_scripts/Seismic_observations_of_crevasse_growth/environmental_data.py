@@ -0,0 +1,279 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+Bulk readers for the environmental (GNSS and lake level) data compared
+against crevassing rates in trigger_statistics_vel.py. Fixed-width files
+saved from MATLAB (save -ascii -double) are memory-mapped and parsed as
+arrays: the time column is parsed first, the date window is found with
+np.searchsorted, and only the data columns of rows within the window are
+parsed. The window functions also slice samples cached by forcing_store.
+"""
+
+import csv
+import os
+
+import numpy as np
+
+# MATLAB datenum of 1970-01-01
+
+MATLAB_EPOCH = 719529
+
+
+
+
+def matlab_day_of_year(matlab_seconds):
+
+    '''
+    Convert MATLAB times in seconds (datenum * 86400) to days of the year,
+    decimal days of the year (day of the year plus fraction of the day, as
+    used for the hourly data in trigger_statistics_vel) and years.
+    '''
+
+    matlab_seconds = np.asarray(matlab_seconds, dtype = np.float64)
+
+    days = np.floor(matlab_seconds / 86400.0)
+    day_fractions = (matlab_seconds - 86400 * days) / 86400.0
+
+    dates = (days - MATLAB_EPOCH).astype(np.int64).astype('datetime64[D]')
+    year_starts = dates.astype('datetime64[Y]')
+
+    days_of_year = (dates - year_starts.astype('datetime64[D]')).astype(np.int64) + 1
+    years = year_starts.astype(np.int64) + 1970
+
+    return days_of_year, days_of_year + day_fractions, years
+
+
+
+
+def day_window(matlab_seconds, start_date, end_date):
+
+    '''
+    Find the times (MATLAB seconds) whose day of the year is between
+    start_date and end_date (inclusive), in every year the times span.
+    Sorted times are windowed with np.searchsorted, returning a slice
+    (one per year, joined into an index array for multi-year data), and
+    unsorted times fall back to a boolean mask.
+    '''
+
+    matlab_seconds = np.asarray(matlab_seconds)
+
+    if len(matlab_seconds) == 0:
+
+        return slice(0, 0)
+
+    if np.any(np.diff(matlab_seconds) < 0):
+
+        days_of_year = matlab_day_of_year(matlab_seconds)[0]
+
+        return (days_of_year >= start_date) & (days_of_year <= end_date)
+
+    first_year, last_year = matlab_day_of_year([matlab_seconds[0], matlab_seconds[-1]])[2]
+
+    windows = []
+
+    for year in range(first_year, last_year + 1):
+
+        # Window from the start of start_date to the end of end_date
+
+        year_start = 86400 * (MATLAB_EPOCH + (np.datetime64(str(year), 'D') - np.datetime64('1970-01-01', 'D')).astype(np.int64))
+
+        windows.append([np.searchsorted(matlab_seconds, year_start + 86400 * (start_date - 1), 'left'),
+                        np.searchsorted(matlab_seconds, year_start + 86400 * end_date, 'left')])
+
+    if len(windows) == 1:
+
+        return slice(windows[0][0], windows[0][1])
+
+    return np.concatenate([np.arange(start, end) for start, end in windows])
+
+
+
+
+def read_fixed_width(fixed_width_file, columns, rows = None, field_width = 25, field_offset = 3):
+
+    '''
+    Parse columns of a fixed-width numeric file (fields of field_width
+    characters, the first field_offset characters of each being padding,
+    as written by MATLAB's save -ascii -double) into an array of shape
+    (rows, columns). The file is memory-mapped, and only the given rows (a
+    slice or index array, None for all) of the given columns are parsed.
+    Files whose lines are not all the same length are read with np.loadtxt.
+    '''
+
+    if os.path.getsize(fixed_width_file) == 0:
+
+        return np.zeros((0, len(columns)))
+
+    data = np.memmap(fixed_width_file, dtype = np.uint8, mode = 'r')
+
+    # Lines are assumed to be shorter than 64 kB
+
+    newlines = np.flatnonzero(data[:65536] == ord('\n'))
+    line_length = int(newlines[0]) + 1 if len(newlines) > 0 else len(data) + 1
+
+    # Allow for a missing newline at the end of the file
+
+    num_lines = (len(data) + 1) // line_length
+
+    fixed_width = (num_lines * line_length in [len(data), len(data) + 1]) and \
+                  np.all(data[line_length - 1 : : line_length] == ord('\n'))
+
+    if not fixed_width:
+
+        values = np.atleast_2d(np.loadtxt(fixed_width_file))[:, columns]
+
+        return values if rows is None else values[rows]
+
+    if num_lines * line_length > len(data):
+
+        lines = np.zeros((num_lines, line_length), dtype = np.uint8)
+        lines.ravel()[:len(data)] = data
+
+    else:
+
+        lines = data.reshape(num_lines, line_length)
+
+    if rows is not None:
+
+        lines = lines[rows]
+
+    values = np.zeros((len(lines), len(columns)))
+
+    for c in range(len(columns)):
+
+        start = field_width * columns[c] + field_offset
+        field = np.ascontiguousarray(lines[:, start : field_width * (columns[c] + 1)])
+
+        values[:, c] = field.view('S' + str(field.shape[1])).ravel().astype(np.float64)
+
+    return values
+
+
+
+
+def gnss_position_window(samples, start_date, end_date):
+
+    '''
+    Window GNSS position samples (one row of MATLAB time in seconds,
+    easting, northing and elevation per time) to days of the year
+    start_date to end_date. Returns the decimal days of the year and the
+    positions (one row of easting, northing and elevation per time).
+    '''
+
+    window = day_window(samples[:, 0], start_date, end_date)
+
+    return matlab_day_of_year(samples[window, 0])[1], samples[window, 1:4]
+
+
+
+
+def read_gnss_positions(position_file, start_date, end_date):
+
+    '''
+    Read a GNSS position file (tas_position_arc*.txt: MATLAB time in
+    seconds, then easting, northing and elevation) for days of the year
+    start_date to end_date. Returns the decimal days of the year and the
+    positions (one row of easting, northing and elevation per time).
+    '''
+
+    matlab_seconds = read_fixed_width(position_file, [0])[:, 0]
+
+    window = day_window(matlab_seconds, start_date, end_date)
+
+    positions = read_fixed_width(position_file, [1, 2, 3], rows = window)
+
+    return matlab_day_of_year(matlab_seconds[window])[1], positions
+
+
+
+
+def gnss_velocity_window(v_data, start_date, end_date):
+
+    '''
+    Window the rows of a GNSS velocity file (MATLAB time in seconds,
+    velocity and its lower and upper bounds in m/s) to days of the year
+    start_date to end_date. Times are truncated to whole seconds. Returns
+    the decimal days of the year, velocities (m/day), velocity
+    uncertainties (half the bound range, m/day) and relative uncertainties
+    (%).
+    '''
+
+    if v_data.size == 0:
+
+        return np.zeros(0), np.zeros(0), np.zeros(0), np.zeros(0)
+
+    matlab_seconds = np.floor(v_data[:, 0])
+
+    window = day_window(matlab_seconds, start_date, end_date)
+
+    velocities = 86400.0 * v_data[window, 1]
+    uncertainties = 86400.0 * np.abs(v_data[window, 3] - v_data[window, 2]) / 2
+
+    with np.errstate(divide = 'ignore', invalid = 'ignore'):
+
+        relative_uncertainties = 100 * uncertainties / velocities
+
+    return matlab_day_of_year(matlab_seconds[window])[1], velocities, uncertainties, relative_uncertainties
+
+
+
+
+def read_gnss_velocities(velocity_file, start_date, end_date):
+
+    '''
+    Read a GNSS velocity file for days of the year start_date to end_date
+    (see gnss_velocity_window).
+    '''
+
+    return gnss_velocity_window(np.atleast_2d(np.loadtxt(velocity_file)), start_date, end_date)
+
+
+
+
+def read_lake_levels(lake_level_file):
+
+    '''
+    Read a lake level file (.csv rows of time as YYYY-mm-dd HH:MM:SS, two
+    other columns, then the lake level). Returns an array of one row of
+    MATLAB time in seconds and lake level per sample, in file order.
+    '''
+
+    times = []
+    levels = []
+
+    with open(lake_level_file, 'r') as csvfile:
+
+        for line in csv.reader(csvfile):
+
+            times.append(line[0])
+            levels.append(float(line[3]))
+
+    posix_seconds = np.array(times, dtype = 'datetime64[s]').astype(np.int64)
+
+    samples = np.zeros((len(times), 2))
+    samples[:, 0] = 86400 * MATLAB_EPOCH + posix_seconds
+    samples[:, 1] = levels
+
+    return samples
+
+
+
+
+def lake_level_window(samples, year, start_date, end_date):
+
+    '''
+    Window lake level samples (see read_lake_levels) to days of the year
+    start_date to end_date of year. Returns the day of the year, the hour
+    (with minutes and seconds as fractions of the hour) and the lake level
+    of each sample in the window.
+    '''
+
+    days_of_year, decimal_days, years = matlab_day_of_year(samples[:, 0])
+
+    window = (years == year) & (days_of_year >= start_date) & (days_of_year <= end_date)
+
+    seconds = samples[window, 0] % 86400
+
+    hours = seconds // 3600 + (seconds % 3600 // 60) / 60.0 + (seconds % 60) / 3600.0
+
+    return days_of_year[window], hours, samples[window, 1]
@@ -0,0 +1,481 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+Indexed event catalogue: an SQLite database of detected events and their
+station triggers, with event waveforms packed into miniSEED archives
+(one per day, event type and threshold) indexed by byte offset.
+Replaces one .MSEED and one trigger .csv file per event, so downstream
+scripts can query events by time range without scanning directories.
+"""
+
+import io
+import os
+import sqlite3
+
+import numpy as np
+import obspy
+
+# Name of the catalogue database within an event directory
+
+CATALOGUE_NAME = 'event_catalogue.sqlite'
+
+SCHEMA = '''
+CREATE TABLE IF NOT EXISTS events (
+    id INTEGER PRIMARY KEY,
+    on_time REAL NOT NULL,
+    off_time REAL NOT NULL,
+    length REAL,
+    num_stations INTEGER,
+    stations TEXT,
+    type TEXT,
+    threshold REAL
+);
+CREATE INDEX IF NOT EXISTS events_on_time ON events (on_time);
+CREATE TABLE IF NOT EXISTS triggers (
+    event_id INTEGER NOT NULL,
+    stage TEXT NOT NULL,
+    station TEXT NOT NULL,
+    on_time REAL NOT NULL,
+    off_time REAL NOT NULL,
+    snr REAL
+);
+CREATE INDEX IF NOT EXISTS triggers_event_id ON triggers (event_id, stage);
+CREATE TABLE IF NOT EXISTS waveforms (
+    event_id INTEGER PRIMARY KEY,
+    archive TEXT NOT NULL,
+    offset INTEGER NOT NULL,
+    length INTEGER NOT NULL
+);
+'''
+
+
+
+
+def open_catalogue(catalogue_file):
+
+    '''
+    Open (creating if needed) an event catalogue.
+    '''
+
+    connection = sqlite3.connect(catalogue_file)
+    connection.executescript(SCHEMA)
+
+    return connection
+
+
+
+
+def find_catalogue(event_directory):
+
+    '''
+    Return the event catalogue in an event directory, or None if the
+    directory only holds individual event files.
+    '''
+
+    catalogue_file = event_directory + CATALOGUE_NAME
+
+    if os.path.exists(catalogue_file):
+
+        return catalogue_file
+
+    return None
+
+
+
+
+def event_file_names(event_directory, starttime = None, endtime = None):
+
+    '''
+    Names of the individual event files (.MSEED) in an event directory with
+    on times between starttime and endtime (either may be None), sorted by
+    time.
+    '''
+
+    names = [afile for afile in os.listdir(event_directory) if afile[-6:] == '.MSEED']
+
+    # Event names are ISO times of fixed length, so they compare as times
+
+    if starttime is not None:
+
+        first = event_name(starttime)
+        names = [name for name in names if name[:-6] >= first]
+
+    if endtime is not None:
+
+        last = event_name(endtime)
+        names = [name for name in names if name[:-6] <= last]
+
+    return sorted(names)
+
+
+
+
+def find_events(event_directory, starttime = None, endtime = None):
+
+    '''
+    Find the events in an event directory with on times between starttime
+    and endtime: from its event catalogue if it has one (without scanning
+    the directory), otherwise from its event files.
+
+    Returns the catalogue file (None without a catalogue), a dictionary of
+    catalogued event names (see event_file_index) to event ids and the
+    sorted event names.
+    '''
+
+    catalogue_file = find_catalogue(event_directory)
+
+    if catalogue_file is None:
+
+        return None, {}, event_file_names(event_directory, starttime, endtime)
+
+    catalogue = open_catalogue(catalogue_file)
+    catalogue_events = event_file_index(catalogue, starttime, endtime)
+    catalogue.close()
+
+    return catalogue_file, catalogue_events, sorted(catalogue_events)
+
+
+
+
+def event_name(on_time):
+
+    '''
+    Name of an event as used for event files: its on time as an ISO string.
+    '''
+
+    return str(obspy.UTCDateTime(on_time))
+
+
+
+
+def archive_name(on_time, event_type = None, threshold = None):
+
+    '''
+    Waveform archive (relative to the catalogue directory) holding events
+    of one type and threshold starting on the same day, so a day's events
+    can be replaced (see remove_events) without leaving their waveforms
+    behind in an archive shared with other events.
+    '''
+
+    return 'waveforms/' + obspy.UTCDateTime(on_time).strftime('%Y.%j') + '_' + str(event_type) + '_' + \
+           str(threshold) + '.mseed'
+
+
+
+
+def catalogue_directory(connection):
+
+    '''
+    Directory of the catalogue's database file.
+    '''
+
+    database_file = connection.execute('PRAGMA database_list').fetchone()[2]
+
+    return os.path.dirname(os.path.abspath(database_file)) + '/'
+
+
+
+
+def add_event(connection, on_time, off_time, triggers, event_type = None, threshold = None,
+              event_stream = None, stage = 'detection'):
+
+    '''
+    Add an event and its station triggers (a list of
+    [station, on_time, off_time, snr]) to the catalogue, and append its
+    waveforms to the day's waveform archive if event_stream (a stream, or
+    bytes from pack_waveform) is given.
+    Times may be POSIX seconds or UTCDateTimes. Returns the event id.
+    '''
+
+    on_time = float(obspy.UTCDateTime(on_time).timestamp)
+    off_time = float(obspy.UTCDateTime(off_time).timestamp)
+    stations = [trigger[0] for trigger in triggers]
+
+    cursor = connection.execute('INSERT INTO events (on_time, off_time, length, num_stations, stations, type, threshold) '
+                                'VALUES (?, ?, ?, ?, ?, ?, ?)',
+                                (on_time, off_time, off_time - on_time, len(stations), ','.join(stations),
+                                 event_type, threshold))
+    event_id = cursor.lastrowid
+
+    add_triggers(connection, event_id, triggers, stage = stage)
+
+    if event_stream is not None:
+
+        write_waveform(connection, event_id, on_time, event_stream, event_type, threshold)
+
+    return event_id
+
+
+
+
+def remove_events(connection, starttime, endtime, event_type = None, threshold = None):
+
+    '''
+    Remove the events of one type and threshold (None matches events
+    without one) with on times from starttime up to endtime (exclusive),
+    with their triggers and waveforms, e.g. before a day's events are
+    detected again. The removal is committed, and waveform archives left
+    without events are then deleted. Returns the number of events removed.
+    '''
+
+    event_ids = [(row[0],) for row in connection.execute('SELECT id FROM events WHERE on_time >= ? AND on_time < ? '
+                                                         'AND type IS ? AND threshold IS ?',
+                                                         (float(obspy.UTCDateTime(starttime).timestamp),
+                                                          float(obspy.UTCDateTime(endtime).timestamp),
+                                                          event_type, threshold))]
+
+    if len(event_ids) == 0:
+
+        return 0
+
+    archives = set()
+
+    for event_id in event_ids:
+
+        row = connection.execute('SELECT archive FROM waveforms WHERE event_id = ?', event_id).fetchone()
+
+        if row is not None: archives.add(row[0])
+
+    connection.executemany('DELETE FROM triggers WHERE event_id = ?', event_ids)
+    connection.executemany('DELETE FROM waveforms WHERE event_id = ?', event_ids)
+    connection.executemany('DELETE FROM events WHERE id = ?', event_ids)
+    connection.commit()
+
+    # Archives shared with other events (e.g. written before archives were
+    # kept per type and threshold) are kept
+
+    for archive in sorted(archives):
+
+        if connection.execute('SELECT 1 FROM waveforms WHERE archive = ? LIMIT 1', (archive,)).fetchone() is not None:
+
+            continue
+
+        if os.path.exists(catalogue_directory(connection) + archive):
+
+            os.remove(catalogue_directory(connection) + archive)
+
+    return len(event_ids)
+
+
+
+
+def add_triggers(connection, event_id, triggers, stage = 'detection'):
+
+    '''
+    Add station triggers (a list of [station, on_time, off_time, snr]) for
+    an event. stage separates detection triggers from later re-triggering
+    (e.g. 'refined'); existing triggers of the same stage are replaced.
+    '''
+
+    connection.execute('DELETE FROM triggers WHERE event_id = ? AND stage = ?', (event_id, stage))
+
+    rows = []
+
+    for trigger in triggers:
+
+        snr = None
+
+        if len(trigger) > 3 and trigger[3] is not None:
+
+            snr = float(trigger[3])
+
+        rows.append((event_id, stage, trigger[0], float(obspy.UTCDateTime(trigger[1]).timestamp),
+                     float(obspy.UTCDateTime(trigger[2]).timestamp), snr))
+
+    connection.executemany('INSERT INTO triggers (event_id, stage, station, on_time, off_time, snr) '
+                           'VALUES (?, ?, ?, ?, ?, ?)', rows)
+
+
+
+
+def pack_waveform(event_stream):
+
+    '''
+    Serialise an event stream as miniSEED bytes, as stored in waveform
+    archives: STEIM2 compressed for integer (int32) traces, otherwise in
+    the encoding obspy chooses for the data type (e.g. FLOAT32).
+    '''
+
+    # Events without waveforms (e.g. missing stream files) are stored empty
+
+    if len(event_stream) == 0:
+
+        return b''
+
+    buffer = io.BytesIO()
+
+    # miniSEED records are independent, so traces are written one at a time
+    # with the encoding of each trace's data type
+
+    for trace in event_stream:
+
+        if trace.data.dtype == np.int32:
+
+            trace.write(buffer, format = 'MSEED', encoding = 'STEIM2')
+
+        else:
+
+            trace.write(buffer, format = 'MSEED')
+
+    return buffer.getvalue()
+
+
+
+
+def write_waveform(connection, event_id, on_time, event_stream, event_type = None, threshold = None):
+
+    '''
+    Append an event's waveforms (a stream, or bytes from pack_waveform) to
+    the waveform archive of the day, type and threshold of the event (see
+    archive_name) and index their byte offset and length.
+    '''
+
+    if isinstance(event_stream, bytes):
+
+        data = event_stream
+
+    else:
+
+        data = pack_waveform(event_stream)
+
+    archive = archive_name(on_time, event_type, threshold)
+    archive_file = catalogue_directory(connection) + archive
+
+    if not os.path.exists(os.path.dirname(archive_file)):
+
+        os.makedirs(os.path.dirname(archive_file))
+
+    with open(archive_file, 'ab') as openfile:
+
+        offset = openfile.tell()
+        openfile.write(data)
+
+    connection.execute('INSERT OR REPLACE INTO waveforms (event_id, archive, offset, length) VALUES (?, ?, ?, ?)',
+                       (event_id, archive, offset, len(data)))
+
+
+
+
+def read_waveform(connection, event_id):
+
+    '''
+    Read an event's waveforms from its waveform archive.
+    '''
+
+    row = connection.execute('SELECT archive, offset, length FROM waveforms WHERE event_id = ?',
+                             (event_id,)).fetchone()
+
+    if (row is None) or (row[2] == 0):
+
+        return obspy.Stream()
+
+    archive, offset, length = row
+
+    with open(catalogue_directory(connection) + archive, 'rb') as openfile:
+
+        openfile.seek(offset)
+        data = openfile.read(length)
+
+    return obspy.read(io.BytesIO(data), format = 'MSEED')
+
+
+
+
+def query_events(connection, starttime = None, endtime = None, event_type = None, threshold = None):
+
+    '''
+    Find events with on times between starttime and endtime (POSIX seconds
+    or UTCDateTimes, either may be None), optionally of one type and
+    threshold. Returns rows of (id, on_time, off_time, length,
+    num_stations, stations, type, threshold) sorted by on time.
+    '''
+
+    conditions = []
+    values = []
+
+    if starttime is not None:
+
+        conditions.append('on_time >= ?')
+        values.append(float(obspy.UTCDateTime(starttime).timestamp))
+
+    if endtime is not None:
+
+        conditions.append('on_time <= ?')
+        values.append(float(obspy.UTCDateTime(endtime).timestamp))
+
+    if event_type is not None:
+
+        conditions.append('type = ?')
+        values.append(event_type)
+
+    if threshold is not None:
+
+        conditions.append('threshold = ?')
+        values.append(threshold)
+
+    query = 'SELECT id, on_time, off_time, length, num_stations, stations, type, threshold FROM events'
+
+    if len(conditions) > 0:
+
+        query += ' WHERE ' + ' AND '.join(conditions)
+
+    return connection.execute(query + ' ORDER BY on_time, id', values).fetchall()
+
+
+
+
+def event_times(connection, starttime = None, endtime = None, event_type = None, threshold = None):
+
+    '''
+    On times (POSIX seconds) of events in a time range, as a sorted array.
+    '''
+
+    rows = query_events(connection, starttime, endtime, event_type, threshold)
+
+    return np.array([row[1] for row in rows], dtype = np.float64)
+
+
+
+
+def event_file_index(connection, starttime = None, endtime = None, event_type = None, threshold = None):
+
+    '''
+    Map the event file names the scripts used before the catalogue
+    (e.g. 2016-05-01T12:00:00.500000Z.MSEED) to event ids, in time order,
+    for events in a time range.
+    '''
+
+    rows = query_events(connection, starttime, endtime, event_type, threshold)
+
+    return dict([(event_name(row[1]) + '.MSEED', row[0]) for row in rows])
+
+
+
+
+def event_triggers(connection, event_id, stage = None):
+
+    '''
+    Station triggers of an event as a list of [station, on_time, off_time,
+    snr] with UTCDateTime times. If stage is None, refined triggers are
+    returned when available, otherwise detection triggers.
+    '''
+
+    if stage is None:
+
+        stages = ['refined', 'detection']
+
+    else:
+
+        stages = [stage]
+
+    for stage in stages:
+
+        rows = connection.execute('SELECT station, on_time, off_time, snr FROM triggers '
+                                  'WHERE event_id = ? AND stage = ? ORDER BY on_time, station',
+                                  (event_id, stage)).fetchall()
+
+        if len(rows) > 0:
+
+            return [[row[0], obspy.UTCDateTime(row[1]), obspy.UTCDateTime(row[2]), row[3]] for row in rows]
+
+    return []
@@ -0,0 +1,563 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+Per-event spectral feature store: the spectra of every event's station
+waveforms are calculated once, in parallel across days of events, and
+stored column by column (one .npy file per column, memory-mapped when
+loaded) with one row per event station. Events added later are appended
+as a new segment of columns, so existing columns are never rewritten.
+Inspection scripts query the store rather than re-running FFTs.
+
+Each row holds the event and station, the station trigger times and
+duration, the peak frequency, spectral centroid and band energies of the
+triggered data, its mean amplitude spectrum, and the position of the
+station's spectrogram (non-overlapping windows over the whole event
+waveform) in its segment's spectrogram columns. As for the detection
+spectra, spectra are the absolute real part of the rFFT without the first
+(zero) frequency.
+"""
+
+import hashlib
+import itertools
+import json
+import os
+import shutil
+
+import obspy
+import numpy as np
+
+from event_catalogue import open_catalogue, read_waveform, event_triggers
+from spectrum_store import detrend_windows
+from task_scheduler import run_tasks
+
+# Row columns and their types (band energies and spectra have one value
+# per band or frequency per row)
+
+ROW_COLUMNS = {'event': 'U32', 'event_id': 'i8', 'station': 'U8', 'on_time': 'f8', 'off_time': 'f8',
+               'duration': 'f8', 'peak_frequency': 'f8', 'centroid': 'f8', 'band_energies': 'f8',
+               'spectrum': 'f4', 'window_start': 'i8', 'window_count': 'i8'}
+
+# Spectrogram columns, with one value (or spectrum) per window
+
+WINDOW_COLUMNS = {'window_times': 'f8', 'spectrogram': 'f4'}
+
+# Default feature bands (Hz)
+
+DEFAULT_BANDS = [[1, 5], [5, 10], [10, 20], [20, 50]]
+
+# Version of the feature calculation, part of the store key so stores
+# calculated differently are not reused
+
+FEATURE_VERSION = 2
+
+
+
+
+def feature_key(stations, FFT_window_length, sampling_rate, bands, pre_post_time):
+
+    '''
+    Key identifying a feature store: a hash of the parameters its
+    features are calculated with.
+    '''
+
+    parameters = [FEATURE_VERSION, sorted(stations), FFT_window_length, sampling_rate, bands, pre_post_time]
+
+    return hashlib.sha1(json.dumps(parameters).encode()).hexdigest()[:16]
+
+
+
+
+def feature_frequencies(FFT_window_length, sampling_rate):
+
+    '''
+    Frequencies (Hz) of the stored spectra: the rFFT frequencies of an FFT
+    window without the first (zero) frequency.
+    '''
+
+    return np.fft.rfftfreq(int(round(FFT_window_length * sampling_rate)), 1 / float(sampling_rate))[1:]
+
+
+
+
+def load_event_data(catalogue, event_directory, event, event_id, pre_post_time):
+
+    '''
+    Load an event's waveforms and station triggers (a list of [station, on
+    time, off time], POSIX seconds), from the event catalogue if the event
+    has an id, otherwise from its .MSEED and .csv files. Events without
+    trigger files are taken to trigger on every station for the waveform
+    less pre_post_time either side.
+    '''
+
+    if event_id is not None:
+
+        stream = read_waveform(catalogue, event_id)
+        triggers = [[trigger[0], trigger[1].timestamp, trigger[2].timestamp]
+                    for trigger in event_triggers(catalogue, event_id)]
+
+        return stream, triggers
+
+    stream = obspy.read(event_directory + event)
+    trigger_file = event_directory + event[:-6] + '.csv'
+
+    if os.path.exists(trigger_file):
+
+        with open(trigger_file, 'r') as openfile:
+
+            triggers = [[row.split(',')[0], obspy.UTCDateTime(row.split(',')[1]).timestamp,
+                         obspy.UTCDateTime(row.split(',')[2].strip()).timestamp] for row in openfile if row.strip()]
+
+    else:
+
+        triggers = [[trace.stats.station, trace.stats.starttime.timestamp + pre_post_time,
+                     trace.stats.endtime.timestamp - pre_post_time] for trace in stream]
+
+    return stream, triggers
+
+
+
+
+def spectral_features(spectra, frequencies, bands):
+
+    '''
+    Peak frequency, spectral centroid and band energies of amplitude
+    spectra (one spectrum per row). Band energies are the summed power of
+    frequencies from band[0] (inclusive) to band[1] (exclusive) Hz.
+    '''
+
+    spectra = np.asarray(spectra, dtype = np.float64)
+
+    peak_frequencies = frequencies[np.argmax(spectra, axis = 1)]
+
+    with np.errstate(divide = 'ignore', invalid = 'ignore'):
+
+        centroids = (spectra * frequencies).sum(axis = 1) / spectra.sum(axis = 1)
+
+    power = spectra ** 2
+
+    band_energies = np.column_stack([power[:, (frequencies >= band[0]) & (frequencies < band[1])].sum(axis = 1)
+                                     for band in bands]).reshape(len(spectra), len(bands))
+
+    return peak_frequencies, centroids, band_energies
+
+
+
+
+def day_features(catalogue_file, event_directory, events, event_ids, stations, FFT_window_length,
+                 sampling_rate, bands, pre_post_time):
+
+    '''
+    Process pool worker calculating the features of a day's events (see
+    the module description). The windows of every station waveform of
+    every event are transformed together in one rFFT call. Waveforms
+    at other sampling rates are skipped.
+
+    Returns a dictionary of the day's columns.
+    '''
+
+    window_samples = int(round(FFT_window_length * sampling_rate))
+    frequencies = feature_frequencies(FFT_window_length, sampling_rate)
+
+    catalogue = None
+
+    if any([event_id is not None for event_id in event_ids]):
+
+        catalogue = open_catalogue(catalogue_file)
+
+    rows = []
+    windows = []
+
+    for event, event_id in zip(events, event_ids):
+
+        try:
+
+            stream, triggers = load_event_data(catalogue, event_directory, event, event_id, pre_post_time)
+
+        except Exception as error:
+
+            print('Could not load event ' + event + ' (' + str(error) + ')')
+            continue
+
+        station_triggers = dict([(trigger[0], trigger[1:3]) for trigger in triggers])
+        found = set()
+
+        for trace in stream:
+
+            station = trace.stats.station
+
+            if (station not in stations) or (station not in station_triggers) or (station in found): continue
+            if trace.stats.sampling_rate != sampling_rate: continue
+
+            found.add(station)
+
+            num_windows = trace.stats.npts // window_samples
+
+            if num_windows == 0: continue
+
+            rows.append([event[:-6], -1 if event_id is None else event_id, station] + station_triggers[station] +
+                        [trace.stats.starttime.timestamp, num_windows])
+            windows.append(np.asarray(trace.data[:num_windows * window_samples], dtype = np.float64)
+                           .reshape(num_windows, window_samples))
+
+    if catalogue is not None:
+
+        catalogue.close()
+
+    if len(rows) == 0:
+
+        return empty_columns(len(frequencies), len(bands))
+
+    window_counts = np.array([row[6] for row in rows])
+    window_offsets = np.concatenate([[0], np.cumsum(window_counts)])
+
+    spectrogram = np.absolute(np.fft.rfft(detrend_windows(np.concatenate(windows)), axis = 1).real[:, 1:])
+
+    # Window start times, and the windows overlapping each station's trigger
+
+    window_times = np.concatenate([row[5] + np.arange(row[6]) * FFT_window_length for row in rows])
+
+    row_index = np.repeat(np.arange(len(rows)), window_counts)
+    on_times = np.array([row[3] for row in rows])
+    off_times = np.array([row[4] for row in rows])
+
+    triggered = (window_times < off_times[row_index]) & (window_times + FFT_window_length > on_times[row_index])
+
+    triggered_counts = np.bincount(row_index[triggered], minlength = len(rows))
+    spectra = np.zeros((len(rows), len(frequencies)))
+    np.add.at(spectra, row_index[triggered], spectrogram[triggered])
+
+    with np.errstate(divide = 'ignore', invalid = 'ignore'):
+
+        spectra /= triggered_counts[:, np.newaxis]
+
+    peak_frequencies, centroids, band_energies = spectral_features(spectra, frequencies, bands)
+
+    # Rows without triggered windows have no features
+
+    untriggered = triggered_counts == 0
+
+    peak_frequencies[untriggered] = np.nan
+    centroids[untriggered] = np.nan
+    band_energies[untriggered] = np.nan
+
+    return {'event': np.array([row[0] for row in rows], dtype = ROW_COLUMNS['event']),
+            'event_id': np.array([row[1] for row in rows], dtype = np.int64),
+            'station': np.array([row[2] for row in rows], dtype = ROW_COLUMNS['station']),
+            'on_time': on_times,
+            'off_time': off_times,
+            'duration': off_times - on_times,
+            'peak_frequency': peak_frequencies,
+            'centroid': centroids,
+            'band_energies': band_energies,
+            'spectrum': spectra.astype(np.float32),
+            'window_start': window_offsets[:-1],
+            'window_count': window_counts.astype(np.int64),
+            'window_times': window_times,
+            'spectrogram': spectrogram.astype(np.float32)}
+
+
+
+
+def empty_columns(num_frequencies, num_bands):
+
+    '''
+    Feature store columns without any rows.
+    '''
+
+    columns = dict([(name, np.zeros(0, dtype = dtype)) for name, dtype in ROW_COLUMNS.items()])
+    columns.update(dict([(name, np.zeros(0, dtype = dtype)) for name, dtype in WINDOW_COLUMNS.items()]))
+
+    columns['band_energies'] = np.zeros((0, num_bands))
+    columns['spectrum'] = np.zeros((0, num_frequencies), dtype = np.float32)
+    columns['spectrogram'] = np.zeros((0, num_frequencies), dtype = np.float32)
+
+    return columns
+
+
+
+
+def concatenate_columns(column_sets):
+
+    '''
+    Join feature store columns, offsetting window positions so rows still
+    point at their own spectrogram windows.
+    '''
+
+    columns = {}
+    window_total = 0
+    window_starts = []
+
+    for column_set in column_sets:
+
+        window_starts.append(column_set['window_start'] + window_total)
+        window_total += len(column_set['window_times'])
+
+    for name in column_sets[0]:
+
+        columns[name] = np.concatenate([column_set[name] for column_set in column_sets])
+
+    columns['window_start'] = np.concatenate(window_starts).astype(np.int64)
+
+    return columns
+
+
+
+
+def segment_directory(store_directory, segment):
+
+    '''
+    Directory of a feature store segment's columns.
+    '''
+
+    return store_directory + segment + '/'
+
+
+
+
+def load_features(store_directory):
+
+    '''
+    Load a feature store: a dictionary of its header (parameters,
+    frequencies and segments), each segment's columns (memory-mapped
+    read-only) and the row columns of all segments joined, with the
+    segment of each row (window positions are within its segment).
+    '''
+
+    with open(store_directory + 'features.json', 'r') as openfile:
+        header = json.load(openfile)
+
+    segments = []
+
+    for segment in header['segments']:
+
+        segments.append(dict([(name, np.load(segment_directory(store_directory, segment) + name + '.npy',
+                                             mmap_mode = 'r'))
+                              for name in list(ROW_COLUMNS) + list(WINDOW_COLUMNS)]))
+
+    if len(segments) == 1:
+
+        columns = dict([(name, segments[0][name]) for name in ROW_COLUMNS])
+
+    else:
+
+        columns = dict([(name, np.concatenate([segment[name] for segment in segments]))
+                        for name in ROW_COLUMNS])
+
+    columns['segment'] = np.repeat(np.arange(len(segments)), [len(segment['event']) for segment in segments])
+
+    return {'header': header, 'segments': segments, 'columns': columns}
+
+
+
+
+def save_segment(store_directory, segment, columns):
+
+    '''
+    Write the columns of a new feature store segment, through a .part
+    directory so a segment only appears once complete.
+    '''
+
+    directory = segment_directory(store_directory, segment)
+
+    # Remove what an interrupted update left behind
+
+    for leftover in [directory[:-1] + '.part', directory[:-1]]:
+
+        if os.path.exists(leftover):
+
+            shutil.rmtree(leftover)
+
+    os.makedirs(directory[:-1] + '.part')
+
+    for name, values in columns.items():
+
+        np.save(directory[:-1] + '.part/' + name + '.npy', values)
+
+    os.replace(directory[:-1] + '.part', directory[:-1])
+
+
+
+
+def save_header(store_directory, header):
+
+    '''
+    Write a feature store's header, through a .part file, which adds its
+    segments to the store.
+    '''
+
+    with open(store_directory + 'features.json.part', 'w') as openfile:
+        json.dump(header, openfile, indent = 1)
+
+    os.replace(store_directory + 'features.json.part', store_directory + 'features.json')
+
+
+
+
+def feature_store(event_directory, events, event_ids, stations, FFT_window_length = 1, sampling_rate = 250,
+                  bands = None, pre_post_time = 10, catalogue_file = None,
+                  max_workers = None, retries = 1):
+
+    '''
+    Load the feature store of events (event file names, with catalogue ids
+    or None for events only in event files) in event_directory, first
+    calculating the features of any events not yet in the store. Events
+    are processed a day per task, in parallel, and the new events' rows
+    (in event and station order) are appended to the store as one segment.
+
+    Stores are kept in event_directory, one per set of feature parameters
+    (see feature_key); bands default to DEFAULT_BANDS. Event names in the
+    store drop the .MSEED extension. Returns the store as from
+    load_features.
+    '''
+
+    if bands is None:
+
+        bands = DEFAULT_BANDS
+
+    store_directory = event_directory + 'event_features_' + \
+                      feature_key(stations, FFT_window_length, sampling_rate, bands, pre_post_time) + '/'
+
+    header = {'stations': stations, 'FFT_window_length': FFT_window_length, 'sampling_rate': sampling_rate,
+              'bands': bands, 'pre_post_time': pre_post_time,
+              'frequencies': feature_frequencies(FFT_window_length, sampling_rate).tolist(),
+              'segments': [], 'num_rows': 0}
+
+    stored_events = set()
+
+    if os.path.exists(store_directory + 'features.json'):
+
+        store = load_features(store_directory)
+        header = store['header']
+        stored_events = set(np.unique(store['columns']['event']).tolist())
+
+    new_events = [[event, event_id] for event, event_id in zip(events, event_ids) if event[:-6] not in stored_events]
+
+    if (len(new_events) == 0) and (len(header['segments']) > 0):
+
+        return store
+
+    # Events without station waveforms leave no rows, and are recalculated next time
+
+    new_events.sort()
+
+    tasks = []
+
+    for day, day_events in itertools.groupby(new_events, key = lambda new_event: new_event[0][:10]):
+
+        day_events = list(day_events)
+
+        tasks.append({'key': day, 'size': len(day_events),
+                      'args': (catalogue_file, event_directory, [event for event, event_id in day_events],
+                               [event_id for event, event_id in day_events], stations, FFT_window_length,
+                               sampling_rate, bands, pre_post_time)})
+
+    print('Calculating features of ' + str(len(new_events)) + ' events on ' + str(len(tasks)) + ' days')
+
+    results, failed = run_tasks(tasks, day_features, max_workers = max_workers, retries = retries)
+
+    for day in failed:
+
+        print('Failed to calculate features of events on ' + day)
+
+    column_sets = [results[day] for day in sorted(results)]
+
+    columns = concatenate_columns(column_sets) if len(column_sets) > 0 else \
+              empty_columns(len(header['frequencies']), len(bands))
+
+    # Keep each segment's rows in event and station order
+
+    order = np.lexsort([columns['station'], columns['event']])
+    columns = reorder_rows(columns, order)
+
+    # A new store gets its first (possibly empty) segment; later segments
+    # are only added for new rows
+
+    if (len(columns['event']) > 0) or (len(header['segments']) == 0):
+
+        segment = 'segment_{:06d}'.format(len(header['segments']))
+
+        save_segment(store_directory, segment, columns)
+
+        header = dict(header, segments = header['segments'] + [segment],
+                      num_rows = header['num_rows'] + len(columns['event']))
+
+        save_header(store_directory, header)
+
+    return load_features(store_directory)
+
+
+
+
+def reorder_rows(columns, order):
+
+    '''
+    Reorder the rows of feature store columns, keeping their spectrogram
+    windows in row order.
+    '''
+
+    window_columns = dict([(name, columns[name]) for name in WINDOW_COLUMNS])
+
+    columns = dict([(name, np.asarray(columns[name])[order]) for name in ROW_COLUMNS])
+
+    window_index = np.concatenate([np.arange(start, start + count) for start, count in
+                                   zip(columns['window_start'], columns['window_count'])] + [np.zeros(0, dtype = np.int64)])
+
+    for name, values in window_columns.items():
+
+        columns[name] = np.asarray(values)[window_index]
+
+    columns['window_start'] = np.concatenate([[0], np.cumsum(columns['window_count'])[:-1]]).astype(np.int64) \
+                              if len(order) > 0 else np.zeros(0, dtype = np.int64)
+
+    return columns
+
+
+
+
+def query_features(store, starttime = None, endtime = None, stations = None, events = None):
+
+    '''
+    Indices of the rows of a feature store with trigger on times between
+    starttime and endtime (POSIX seconds or UTCDateTimes, either may be
+    None), optionally of the given stations and events (names with or
+    without .MSEED).
+    '''
+
+    columns = store['columns']
+    selected = np.ones(len(columns['event']), dtype = bool)
+
+    if starttime is not None:
+
+        selected &= columns['on_time'] >= float(obspy.UTCDateTime(starttime).timestamp)
+
+    if endtime is not None:
+
+        selected &= columns['on_time'] <= float(obspy.UTCDateTime(endtime).timestamp)
+
+    if stations is not None:
+
+        selected &= np.isin(columns['station'], stations)
+
+    if events is not None:
+
+        selected &= np.isin(columns['event'], [event.replace('.MSEED', '') for event in events])
+
+    return np.flatnonzero(selected)
+
+
+
+
+def row_spectrogram(store, row):
+
+    '''
+    Window start times (POSIX seconds) and spectrogram (windows x
+    frequencies) of one feature store row.
+    '''
+
+    columns = store['columns']
+    segment = store['segments'][columns['segment'][row]]
+
+    start = int(columns['window_start'][row])
+    end = start + int(columns['window_count'][row])
+
+    return segment['window_times'][start : end], segment['spectrogram'][start : end]
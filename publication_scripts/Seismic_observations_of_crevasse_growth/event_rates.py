@@ -0,0 +1,161 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+Event rates from event catalogues as array operations: event times are
+parsed from event file names (e.g. 2016-05-01T12:00:00.500000Z.MSEED) into
+integer microseconds in one go, declustered from the differences between
+successive times, and binned into hourly or daily counts with np.bincount.
+"""
+
+import numpy as np
+
+MICROSECONDS_PER_HOUR = 3600 * 10**6
+MICROSECONDS_PER_DAY = 24 * MICROSECONDS_PER_HOUR
+
+# Character positions of the date and time fields in event names
+# (YYYY-MM-DDTHH:MM:SS.ffffff)
+
+NAME_LENGTH = 26
+NAME_DIGITS = [0, 1, 2, 3, 5, 6, 8, 9, 11, 12, 14, 15, 17, 18, 20, 21, 22, 23, 24, 25]
+NAME_SEPARATORS = {4 : '-', 7 : '-', 10 : 'T', 13 : ':', 16 : ':', 19 : '.'}
+
+
+
+
+def name_field(digits, first, last):
+
+    '''
+    Integer value of the digit columns first to last (inclusive) of the
+    event name characters.
+    '''
+
+    value = np.zeros(len(digits), dtype = np.int64)
+
+    for column in range(first, last + 1):
+
+        value *= 10
+        value += digits[:, column]
+
+    return value
+
+
+
+
+def event_name_times(event_names):
+
+    '''
+    Parse the on times of event names (starting YYYY-MM-DDTHH:MM:SS.ffffff)
+    into microseconds since 1970-01-01. Names are parsed together as a
+    character array, so no per-name date parsing is done.
+
+    Returns the times (int64) and a mask of the names that parsed (times of
+    other names are 0).
+    '''
+
+    names = np.asarray(event_names, dtype = 'U' + str(NAME_LENGTH))
+
+    if len(names) == 0:
+
+        return np.zeros(0, dtype = np.int64), np.zeros(0, dtype = bool)
+
+    characters = names.reshape(-1, 1).view(np.uint32).reshape(len(names), NAME_LENGTH)
+
+    # Characters below '0' wrap round to large unsigned values
+
+    digits = characters - np.uint32(ord('0'))
+
+    valid = np.all(digits[:, NAME_DIGITS] <= 9, axis = 1)
+
+    for column, separator in NAME_SEPARATORS.items():
+
+        valid &= characters[:, column] == ord(separator)
+
+    digits = np.where(valid[:, None], digits, 0)
+
+    years = name_field(digits, 0, 3)
+    months = name_field(digits, 5, 6)
+    days = name_field(digits, 8, 9)
+
+    valid &= (years >= 1970) & (months >= 1) & (months <= 12) & (days >= 1) & (days <= 31)
+
+    # Days since 1970 from the year and month starts
+
+    month_starts = ((np.where(valid, years, 1970) - 1970) * 12 + np.where(valid, months, 1) - 1).astype('datetime64[M]')
+    dates = month_starts.astype('datetime64[D]').astype(np.int64) + days - 1
+
+    times = dates * MICROSECONDS_PER_DAY + \
+            name_field(digits, 11, 12) * MICROSECONDS_PER_HOUR + \
+            name_field(digits, 14, 15) * 60 * 10**6 + \
+            name_field(digits, 17, 18) * 10**6 + \
+            name_field(digits, 20, 25)
+
+    return np.where(valid, times, 0), valid
+
+
+
+
+def decluster(times, delay_time):
+
+    '''
+    Mask of events to keep when successive events are removed: an event is
+    removed when it starts within delay_time (seconds) of the previous
+    event, whether or not that event was itself removed, so a run of closely
+    spaced events is counted once. times are sorted microseconds.
+    '''
+
+    times = np.asarray(times, dtype = np.int64)
+
+    keep = np.ones(len(times), dtype = bool)
+    keep[1:] = np.diff(times) > int(round(delay_time * 10**6))
+
+    return keep
+
+
+
+
+def day_of_year(times):
+
+    '''
+    Days of the year (1 on 1 January) and years of times (microseconds).
+    '''
+
+    dates = (np.asarray(times, dtype = np.int64) // MICROSECONDS_PER_DAY).astype('datetime64[D]')
+    year_starts = dates.astype('datetime64[Y]')
+
+    days_of_year = (dates - year_starts.astype('datetime64[D]')).astype(np.int64) + 1
+
+    return days_of_year, year_starts.astype(np.int64) + 1970
+
+
+
+
+def hour_ending(times):
+
+    '''
+    Hour of the day (0 to 24) ending the hour each time falls in, as used
+    for hourly event counts: events from 12:00 (exclusive) to 13:00
+    (inclusive) fall in hour 13.
+    '''
+
+    time_of_day = np.asarray(times, dtype = np.int64) % MICROSECONDS_PER_DAY
+
+    return -(-time_of_day // MICROSECONDS_PER_HOUR)
+
+
+
+
+def binned_counts(times, start_time, end_time, bin_width = MICROSECONDS_PER_HOUR):
+
+    '''
+    Number of times in each bin of bin_width microseconds from start_time
+    (inclusive) to end_time (exclusive), e.g. hourly or daily event counts.
+    '''
+
+    times = np.asarray(times, dtype = np.int64)
+
+    num_bins = int(-(-(end_time - start_time) // bin_width))
+
+    bins = (times - start_time) // bin_width
+    bins = bins[(times >= start_time) & (times < end_time)]
+
+    return np.bincount(bins, minlength = num_bins)[:num_bins]
@@ -0,0 +1,336 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+Event-local trigger refinement: station trigger times of detected events
+are redefined from spectrograms at a higher temporal resolution (and
+hence lower frequency resolution) than the detection spectrograms.
+
+Only each event's own padded waveforms are read (from the event catalogue
+or event files), the short FFT windows of all of a day's events are
+transformed in one batched rFFT call, and band energies for all windows
+come from one cumulative sum, so no day-long streams are re-read and no
+spectra are written to disk.
+"""
+
+import obspy
+import numpy as np
+
+from detection_engine import band_energy_sets
+from event_catalogue import open_catalogue, read_waveform
+from spectrum_store import detrend_windows
+
+
+
+
+def event_segments(event_stream, stations, trim_time):
+
+    '''
+    Take the first trace of each station in stations from an event stream
+    and trim trim_time seconds from both ends (to the nearest sample, as
+    obspy's trim does). Returns a list of [station, start time (POSIX
+    seconds), sampling rate, data].
+    '''
+
+    segments = []
+    found = set()
+
+    for trace in event_stream:
+
+        station = trace.stats.station
+
+        if (station not in stations) or (station in found): continue
+
+        found.add(station)
+
+        sampling_rate = trace.stats.sampling_rate
+        trim_samples = int(round(trim_time * sampling_rate))
+
+        data = np.asarray(trace.data, dtype = np.float64)[max(trim_samples, 0) : len(trace.data) - max(trim_samples, 0)]
+
+        segments.append([station, trace.stats.starttime.timestamp + trim_samples / sampling_rate,
+                         sampling_rate, data])
+
+    return segments
+
+
+
+
+def segment_band_energies(segments, FFT_window_length, signal_bands, signal_band_weights,
+                          noise_bands, noise_band_weights):
+
+    '''
+    Calculate signal and noise band energies (see
+    detection_engine.band_energies) of the consecutive, non-overlapping
+    FFT windows of many waveform segments (see event_segments). The
+    windows of all segments are detrended and transformed together in one
+    rFFT call; as for the detection spectra the absolute real spectrum is
+    used without its first frequency entry.
+
+    Returns, for each segment, the window start times and the signal and
+    noise band energy of each window.
+    '''
+
+    window_counts = []
+    windows = []
+
+    for station, start_time, sampling_rate, data in segments:
+
+        window_samples = int(round(FFT_window_length * sampling_rate))
+        num_windows = len(data) // window_samples
+
+        window_counts.append(num_windows)
+        windows.append(data[:num_windows * window_samples].reshape(num_windows, window_samples))
+
+    # Windows of different lengths (sampling rates) are transformed in groups
+
+    window_lengths = [window.shape[1] for window in windows]
+    energies = [None] * len(segments)
+
+    for window_samples in sorted(set(window_lengths)):
+
+        members = [s for s in range(len(segments)) if window_lengths[s] == window_samples]
+
+        group_windows = np.concatenate([windows[s] for s in members])
+
+        if len(group_windows) == 0: continue
+
+        spectra = np.absolute(np.fft.rfft(detrend_windows(group_windows), axis = 1).real[:, 1:])
+
+        group_energies = band_energy_sets(spectra, [signal_bands, noise_bands],
+                                          [signal_band_weights, noise_band_weights])
+
+        offsets = np.cumsum([0] + [window_counts[s] for s in members])
+
+        for m in range(len(members)):
+
+            energies[members[m]] = group_energies[:, offsets[m] : offsets[m + 1]]
+
+    results = []
+
+    for s in range(len(segments)):
+
+        station, start_time, sampling_rate, data = segments[s]
+
+        times = start_time + np.arange(window_counts[s]) * window_lengths[s] / sampling_rate
+
+        if energies[s] is None:
+
+            energies[s] = np.zeros((2, 0))
+
+        results.append([times, energies[s][0], energies[s][1]])
+
+    return results
+
+
+
+
+def refine_triggers(signal, noise, trigger_threshold, trigger_dethreshold, trigger_overload = np.inf,
+                    signal_samples = 1, noise_samples = 1):
+
+    '''
+    Generate re-triggers from the signal and noise band energies of
+    successive windows of an event's waveform.
+
+    Signal values (summed over signal_samples windows) are compared to the
+    previous signal value (the first to the noise of the first
+    noise_samples windows) until the band ratio reaches trigger_threshold;
+    the trigger starts one window earlier. Later values are compared to
+    the noise at triggering until the band ratio drops below
+    trigger_dethreshold or the data ends. Scanning then restarts after
+    the trigger's first window, relative to the noise there, so triggers
+    may overlap.
+
+    Returns the band ratio of each window (0 for windows not compared) and
+    a list of trigger [on index, off index].
+    '''
+
+    num_windows = len(signal)
+
+    # Sum signal values over signal_samples windows (fewer at the end)
+
+    cumulative = np.concatenate([[0], np.cumsum(signal)])
+    window_ends = np.minimum(np.arange(num_windows) + signal_samples, num_windows)
+
+    signal = (cumulative[window_ends] - cumulative[:num_windows]).tolist()
+    noise = np.asarray(noise, dtype = np.float64).tolist()
+
+    ratios = [0.0] * num_windows
+    triggers = []
+
+    if num_windows <= noise_samples:
+
+        return np.array(ratios), triggers
+
+    def noise_at(j):
+
+        return sum([noise[j - n] for n in range(noise_samples)])
+
+    def band_ratio(signal_value, noise_value):
+
+        # Zero noise gives infinite (or undefined) ratios, as numpy division would
+
+        if noise_value == 0:
+
+            return np.inf if signal_value > 0 else np.nan
+
+        return signal_value / noise_value
+
+    noise_value = noise_at(noise_samples - 1)
+    trigger_on = False
+    j = noise_samples - 1
+
+    while j < num_windows - 1:
+
+        j += 1
+
+        signal_value = signal[j]
+        ratio = band_ratio(signal_value, noise_value)
+        ratios[j] = ratio
+
+        if (trigger_on == False) and (trigger_overload > ratio >= trigger_threshold):
+
+            trigger_on = True
+            on_index = j - 1
+
+        elif (trigger_on == True) and ((ratio < trigger_dethreshold) or (j == num_windows - 1)):
+
+            # Save the trigger and rescan from after its first window
+
+            trigger_on = False
+            triggers.append([on_index, j])
+
+            j = on_index + 1
+            noise_value = noise_at(j)
+
+        elif trigger_on == False:
+
+            noise_value = signal_value
+
+    return np.array(ratios), triggers
+
+
+
+
+def onset_trigger(ratios, triggers):
+
+    '''
+    Choose the trigger defining a station's onset: of the triggers
+    containing the window with the greatest band ratio, the one ending
+    first (then starting first). Returns None if there is none.
+    '''
+
+    if (len(triggers) == 0) or np.all(np.isnan(ratios)):
+
+        return None
+
+    max_index = np.nanargmax(ratios)
+
+    containing = [trigger for trigger in triggers if trigger[0] <= max_index <= trigger[1]]
+
+    if len(containing) == 0:
+
+        return None
+
+    return min(containing, key = lambda trigger: (trigger[1], trigger[0]))
+
+
+
+
+def refine_events(event_streams, stations, pre_post_time, old_FFT_window, FFT_window_length,
+                  signal_bands, signal_band_weights, noise_bands, noise_band_weights,
+                  trigger_threshold, trigger_dethreshold, trigger_overload = np.inf,
+                  signal_samples = 1, noise_samples = 1):
+
+    '''
+    Refine the station trigger times of events from their waveforms (one
+    stream per event, cut with pre_post_time seconds either side of the
+    detection triggers). Waveforms are trimmed to within old_FFT_window
+    seconds (the detection FFT window length) of the detection triggers
+    and the band energies of all events are calculated together.
+
+    Returns, for each event, a list of refined triggers [station, on time,
+    off time] (POSIX seconds, window start times) in station order.
+    '''
+
+    segments = []
+    segment_events = []
+
+    for e in range(len(event_streams)):
+
+        station_segments = event_segments(event_streams[e], stations, pre_post_time - old_FFT_window)
+
+        segments += station_segments
+        segment_events += [e] * len(station_segments)
+
+    energies = segment_band_energies(segments, FFT_window_length, signal_bands, signal_band_weights,
+                                     noise_bands, noise_band_weights)
+
+    event_triggers = [[] for e in range(len(event_streams))]
+
+    for s in range(len(segments)):
+
+        times, signal, noise = energies[s]
+
+        ratios, triggers = refine_triggers(signal, noise, trigger_threshold, trigger_dethreshold,
+                                           trigger_overload, signal_samples, noise_samples)
+
+        trigger = onset_trigger(ratios, triggers)
+
+        if trigger is not None:
+
+            event_triggers[segment_events[s]].append([segments[s][0], times[trigger[0]], times[trigger[1]]])
+
+    for triggers in event_triggers:
+
+        triggers.sort(key = lambda trigger: stations.index(trigger[0]))
+
+    return event_triggers
+
+
+
+
+def refine_day_events(catalogue_file, event_directory, events, event_ids, stations, pre_post_time,
+                      old_FFT_window, FFT_window_length, signal_bands, signal_band_weights,
+                      noise_bands, noise_band_weights, trigger_threshold, trigger_dethreshold,
+                      trigger_overload = np.inf, signal_samples = 1, noise_samples = 1):
+
+    '''
+    Process pool worker refining one day's events (see refine_events).
+    Events with an id (not None) are read from the event catalogue,
+    others from their .MSEED files in event_directory. Events that cannot
+    be read get no refined triggers.
+    '''
+
+    catalogue = None
+
+    if any([event_id is not None for event_id in event_ids]):
+
+        catalogue = open_catalogue(catalogue_file)
+
+    event_streams = []
+
+    for event, event_id in zip(events, event_ids):
+
+        try:
+
+            if event_id is not None:
+
+                event_streams.append(read_waveform(catalogue, event_id))
+
+            else:
+
+                event_streams.append(obspy.read(event_directory + event))
+
+        except Exception as error:
+
+            print('Could not read event ' + event + ' (' + str(error) + ')')
+            event_streams.append(obspy.Stream())
+
+    if catalogue is not None:
+
+        catalogue.close()
+
+    return refine_events(event_streams, stations, pre_post_time, old_FFT_window, FFT_window_length,
+                         signal_bands, signal_band_weights, noise_bands, noise_band_weights,
+                         trigger_threshold, trigger_dethreshold, trigger_overload,
+                         signal_samples, noise_samples)
@@ -0,0 +1,351 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+Environmental forcing store: rainfall is parsed once onto an hourly index,
+and lake level and GNSS position and velocity samples are parsed once and
+kept at their own sample times. Each is cached as a .npy array keyed on
+the source files (path, size and modification time). Cached stores are
+memory-mapped read-only and any time window is served by slicing, so
+repeated statistics and model runs do no text parsing.
+
+Hours are hour-ending, as for the hourly event counts in
+trigger_statistics_vel: rainfall observed over the hour to 13:00 is
+stored at hour 13. Samples are windowed with the environmental_data window
+functions, as trigger_statistics_vel's GPS_parse and lake_level use them.
+"""
+
+import glob
+import hashlib
+import json
+import os
+
+import numpy as np
+
+from environmental_data import MATLAB_EPOCH, read_fixed_width, read_lake_levels
+
+
+
+
+def matlab_hours(matlab_days):
+
+    '''
+    Hours since 1970-01-01 of MATLAB datenums (in days) of hourly samples.
+    '''
+
+    return np.round((np.asarray(matlab_days, dtype = np.float64) - MATLAB_EPOCH) * 24).astype(np.int64)
+
+
+
+
+def read_matlab_values(matlab_file):
+
+    '''
+    All values of a file written by MATLAB's save -ascii (with or without
+    -tabs), in file order.
+    '''
+
+    with open(matlab_file, 'r') as openfile:
+
+        return np.array(openfile.read().split(), dtype = np.float64)
+
+
+
+
+def read_rainfall(rainfall_times, rainfall_data):
+
+    '''
+    Read hourly rainfall (mm) and its times (MATLAB datenums, one per hour).
+    Returns the hours (since 1970-01-01) and the rainfall in each hour.
+    '''
+
+    hours = matlab_hours(read_matlab_values(rainfall_times))
+    rainfall = read_matlab_values(rainfall_data)
+
+    num_hours = min(len(hours), len(rainfall))
+
+    return hours[:num_hours], rainfall[:num_hours]
+
+
+
+
+def source_signatures(sources):
+
+    '''
+    Path, size and modification time of every source file, keyed on the
+    series name prefix the file is stored under.
+    '''
+
+    signatures = {}
+
+    for name, files in sources.items():
+
+        if isinstance(files, str):
+
+            files = [files]
+
+        signatures[name] = [[os.path.abspath(f), os.path.getsize(f), os.path.getmtime(f)] for f in files]
+
+    return signatures
+
+
+
+
+def store_key(signatures):
+
+    '''
+    Key identifying a store: a hash of the source file signatures.
+    '''
+
+    return hashlib.sha1(json.dumps(signatures, sort_keys = True).encode()).hexdigest()[:16]
+
+
+
+
+def ingest_sources(rainfall = None):
+
+    '''
+    Parse the sources and put every series on one hourly index. Returns the
+    first hour (since 1970-01-01), the series names and an array of the
+    series with shape (series, hours).
+    '''
+
+    names = []
+    hourly_sources = [] # (hours, values)
+
+    if rainfall is not None:
+
+        hours, values = read_rainfall(rainfall[0], rainfall[1])
+        names.append('rainfall')
+        hourly_sources.append((hours, values))
+
+    all_hours = [hours for hours, values in hourly_sources if len(hours) > 0]
+
+    if len(all_hours) == 0:
+
+        return 0, names, np.zeros((len(names), 0))
+
+    first_hour = min([int(hours.min()) for hours in all_hours])
+    num_hours = max([int(hours.max()) for hours in all_hours]) - first_hour + 1
+
+    series = np.full((len(names), num_hours), np.nan)
+
+    for i in range(len(hourly_sources)):
+
+        # One value per hour: the last value given for each hour is kept
+
+        hours, values = hourly_sources[i]
+        series[i, hours - first_hour] = values
+
+    return first_hour, names, series
+
+
+
+
+def ingest_samples(lake_level = None, gnss_positions = None, gnss_velocities = None):
+
+    '''
+    Parse the sources that are kept at their own sample times. Returns a
+    dictionary of the samples of each series (rows of MATLAB time in
+    seconds, then the series' values), keyed on name: 'lake_level',
+    'gnss_positions_0', 'gnss_positions_1', ... and 'gnss_velocities_0',
+    ... in the order of the files given.
+    '''
+
+    samples = {}
+
+    if lake_level is not None:
+
+        samples['lake_level'] = read_lake_levels(lake_level)
+
+    for g in range(len(gnss_positions or [])):
+
+        samples['gnss_positions_' + str(g)] = read_fixed_width(gnss_positions[g], [0, 1, 2, 3])
+
+    for g in range(len(gnss_velocities or [])):
+
+        samples['gnss_velocities_' + str(g)] = np.atleast_2d(np.loadtxt(gnss_velocities[g]))
+
+    return samples
+
+
+
+
+def remove_stale_stores(store_directory, signatures, key):
+
+    '''
+    Remove stores in store_directory built from the same source files as
+    the store with the given key, but from older versions of them.
+    '''
+
+    paths = dict([(name, [f[0] for f in files]) for name, files in signatures.items()])
+
+    for header_file in glob.glob(os.path.join(store_directory, 'forcing_*.json')):
+
+        if os.path.basename(header_file) == 'forcing_' + key + '.json': continue
+
+        try:
+
+            with open(header_file, 'r') as openfile:
+                sources = json.load(openfile)['sources']
+
+        except (ValueError, KeyError):
+
+            continue
+
+        if dict([(name, [f[0] for f in files]) for name, files in sources.items()]) != paths: continue
+
+        print('Removing stale forcing store ' + os.path.basename(header_file)[8:-5])
+
+        for stale_file in [header_file, header_file[:-5] + '.npy'] + glob.glob(header_file[:-5] + '_*.npy'):
+
+            if os.path.exists(stale_file):
+
+                os.remove(stale_file)
+
+
+
+
+def sample_file(series_file, name):
+
+    '''
+    File the samples of the named series are cached in, alongside the
+    store's hourly series file.
+    '''
+
+    return series_file[:-4] + '_' + name + '.npy'
+
+
+
+
+def forcing_store(store_directory, rainfall = None, lake_level = None, gnss_positions = None,
+                  gnss_velocities = None):
+
+    '''
+    Load (or build and cache in store_directory) the forcing store for the
+    given sources:
+
+    rainfall        -- (rainfall times file, rainfall data file) as read by
+                       trigger_statistics_vel.chosen_rainfall
+    lake_level      -- lake level .csv file (see
+                       environmental_data.read_lake_levels)
+    gnss_positions  -- list of GNSS position files (see
+                       environmental_data.read_gnss_positions)
+    gnss_velocities -- list of GNSS velocity files (see
+                       environmental_data.read_gnss_velocities)
+
+    Returns the store as a dictionary of the first hour (since 1970-01-01),
+    the hourly series keyed on name ('rainfall') and the samples keyed on
+    name (see ingest_samples), as read-only arrays memory-mapped from the
+    cache. A store is rebuilt when any of its source files change, and the
+    store of their previous versions is removed.
+    '''
+
+    sources = {}
+
+    if rainfall is not None: sources['rainfall'] = list(rainfall)
+    if lake_level is not None: sources['lake_level'] = lake_level
+
+    for g in range(len(gnss_positions or [])):
+
+        sources['gnss_positions_' + str(g)] = gnss_positions[g]
+
+    for g in range(len(gnss_velocities or [])):
+
+        sources['gnss_velocities_' + str(g)] = gnss_velocities[g]
+
+    if not os.path.exists(store_directory):
+
+        os.makedirs(store_directory)
+
+    signatures = source_signatures(sources)
+    key = store_key(signatures)
+
+    series_file = os.path.join(store_directory, 'forcing_' + key + '.npy')
+    header_file = os.path.join(store_directory, 'forcing_' + key + '.json')
+
+    if not (os.path.exists(series_file) and os.path.exists(header_file)):
+
+        print('Building forcing store ' + key)
+
+        first_hour, names, series = ingest_sources(rainfall)
+        samples = ingest_samples(lake_level, gnss_positions, gnss_velocities)
+
+        # Write the header last, so a store is only used once complete
+
+        arrays = [(series_file, series)] + [(sample_file(series_file, name), samples[name]) for name in sorted(samples)]
+
+        for array_file, array in arrays:
+
+            with open(array_file + '.part', 'wb') as openfile:
+                np.save(openfile, array)
+
+            os.replace(array_file + '.part', array_file)
+
+        with open(header_file + '.part', 'w') as openfile:
+            json.dump({'first_hour': first_hour, 'names': names, 'samples': sorted(samples),
+                       'sources': signatures}, openfile, indent = 1)
+
+        os.replace(header_file + '.part', header_file)
+
+        remove_stale_stores(store_directory, signatures, key)
+
+    with open(header_file, 'r') as openfile:
+        header = json.load(openfile)
+
+    series = np.load(series_file, mmap_mode = 'r')
+
+    return {'first_hour': header['first_hour'],
+            'series': dict([(header['names'][i], series[i]) for i in range(len(header['names']))]),
+            'samples': dict([(name, np.load(sample_file(series_file, name), mmap_mode = 'r'))
+                             for name in header.get('samples', [])])}
+
+
+
+
+def year_start_hour(year):
+
+    '''
+    Hours since 1970-01-01 at the start of a year.
+    '''
+
+    return 24 * int((np.datetime64(str(year), 'D') - np.datetime64('1970-01-01', 'D')).astype(np.int64))
+
+
+
+
+def forcing_window(store, year, start_date, end_date, names = None):
+
+    '''
+    Slice the hours 00:00 of day of the year start_date to 23:00 of
+    end_date out of a forcing store. Hours outside the store are NaN.
+
+    Returns the decimal days of the year of the hours (day of the year plus
+    the hour as a fraction of the day) and a dictionary of the series
+    named in names (all series if None) over the window.
+    '''
+
+    start_hour = year_start_hour(year) + 24 * (start_date - 1)
+    num_hours = 24 * (end_date - start_date + 1)
+
+    hours = np.arange(start_hour, start_hour + num_hours) - year_start_hour(year)
+    decimal_days = hours // 24 + 1 + (hours % 24) / 24.0
+
+    # Part of the window may be outside the store
+
+    first = start_hour - store['first_hour']
+    store_slice = slice(max(first, 0), max(first + num_hours, 0))
+
+    if names is None:
+
+        names = list(store['series'])
+
+    window = {}
+
+    for name in names:
+
+        values = store['series'][name][store_slice]
+
+        window[name] = np.full(num_hours, np.nan)
+        window[name][store_slice.start - first : store_slice.start - first + len(values)] = values
+
+    return decimal_days, window
@@ -5,222 +5,171 @@ Grid search algorithm that takes arrival time picks from S-files
 and calculates 2D epicentres as the grid cell with lowest L2 residual.
 """
 
-import datetime
-import glob
-import math
+import os
 import numpy as np
 
+from nordic import pick_table
+from travel_time_table import travel_time_table
 
 
 
-def get_arrival_times(S_file):
+
+def generate_tt(xmin, xmax, ymin, ymax, xstep, ystep, velocity, station_positions, cache_directory = None):
     
     '''
-    Parse S-file for P wave arrival times
-    at recording stations.
+    Generate 2D travel time grid. Travel times are loaded from (or saved
+    to) a cached table in cache_directory if one is given, and have shape
+    (rows, columns, stations) like the grid.
     '''
+
+    gridx, gridy = np.meshgrid(np.linspace(xmin, xmax, int(round((xmax - xmin) / xstep + 1))), 
+                               np.linspace(ymin, ymax, int(round((ymax - ymin) / ystep + 1))))
     
-    arrival_time_data = [[], []]
-    with open(S_file) as openfile:
-        
-        r = -1
-        for row in openfile:
-            r += 1
-            
-            # Split row by spaces
-            
-            row_split = row[:-2].split(' ')
-            
-            # Get non-empty columns in the row
-            
-            cols = []
-            for col in row_split:
-                
-                if len(col) != 0:
-                    
-                    cols.append(col)
-                    
-            # Collect data
-                    
-            if r == 0:
-                
-                # Get date
-                
-                year = cols[0]
-                
-                if len(cols[1]) > 2:
-                    
-                    month = cols[1][:-2]
-                    day = cols[1][-2:]
-                    
-                else:
-                    
-                    
-                    month= cols[1]
-                    day = cols[2]
-                
-                if len(month) < 2:
-                    month = '0' + month
-                    
-                if len(day) < 2:
-                    day = '0' + day
-                
-                date = datetime.datetime.strptime(year + '-' + month + '-' + day,
-                                                  '%Y-%m-%d')
-                
-            elif r > 3:
-                
-                if len(cols) == 0:
-                    
-                    continue
-                
-                # Get arrival time data (assume no day increments)
-                
-                station = cols[0][:-2] # Ignore component details
-                
-                seconds = cols[-1]
-                
-                if len(cols[-2]) > 2:
-                    
-                    minutes = cols[-2][-2:]
-                    hours = cols[-2][:-2]
-                    
-                else:
-                    
-                    minutes = cols[-2]
-                    hours = cols[-3]
-                    
-                total_seconds = (int(hours) * 3600 + int(minutes) * 60 + float(seconds))
-                
-                arrival_time_data[0].append(station)
-                arrival_time_data[1].append(total_seconds)
+    # Get travel times from each station to each grid point
+    
+    travel_times = travel_time_table(gridx, gridy, station_positions, velocity,
+                                     cache_directory = cache_directory)[0]
                 
-    return arrival_time_data
-
+    return gridx, gridy, travel_times
+    
 
 
 
-def relative_timing(arrival_time_data):
+def arrival_array(picks, num_events, stations):
     
     '''
-    Make arrival time data relative for all stations.
+    Hold the arrival times in a pick table (see nordic.pick_table) as one
+    array of shape (events, stations), relative to each event's first
+    listed pick, with NaN for stations without a pick. Only the first pick
+    at a station is used. Also returns the index of each event's reference
+    station (that of the first pick), or -1 if it is not in stations.
     '''
     
-    reference_station = arrival_time_data[0][0]
-    reference_arrival_time = arrival_time_data[1][0] 
+    arrival_times = np.full((num_events, len(stations)), np.nan)
+    reference_indices = np.full(num_events, -1, dtype = int)
     
-    relative_arrival_time_data = [[], []]
-    for i in range(len(arrival_time_data[0])):
-        
-        relative_arrival_time_data[0].append(arrival_time_data[0][i])
-        relative_arrival_time_data[1].append(arrival_time_data[1][i] - reference_arrival_time)
+    if len(picks) == 0:
         
-    return relative_arrival_time_data, reference_station
-
-
-
-
-def generate_tt(xmin, xmax, ymin, ymax, xstep, ystep, velocity, station_positions):
+        return arrival_times, reference_indices
     
-    '''
-    Generate 2D travel time grid.
-    '''
-
-    gridx, gridy = np.meshgrid(np.linspace(xmin, xmax, (xmax - xmin) / xstep + 1), 
-                               np.linspace(ymin, ymax, (ymax - ymin) / ystep + 1))
+    # Index of each pick's station in the station list (-1 if not in it)
     
-    # Generate travel times from each station to each grid point
+    names, name_indices = np.unique(picks['station'], return_inverse = True)
+    station_indices = np.array([stations.index(name) if name in stations else -1 for name in names], dtype = int)[name_indices]
     
-    travel_times = [[[] for i in range(len(gridx))] for j in range(len(gridx[0]))]
+    # Make arrival times relative to each event's first pick
     
-    for i in range(len(gridx)):
-        for j in range(len(gridx[i])):
-            
-            x = gridx[i][j]
-            y = gridy[i][j]
-            
-            for station_position in station_positions:
-                
-                distance = calculate_distance(x, y, station_position[0], station_position[1])
-                
-                travel_times[j][i].append(distance / velocity)
-                
-    return gridx, gridy, travel_times
+    picked_events, first_picks = np.unique(picks['event'], return_index = True)
+    reference_indices[picked_events] = station_indices[first_picks]
     
-
-
-
-def calculate_distance(x1, y1, x2, y2):
+    relative_times = picks['time'] - picks['time'][first_picks][np.searchsorted(picked_events, picks['event'])]
     
-    '''
-    Calculate distance between two points in a two-dimensional
-    cartesian coordinate system.
-    '''
+    # Keep the first pick of each event at each station
     
-    distance = math.sqrt((x2 - x1)**2 + (y2 - y1)**2)
+    known = np.where(station_indices >= 0)[0]
     
-    return distance
-
-
-
-
-def relative_travel_time(travel_times, stations):
+    event_stations, first_station_picks = np.unique(picks['event'][known] * len(stations) + station_indices[known],
+                                                    return_index = True)
     
-    '''
-    Make travel times relative to a reference station.
-    '''
-
-    relative_travel_times = [[[[] for i in range(len(gridx))] for j in range(len(gridx[0]))] for k in range(len(stations))]
-
-    for k in range(len(stations)):
-        for j in range(len(travel_times)):
-            for i in range(len(travel_times[j])):
-                for l in range(len(travel_times[j][i])):
-                    
-                    relative_travel_times[k][j][i].append(travel_times[j][i][l] - travel_times[j][i][k])
-            
-    return relative_travel_times
+    arrival_times.flat[event_stations] = relative_times[known[first_station_picks]]
+                
+    return arrival_times, reference_indices
 
 
 
 
-def L2_residual(relative_arrival_times, relative_travel_times, stations):
+def L2_residuals(arrival_times, reference_indices, travel_times, block_size = 32):
     
     '''
-    Calculate L2 residual for data and model output.
+    Calculate the L2 residual between relative arrival times and relative
+    travel times for every grid cell, for a batch of events at once.
+    
+    arrival_times and reference_indices are as returned by arrival_array,
+    travel_times has shape (rows, columns, stations). Stations without a
+    pick (NaN) are masked out of an event's residuals. Events are processed
+    in blocks of block_size, broadcasting each station's arrival times
+    against the travel times of all cells.
+    
+    Returns the residual surfaces, shape (events, rows, columns), NaN for
+    events without a known reference station, and the [row, column] index
+    of each event's minimum residual cell ([-1, -1] if there is none).
     '''
     
-    L2_residual = 0
+    travel_times = np.asarray(travel_times, dtype = np.float64)
+    num_rows, num_columns, num_stations = travel_times.shape
+    
+    # Travel times of all cells to each station, one row per station
+    
+    cell_travel_times = np.ascontiguousarray(travel_times.reshape(-1, num_stations).T)
+    
+    squared_residuals = np.full((len(arrival_times), num_rows * num_columns), np.nan)
+    valid = np.where(reference_indices >= 0)[0]
     
-    for i in range(len(relative_arrival_times[0])):
+    for start in range(0, len(valid), block_size):
         
-        data_station = relative_arrival_times[0][i]
+        block = valid[start : start + block_size]
+        block_residuals = np.zeros((len(block), num_rows * num_columns))
         
-        for j in range(len(relative_travel_times)):
+        # Travel times to each event's reference station
+        
+        reference_travel_times = cell_travel_times[reference_indices[block]]
+        
+        for k in range(num_stations):
             
-            model_station = stations[j]
+            picked = ~np.isnan(arrival_times[block, k])
             
-            if data_station == model_station:
-                
-                # Scale by 1000 before squaring, to avoid square scaling reversals
-                # with > 1, < 1 residuals.
-                
-                L2_residual += (1000000 * (relative_arrival_times[1][i] - relative_travel_times[j])**2)
+            if not np.any(picked): continue
+            
+            # Difference between the relative arrival time and the travel
+            # time relative to the reference station, for every cell
+            
+            differences = arrival_times[block[picked], k][:, np.newaxis] + reference_travel_times[picked] - cell_travel_times[k]
+            
+            block_residuals[picked] += differences**2
+        
+        squared_residuals[block] = block_residuals
+    
+    # Scale by 1000 (1000000 once squared) to avoid square scaling reversals
+    # with > 1, < 1 residuals.
+    
+    residuals = (1000 * np.sqrt(squared_residuals)).reshape(len(arrival_times), num_rows, num_columns)
+    
+    # Find the first minimum residual cell of each event, in row-major order
+    
+    best_cells = np.full((len(arrival_times), 2), -1, dtype = int)
+    
+    if len(valid) > 0:
         
-    return math.sqrt(L2_residual)
+        flat_best = np.argmin(residuals[valid].reshape(len(valid), -1), axis = 1)
+        best_cells[valid, 0], best_cells[valid, 1] = np.unravel_index(flat_best, (num_rows, num_columns))
+    
+    return residuals, best_cells
 
 
 
 
-# Get arrival time data
+# Get arrival time data from all S-files (and concatenated .out files) in
+# the S-file directory, parsed in parallel into one pick table
 
 S_file_dir = '/home/sam/PAPERV2_SEISMIC_3COMP_EVENTS/'
-S_files = glob.glob(S_file_dir + '*.S*')
+S_file_pattern = '*.S*'
+
+events, picks = pick_table([S_file_dir], S_file_pattern)
 
-events = []
-for S_file in S_files:
+# Name events by their S-file, numbering events in files holding several
+
+file_event_counts = {}
+for S_file, n, origin_time in events:
+    file_event_counts[S_file] = file_event_counts.get(S_file, 0) + 1
+
+event_names = []
+for S_file, n, origin_time in events:
+    
+    event_names.append(os.path.basename(S_file))
     
-    events.append(get_arrival_times(S_file))
+    if file_event_counts[S_file] > 1:
+        
+        event_names[-1] += '.' + str(n)
 
 # Define station names and positions (XYZ)
 
@@ -246,55 +195,56 @@ ystep = 0.05
 
 velocity = 1.65
 
+# Directory to cache travel time tables in (None to calculate them each run)
+
+travel_time_directory = '/home/sam/TRAVEL_TIME_TABLES/'
+
 # Calculate travel time grid and travel times
 
 gridx, gridy, travel_times = generate_tt(xmin, xmax, ymin, ymax, xstep, ystep,
-                                         velocity, station_positions)
+                                         velocity, station_positions, travel_time_directory)
 
-# Calculate relative travel times for each station
+## Save each event's residual surface indexed [j][i] to its own
+## S-file_residuals.npy, as well as the stacked surfaces of all events
 
-relative_tt = relative_travel_time(travel_times, stations)
+save_residual_files = False
 
-# Perform grid search
+residual_file = 'grid_search_residuals.npy'
 
-for e in range(len(events)):
-    
-    event = events[e]
-    epicentre_idx = [0, 0]
-    min_residual = 999999
-    L2_residuals = [[[] for i in range(len(gridx))] for j in range(len(gridx[0]))]
-    
-    # Make arrival time relative to a given station
+# Hold the arrival times of all events in one array
 
-    relative_arrival_time_data, reference_station = relative_timing(event)
-    
-    # Find index of reference station in station list
-    
-    reference_station_idx = stations.index(reference_station)
+arrival_times, reference_indices = arrival_array(picks, len(events), stations)
+
+# Perform grid search for all events at once
+
+residuals, best_cells = L2_residuals(arrival_times, reference_indices, travel_times)
+
+for e in range(len(events)):
     
-    # Look through all grid cells
+    S_file_name = event_names[e]
     
-    for i in range(len(gridx)):
+    if reference_indices[e] < 0:
         
-        for j in range(len(gridx[i])):
+        print('No reference station for ' + S_file_name)
+        continue
     
-            # Make travel times relative to the reference station for the grid cell
+    i, j = [int(index) for index in best_cells[e]]
+    min_residual = float(residuals[e, i, j])
+    epicentre_idx = [j, i]
+    epicentre = [float(gridx[i][j]), float(gridy[i][j])]
     
-            relative_travel_times = relative_tt[reference_station_idx][j][i]
-            
-            # Calculate the L2 residual for the grid cell
-    
-            L2_residuals[j][i] = L2_residual(relative_arrival_time_data, relative_travel_times, stations)
-            
-            if L2_residuals[j][i] < min_residual:
-                
-                min_residual = L2_residuals[j][i]
-                epicentre_idx = [j, i] 
-                epicentre = [gridx[i][j], gridy[i][j]]
-                
-    print(S_files[e].split('/')[-1] + ',' + str(min_residual) + ',' + str(epicentre_idx) + ',' + str(epicentre))
-    np.save(S_files[e].split('/')[-1] + '_residuals.npy', L2_residuals)
-            
-            
+    print(S_file_name + ',' + str(min_residual) + ',' + str(epicentre_idx) + ',' + str(epicentre))
     
+    if save_residual_files == True:
+        
+        np.save(S_file_name + '_residuals.npy', residuals[e].T)
+
+# Save the stacked residual surfaces (events, rows, columns), in event order
 
+np.save(residual_file, residuals)
+
+with open(residual_file[:-4] + '.csv', 'w') as openfile:
+    
+    for event_name in event_names:
+        
+        openfile.write(event_name + '\n')
@@ -0,0 +1,425 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+Batch transect and plateau analysis of GRID2D xcorr value grids. All grids
+in a date range are stacked into one memory-mapped (events, rows, columns)
+array, transects along the location uncertainty long axis are sampled from
+the nearest grid cells for many events at once, plateau edges are found
+from their second derivatives with the same criterion as Plot_GRID2D's
+locate_grid, and location densities are counted with np.histogram2d.
+"""
+
+import datetime
+import glob
+import math
+import os
+
+import numpy as np
+
+# Minimum number of transect points inside the grid for a location
+# (as in Plot_GRID2D)
+
+MIN_TRANSECT_POINTS = 7
+
+
+
+
+def event_date(event):
+
+    '''
+    Time of an event from its name (2016-05-01T12:00:00...).
+    '''
+
+    return datetime.datetime.strptime(event[:19], '%Y-%m-%dT%H:%M:%S')
+
+
+
+
+def grid_sources(event_directory, min_date, max_date):
+
+    '''
+    Find the xcorr value grids of events from min_date to max_date
+    (inclusive) in GRID2D's output: stacked daily grids
+    (DAY.xcorrvaluegrids.npy, indexed by DAY.xcorrvaluegrids.csv) and
+    per-event grids (EVENT.xcorrvaluegrid.npy).
+
+    Returns a time-ordered list of [event, grid file, stack index], the stack
+    index being None for per-event grid files.
+    '''
+
+    sources = {}
+
+    for index_file in glob.glob(event_directory + '*.xcorrvaluegrids.csv'):
+
+        day = datetime.datetime.strptime(os.path.basename(index_file)[:10], '%Y-%m-%d')
+
+        if (day > max_date) or (day + datetime.timedelta(days = 1) < min_date): continue
+
+        with open(index_file, 'r') as openfile:
+
+            for row in openfile:
+
+                event, stack_index = row.split(',')[:2]
+
+                if int(stack_index) < 0: continue
+
+                if min_date <= event_date(event) <= max_date:
+
+                    sources[event] = [event, index_file[:-4] + '.npy', int(stack_index)]
+
+    for grid_file in glob.glob(event_directory + '*.xcorrvaluegrid.npy'):
+
+        event = os.path.basename(grid_file)[:-len('.xcorrvaluegrid.npy')] + '.MSEED'
+
+        if (event not in sources) and (min_date <= event_date(event) <= max_date):
+
+            sources[event] = [event, grid_file, None]
+
+    return [sources[event] for event in sorted(sources)]
+
+
+
+
+def stack_grids(sources, stack_file):
+
+    '''
+    Copy the grids of sources (see grid_sources) into one .npy array of
+    shape (events, rows, columns), written through a memory map so the
+    grids are never all held in memory. Grids from the same daily stack
+    are copied together. Returns the stack memory-mapped read-only.
+    '''
+
+    if len(sources) == 0:
+
+        return np.zeros((0, 0, 0))
+
+    first_grid = np.load(sources[0][1], mmap_mode = 'r')
+    grid_shape = first_grid.shape[1:] if sources[0][2] is not None else first_grid.shape
+
+    stack = np.lib.format.open_memmap(stack_file + '.part', mode = 'w+', dtype = np.float64,
+                                      shape = (len(sources),) + tuple(grid_shape))
+
+    # Group events by the file their grid is in
+
+    file_events = {}
+
+    for e in range(len(sources)):
+
+        file_events.setdefault(sources[e][1], []).append(e)
+
+    for grid_file, events in file_events.items():
+
+        grids = np.load(grid_file, mmap_mode = 'r')
+
+        if sources[events[0]][2] is None:
+
+            stack[events[0]] = grids
+
+        else:
+
+            stack[events] = grids[[sources[e][2] for e in events]]
+
+    stack.flush()
+    del stack
+
+    os.replace(stack_file + '.part', stack_file)
+
+    return np.load(stack_file, mmap_mode = 'r')
+
+
+
+
+def grid_maxima(grids):
+
+    '''
+    Row and column of the maximum of each grid. If two values are the same
+    the one farthest from the origin (last in row-major order) is taken,
+    as in Plot_GRID2D.
+    '''
+
+    flat_grids = np.asarray(grids).reshape(len(grids), -1)
+
+    last_max = flat_grids.shape[1] - 1 - np.argmax(flat_grids[:, ::-1], axis = 1)
+
+    return np.unravel_index(last_max, grids.shape[1:])
+
+
+
+
+def nearest_indices(values, coordinates):
+
+    '''
+    Index of the value nearest each coordinate in sorted values, as
+    Plot_GRID2D's takeClosest: ties go to the smaller value and
+    coordinates beyond either end go to the end value.
+    '''
+
+    values = np.asarray(values, dtype = np.float64)
+
+    positions = np.searchsorted(values, coordinates, side = 'left')
+
+    after = np.minimum(positions, len(values) - 1)
+    before = np.maximum(positions - 1, 0)
+
+    return np.where(values[after] - coordinates < coordinates - values[before], after, before)
+
+
+
+
+def sample_transects(grids, xvals, yvals, centre_rows, centre_columns, bearing, step, num_steps):
+
+    '''
+    Sample each grid along a transect through its centre cell as
+    Plot_GRID2D does: points every step km along the bearing (radians
+    from north) either side of the centre, rounded to step km, take the
+    value of the nearest grid cell. Each side runs up to and including its
+    first point outside the grid, and the centre cell is sampled twice
+    (once as the centre and once as the first forward point).
+
+    Returns the transect values, cell E and N coordinates (NaN outside each
+    event's transect) and the cell row and column of every transect point,
+    each of shape (events, 2 * num_steps + 2).
+    '''
+
+    xvals = np.asarray(xvals, dtype = np.float64)
+    yvals = np.asarray(yvals, dtype = np.float64)
+
+    E = xvals[centre_columns][:, np.newaxis]
+    N = yvals[centre_rows][:, np.newaxis]
+
+    # Backward points num_steps..1, the centre, then forward points 0..num_steps,
+    # with positions calculated and rounded as in Plot_GRID2D
+
+    steps = np.concatenate([np.arange(-num_steps, 0), np.arange(0, num_steps + 1)]).astype(np.float64)
+
+    delta_E = math.sin(bearing) * step
+    delta_N = math.cos(bearing) * step
+
+    point_E = np.round((E + steps * delta_E) / step) * step
+    point_N = np.round((N + steps * delta_N) / step) * step
+
+    inside = (xvals[0] <= point_E) & (point_E <= xvals[-1]) & (yvals[0] <= point_N) & (point_N <= yvals[-1])
+
+    # A point is on the transect if the points between it and the centre are
+    # inside the grid (the first point outside is kept, at the edge cell)
+
+    backward = inside[:, num_steps - 1 :: -1]
+    forward = inside[:, num_steps :]
+
+    backward_on = np.ones(backward.shape, dtype = bool)
+    backward_on[:, 1:] = np.cumprod(backward[:, :-1], axis = 1)
+    forward_on = np.ones(forward.shape, dtype = bool)
+    forward_on[:, 1:] = np.cumprod(forward[:, :-1], axis = 1)
+
+    on_transect = np.concatenate([backward_on[:, ::-1], np.ones((len(grids), 1), dtype = bool), forward_on], axis = 1)
+
+    rows = np.concatenate([nearest_indices(yvals, point_N[:, :num_steps]), np.asarray(centre_rows)[:, np.newaxis],
+                           nearest_indices(yvals, point_N[:, num_steps:])], axis = 1)
+    columns = np.concatenate([nearest_indices(xvals, point_E[:, :num_steps]), np.asarray(centre_columns)[:, np.newaxis],
+                              nearest_indices(xvals, point_E[:, num_steps:])], axis = 1)
+
+    values = np.asarray(grids)[np.arange(len(grids))[:, np.newaxis], rows, columns]
+
+    values = np.where(on_transect, values, np.nan)
+    cell_E = np.where(on_transect, xvals[columns], np.nan)
+    cell_N = np.where(on_transect, yvals[rows], np.nan)
+
+    return values, cell_E, cell_N, rows, columns
+
+
+
+
+def second_derivatives(values, cell_E, cell_N):
+
+    '''
+    Absolute second differences of transect values over the mean distance
+    between each point's cell and its neighbours' cells, as in Plot_GRID2D:
+    zero at the ends of each transect and NaN inside runs of points in the
+    same cell (0 / 0) and outside the transect.
+    '''
+
+    distances = np.sqrt(np.diff(cell_E, axis = 1)**2 + np.diff(cell_N, axis = 1)**2)
+
+    second_derivative = np.full(values.shape, np.nan)
+
+    with np.errstate(divide = 'ignore', invalid = 'ignore'):
+
+        second_derivative[:, 1:-1] = np.absolute(values[:, 2:] - 2 * values[:, 1:-1] + values[:, :-2]) / \
+                                     ((distances[:, :-1] + distances[:, 1:]) / 2)
+
+    on_transect = ~np.isnan(values)
+    events = np.arange(len(values))
+
+    second_derivative[events, np.argmax(on_transect, axis = 1)] = 0
+    second_derivative[events, values.shape[1] - 1 - np.argmax(on_transect[:, ::-1], axis = 1)] = 0
+
+    return second_derivative
+
+
+
+
+def plateau_edges(second_derivative, centres):
+
+    '''
+    Find the plateau around the centre of each transect as Plot_GRID2D
+    does: its edges are the maxima of the second derivative (strictly
+    greater than both neighbours) closest to the centre on either side,
+    including the centre itself.
+
+    Returns the transect indices of the left and right edges, -1 where
+    there is no edge on a side or the transect has fewer than
+    MIN_TRANSECT_POINTS points.
+    '''
+
+    num_points = second_derivative.shape[1]
+    indices = np.arange(num_points)
+
+    # Comparisons with NaN (within cells and outside the transect) are False
+
+    maxima = np.zeros(second_derivative.shape, dtype = bool)
+
+    with np.errstate(invalid = 'ignore'):
+
+        maxima[:, 1:-1] = (second_derivative[:, 1:-1] > second_derivative[:, :-2]) & \
+                          (second_derivative[:, 1:-1] > second_derivative[:, 2:])
+
+    left_maxima = maxima & (indices <= centres[:, np.newaxis])
+    right_maxima = maxima & (indices >= centres[:, np.newaxis])
+
+    left = np.where(left_maxima.any(axis = 1), num_points - 1 - np.argmax(left_maxima[:, ::-1], axis = 1), -1)
+    right = np.where(right_maxima.any(axis = 1), np.argmax(right_maxima, axis = 1), -1)
+
+    too_short = np.sum(~np.isnan(second_derivative), axis = 1) < MIN_TRANSECT_POINTS
+
+    left[too_short] = -1
+    right[too_short] = -1
+
+    return left, right
+
+
+
+
+def locate_plateaus(grids, xvals, yvals, bearing, step, chunk_size = 1000):
+
+    '''
+    Locate events from their xcorr value grids (events, rows, columns) on
+    the grid of x (column) and y (row) values, with the same criterion as
+    Plot_GRID2D's locate_grid: each grid is sampled every step km along
+    the bearing (radians from north) through its maximum (see
+    sample_transects), and the plateau around the maximum is bounded by
+    the closest maxima of the transect's second derivative on either side.
+    The location is the cell at the centre of the plateau and the
+    uncertainty half the plateau width (a quarter of the width of the
+    neighbouring points for single point plateaus, located at the
+    maximum). Grids are processed chunk_size events at a time.
+
+    Returns locations (events x [E, N, uncertainty, max value], NaN for
+    events without a plateau or with non-finite grid values) and plateau
+    ends (events x [[E, N], [E, N]]).
+    '''
+
+    xvals = np.asarray(xvals, dtype = np.float64)
+    yvals = np.asarray(yvals, dtype = np.float64)
+
+    # Enough steps to leave the grid from any cell
+
+    num_steps = int(np.ceil(np.hypot(xvals[-1] - xvals[0], yvals[-1] - yvals[0]) / step)) + 2
+
+    locations = np.full((len(grids), 4), np.nan)
+    plateaus = np.full((len(grids), 2, 2), np.nan)
+
+    for start in range(0, len(grids), chunk_size):
+
+        chunk = np.array(grids[start : start + chunk_size], dtype = np.float64)
+        chunk_locations = locations[start : start + chunk_size]
+        chunk_plateaus = plateaus[start : start + chunk_size]
+
+        # Grids with non-finite values (e.g. NaN correlations of flat
+        # envelopes) have no maximum to locate from
+
+        finite = np.isfinite(chunk).all(axis = (1, 2))
+        chunk[~finite] = 0
+
+        rows, columns = grid_maxima(chunk)
+
+        values, cell_E, cell_N, transect_rows, transect_columns = \
+            sample_transects(chunk, xvals, yvals, rows, columns, bearing, step, num_steps)
+
+        # The transect centre is its last point in the maximum's cell
+
+        in_centre = (transect_rows == rows[:, np.newaxis]) & (transect_columns == columns[:, np.newaxis]) & \
+                    ~np.isnan(values)
+        centres = values.shape[1] - 1 - np.argmax(in_centre[:, ::-1], axis = 1)
+
+        left, right = plateau_edges(second_derivatives(values, cell_E, cell_N), centres)
+
+        located = (left >= 0) & (right >= 0) & finite
+
+        events = np.arange(len(chunk))
+        left = np.maximum(left, 1)
+        right = np.maximum(right, 1)
+
+        # Plateau centre and half width, or for single point plateaus the
+        # maximum and a quarter of the width of the points either side. The
+        # centre index is rounded half to even (as Python's round) from the
+        # start of the transect, as Plot_GRID2D indexes its transect list
+
+        first = np.argmax(~np.isnan(values), axis = 1)
+        middle = first + np.round((left + right - 2 * first) / 2.0).astype(np.int64)
+
+        location_E = cell_E[events, middle]
+        location_N = cell_N[events, middle]
+        uncertainties = np.sqrt((cell_E[events, right] - cell_E[events, left])**2 +
+                                (cell_N[events, right] - cell_N[events, left])**2) / 2
+
+        single_point = left == right
+        outer_left = np.maximum(left - 1, 0)
+        outer_right = np.minimum(right + 1, values.shape[1] - 1)
+
+        location_E[single_point] = xvals[columns][single_point]
+        location_N[single_point] = yvals[rows][single_point]
+        uncertainties[single_point] = (np.sqrt((cell_E[events, outer_right] - cell_E[events, outer_left])**2 +
+                                               (cell_N[events, outer_right] - cell_N[events, outer_left])**2) / 4)[single_point]
+
+        chunk_locations[located, 0] = location_E[located]
+        chunk_locations[located, 1] = location_N[located]
+        chunk_locations[located, 2] = uncertainties[located]
+        chunk_locations[located, 3] = chunk.reshape(len(chunk), -1).max(axis = 1)[located]
+
+        for end, edge in enumerate([left, right]):
+
+            chunk_plateaus[located, end, 0] = cell_E[events, edge][located]
+            chunk_plateaus[located, end, 1] = cell_N[events, edge][located]
+
+    return locations, plateaus
+
+
+
+
+def cell_edges(values):
+
+    '''
+    Edges of grid cells centred on evenly spaced grid values.
+    '''
+
+    values = np.asarray(values, dtype = np.float64)
+    half_step = (values[1] - values[0]) / 2
+
+    return np.concatenate([values - half_step, [values[-1] + half_step]])
+
+
+
+
+def location_density(locations, xvals, yvals):
+
+    '''
+    Number of locations ([E, N, ...] rows) in each grid cell, with shape
+    (rows, columns) indexed like the grid. Cells are centred on the grid
+    x and y values; locations outside the grid are not counted.
+    '''
+
+    locations = np.asarray(locations, dtype = np.float64).reshape(len(locations), -1)
+
+    counts = np.histogram2d(locations[:, 1], locations[:, 0], bins = [cell_edges(yvals), cell_edges(xvals)])[0]
+
+    return counts.astype(np.int64)
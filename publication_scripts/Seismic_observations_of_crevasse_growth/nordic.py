@@ -0,0 +1,279 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+Bulk reader for Nordic format (SEISAN) S-files. Type-1 (header) and
+phase lines are parsed by their fixed column positions, and the picks of
+many S-files, or of concatenated files such as SEISAN select.out files,
+are collected into one columnar pick table. Directories of S-files are
+parsed in parallel in chunks of files.
+"""
+
+import calendar
+import datetime
+import fnmatch
+import os
+
+import numpy as np
+
+from task_scheduler import run_tasks
+
+# Picks are kept as a structured array: the event id (index into the event
+# list), station, phase and arrival time (POSIX seconds)
+
+PICK_DTYPE = np.dtype([('event', 'i8'), ('station', 'U5'), ('phase', 'U4'), ('time', 'f8')])
+
+
+
+
+def line_type(line):
+
+    '''
+    Nordic line type, given in column 80. Phase lines may leave it blank.
+    '''
+
+    if len(line) < 80:
+
+        return ' '
+
+    return line[79]
+
+
+
+
+def header_time(line):
+
+    '''
+    Parse a type-1 line's origin date and time. Returns the POSIX times of
+    the start of the origin day and of the origin (the origin second may
+    be left blank).
+    '''
+
+    day_start = calendar.timegm(datetime.date(int(line[1:5]), int(line[6:8]), int(line[8:10])).timetuple())
+
+    origin_time = day_start
+
+    if len(line[11:15].strip()) > 0:
+
+        origin_time += int(line[11:13].strip() or 0) * 3600 + int(line[13:15].strip() or 0) * 60
+
+    if len(line[16:20].strip()) > 0:
+
+        origin_time += float(line[16:20])
+
+    return day_start, origin_time
+
+
+
+
+def phase_pick(line, day_start):
+
+    '''
+    Parse a phase line's station, phase and arrival time (POSIX seconds).
+    Hours of 24 or more, used for picks after midnight, are kept as day
+    increments. Returns None for lines without a station or arrival time.
+    '''
+
+    station = line[1:6].strip()
+
+    if (len(station) == 0) or (len(line[18:28].strip()) == 0):
+
+        return None
+
+    arrival_time = day_start + int(line[18:20].strip() or 0) * 3600 + int(line[20:22].strip() or 0) * 60 + \
+                   float(line[22:28].strip() or 0)
+
+    return station, line[10:14].strip(), arrival_time
+
+
+
+
+def parse_events(lines):
+
+    '''
+    Parse the events in an iterable of Nordic lines. Events are separated
+    by blank lines, and start with a type-1 line. Phase lines are lines
+    of type blank or 4 after the header line; other line types and
+    lines which cannot be parsed are skipped.
+
+    Yields, for each event, its origin time and its picks (station,
+    phase and arrival time) in the order they are listed.
+    '''
+
+    day_start = None
+    origin_time = None
+    picks = []
+
+    for line in lines:
+
+        line = line.rstrip('\r\n')
+
+        if len(line.strip()) == 0:
+
+            # End of an event
+
+            if day_start is not None:
+
+                yield origin_time, picks
+
+            day_start = None
+            picks = []
+            continue
+
+        if day_start is None:
+
+            # First line of an event
+
+            try:
+
+                day_start, origin_time = header_time(line)
+
+            except ValueError:
+
+                continue
+
+        elif line_type(line) in ' 4':
+
+            try:
+
+                pick = phase_pick(line.ljust(80), day_start)
+
+            except ValueError:
+
+                continue
+
+            if pick is not None:
+
+                picks.append(pick)
+
+    if day_start is not None:
+
+        yield origin_time, picks
+
+
+
+
+def read_S_file(S_file):
+
+    '''
+    Parse every event in an S-file (or concatenated file of S-files).
+    Returns a list of the origin time and picks of each event.
+    '''
+
+    with open(S_file, 'r', errors = 'replace') as openfile:
+
+        return list(parse_events(openfile))
+
+
+
+
+def read_S_files(S_files):
+
+    '''
+    Parse a list of S-files into an event list and a pick table. Events
+    are listed as [file, event number in the file, origin time], and
+    the pick table's event ids index this list. Files which cannot be
+    read are reported and skipped.
+    '''
+
+    events = []
+    pick_rows = []
+
+    for S_file in S_files:
+
+        try:
+
+            file_events = read_S_file(S_file)
+
+        except (IOError, OSError) as error:
+
+            print('Could not read ' + S_file + ': ' + str(error))
+            continue
+
+        for n in range(len(file_events)):
+
+            origin_time, picks = file_events[n]
+
+            for station, phase, arrival_time in picks:
+
+                pick_rows.append((len(events), station, phase, arrival_time))
+
+            events.append([S_file, n, origin_time])
+
+    return events, np.array(pick_rows, dtype = PICK_DTYPE)
+
+
+
+
+def find_S_files(paths, pattern = '*.S*'):
+
+    '''
+    List the S-files in a list of files and directories, searching
+    directories (such as SEISAN REA/YYYY/MM/ trees) recursively for file
+    names matching pattern. Files given directly are always included.
+    '''
+
+    S_files = []
+
+    for path in paths:
+
+        if not os.path.isdir(path):
+
+            S_files.append(path)
+            continue
+
+        for directory, subdirectories, files in os.walk(path):
+
+            subdirectories.sort()
+
+            S_files += [os.path.join(directory, name) for name in sorted(files) if fnmatch.fnmatch(name, pattern)]
+
+    return S_files
+
+
+
+
+def pick_table(paths, pattern = '*.S*', chunk_size = 500, max_workers = None, retries = 1):
+
+    '''
+    Parse all S-files (and concatenated files) found in a list of files and
+    directories into one event list and pick table (see read_S_files), in
+    file order. Files are parsed in chunks of chunk_size files by a pool of
+    max_workers processes (None uses all CPUs), or in this process if there
+    is only one chunk.
+    '''
+
+    S_files = find_S_files(paths, pattern)
+
+    chunks = [S_files[start : start + chunk_size] for start in range(0, len(S_files), chunk_size)]
+
+    if len(chunks) <= 1:
+
+        return read_S_files(S_files)
+
+    tasks = [{'key': c, 'args': (chunks[c],), 'size': sum([os.path.getsize(S_file) for S_file in chunks[c]])}
+             for c in range(len(chunks))]
+
+    results, failed = run_tasks(tasks, read_S_files, max_workers = max_workers, retries = retries)
+
+    for c in failed:
+
+        print('Failed to parse ' + str(len(chunks[c])) + ' S-files from ' + chunks[c][0])
+
+    # Join the chunks in file order, offsetting their event ids
+
+    events = []
+    tables = []
+
+    for c in sorted(results):
+
+        chunk_events, chunk_picks = results[c]
+
+        chunk_picks['event'] += len(events)
+        events += chunk_events
+        tables.append(chunk_picks)
+
+    if len(tables) == 0:
+
+        return events, np.zeros(0, dtype = PICK_DTYPE)
+
+    return events, np.concatenate(tables)
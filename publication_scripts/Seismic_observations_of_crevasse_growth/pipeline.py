@@ -0,0 +1,448 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+Run the processing scripts as a pipeline of stages with declared inputs
+and outputs. Each stage runs one of the existing scripts in its own
+Python process, with the script's top-level parameter assignments
+(name = value) replaced by the stage's parameters, so scripts keep their
+hard-coded defaults when run on their own.
+
+Stages can be split into one node per day (with the script's start and
+end date parameters set to that day). Every node has a key hashing its
+script and the modules it imports from the script directory, its
+parameters, input file signatures and the keys of the nodes it depends
+on; nodes whose key and outputs are unchanged since their last
+successful run are skipped, and independent nodes are run in parallel
+through task_scheduler.run_tasks.
+"""
+
+import ast
+import datetime
+import glob
+import hashlib
+import json
+import os
+import subprocess
+import sys
+import time
+
+from spectrum_store import load_manifest, save_manifest
+from task_scheduler import run_tasks
+
+SCRIPT_DIRECTORY = os.path.dirname(os.path.abspath(__file__))
+
+
+
+
+def override_parameters(source, parameters):
+
+    '''
+    Replace the top-level assignments (name = value) of the parameters in
+    a script's source with the given values (Python literals). Every
+    assignment of each name is replaced. Raises ValueError for parameters
+    the script does not assign at the top level.
+    '''
+
+    lines = source.split('\n')
+    replaced = set()
+
+    # Replace from the end so earlier line numbers stay valid
+
+    assignments = [node for node in ast.parse(source).body if isinstance(node, ast.Assign)
+                   and len(node.targets) == 1 and isinstance(node.targets[0], ast.Name)
+                   and node.targets[0].id in parameters]
+
+    for node in sorted(assignments, key = lambda node: node.lineno, reverse = True):
+
+        name = node.targets[0].id
+
+        lines[node.lineno - 1 : node.end_lineno] = [name + ' = ' + repr(parameters[name])]
+        replaced.add(name)
+
+    missing = sorted(set(parameters) - replaced)
+
+    if len(missing) > 0:
+
+        raise ValueError('Parameters not assigned at the top level of the script: ' + ', '.join(missing))
+
+    return '\n'.join(lines)
+
+
+
+
+def day_parameters(day):
+
+    '''
+    Start and end date parameters (as used by the detection and spectrum
+    scripts) covering one day.
+    '''
+
+    return {'start_year': day.strftime('%Y'), 'start_month': day.strftime('%m'), 'start_day': day.strftime('%d'),
+            'end_year': day.strftime('%Y'), 'end_month': day.strftime('%m'), 'end_day': day.strftime('%d')}
+
+
+
+
+def format_day(value, day):
+
+    '''
+    Fill {year}, {doy} (unpadded, as in the stream directory names), {jday}
+    (zero-padded to three digits, as in the stream file names) and {date}
+    (YYYY-MM-DD) in strings (and lists of strings) for a day.
+    '''
+
+    if isinstance(value, str):
+
+        return value.format(year = day.year, doy = day.timetuple().tm_yday, jday = day.strftime('%j'),
+                            date = day.strftime('%Y-%m-%d'))
+
+    if isinstance(value, list):
+
+        return [format_day(item, day) for item in value]
+
+    return value
+
+
+
+
+def expand_stages(stages, start_date, end_date):
+
+    '''
+    Expand stage definitions into pipeline nodes. A stage is a dictionary
+    with a 'name', the 'script' to run, its 'parameters', the names of the
+    stages it 'depends' on, its external 'inputs' and its 'outputs' (glob
+    patterns) and, optionally, 'split': 'day' to run one node per day from
+    start_date to end_date (datetime.date, inclusive). Strings in the
+    parameters, inputs and outputs of split stages are formatted per day
+    (see format_day).
+
+    A day node depends on the same day's node of split stages it depends
+    on, and on every node of other stages. Stages may only depend on
+    earlier stages (ValueError otherwise). Returns the nodes in stage order.
+    '''
+
+    days = [start_date + datetime.timedelta(days = d) for d in range((end_date - start_date).days + 1)]
+
+    stage_nodes = {}
+    nodes = []
+
+    for stage in stages:
+
+        stage_nodes[stage['name']] = []
+
+        for day in (days if stage.get('split') == 'day' else [None]):
+
+            node = {'id': stage['name'] if day is None else stage['name'] + ':' + day.strftime('%Y-%m-%d'),
+                    'stage': stage['name'],
+                    'day': day,
+                    'script': os.path.join(SCRIPT_DIRECTORY, stage['script']),
+                    'parameters': dict(stage.get('parameters', {})),
+                    'inputs': list(stage.get('inputs', [])),
+                    'outputs': list(stage.get('outputs', [])),
+                    'depends': []}
+
+            if day is not None:
+
+                node['parameters'] = dict([(name, format_day(value, day)) for name, value in node['parameters'].items()])
+                node['parameters'].update(day_parameters(day))
+                node['inputs'] = format_day(node['inputs'], day)
+                node['outputs'] = format_day(node['outputs'], day)
+
+            for upstream in stage.get('depends', []):
+
+                if upstream not in stage_nodes:
+
+                    raise ValueError('Stage ' + stage['name'] + ' depends on ' + upstream +
+                                     ', which is not an earlier stage')
+
+                for upstream_node in stage_nodes[upstream]:
+
+                    if (day is None) or (upstream_node['day'] is None) or (upstream_node['day'] == day):
+
+                        node['depends'].append(upstream_node['id'])
+
+            stage_nodes[stage['name']].append(node)
+            nodes.append(node)
+
+    return nodes
+
+
+
+
+def file_signatures(patterns):
+
+    '''
+    Path, size and modification time of every file matching the glob
+    patterns (directories are walked).
+    '''
+
+    signatures = []
+
+    for pattern in patterns:
+
+        for path in sorted(glob.glob(pattern)):
+
+            if os.path.isdir(path):
+
+                for directory, subdirectories, files in os.walk(path):
+
+                    for name in files:
+
+                        file_path = os.path.join(directory, name)
+                        signatures.append([file_path, os.path.getsize(file_path), os.path.getmtime(file_path)])
+
+            else:
+
+                signatures.append([path, os.path.getsize(path), os.path.getmtime(path)])
+
+    return sorted(signatures)
+
+
+
+
+def script_modules(script):
+
+    '''
+    Paths of a script and of every module it imports, directly or through
+    other modules, from its own directory (e.g. detection_engine for the
+    detection script). Other imports are ignored.
+    '''
+
+    directory = os.path.dirname(script)
+    modules = []
+    unread = [script]
+
+    while len(unread) > 0:
+
+        path = unread.pop()
+
+        if path in modules: continue
+
+        modules.append(path)
+
+        with open(path, 'r') as openfile:
+
+            tree = ast.parse(openfile.read())
+
+        for statement in ast.walk(tree):
+
+            if isinstance(statement, ast.Import):
+
+                names = [alias.name for alias in statement.names]
+
+            elif isinstance(statement, ast.ImportFrom) and (statement.level == 0):
+
+                names = [statement.module]
+
+            else:
+
+                continue
+
+            for name in names:
+
+                module = os.path.join(directory, name.split('.')[0] + '.py')
+
+                if os.path.exists(module): unread.append(module)
+
+    return sorted(modules)
+
+
+
+
+def node_key(node, upstream_keys):
+
+    '''
+    Key identifying a node run: a hash of its script's source and of the
+    modules it imports (see script_modules), its parameters, its input
+    file signatures and its upstream node keys.
+    '''
+
+    script_hash = hashlib.sha1()
+
+    for module in script_modules(node['script']):
+
+        with open(module, 'rb') as openfile:
+
+            script_hash.update(os.path.basename(module).encode() + b'\0' + openfile.read())
+
+    description = {'script': script_hash.hexdigest(),
+                   'parameters': node['parameters'],
+                   'inputs': file_signatures(node['inputs']),
+                   'depends': upstream_keys}
+
+    return hashlib.sha1(json.dumps(description, sort_keys = True, default = repr).encode()).hexdigest()[:16]
+
+
+
+
+def outputs_exist(node):
+
+    '''
+    Check that every output pattern of a node matches at least one file.
+    '''
+
+    return all([len(glob.glob(pattern)) > 0 for pattern in node['outputs']])
+
+
+
+
+def run_node(node_id, script, parameters, work_directory):
+
+    '''
+    Run a node's script with its parameters in a new Python process, in
+    work_directory (where the parameterised script and its log are kept).
+    Raises RuntimeError if the script fails. Returns the run time.
+    '''
+
+    with open(script, 'r') as openfile:
+
+        source = override_parameters(openfile.read(), parameters)
+
+    node_name = node_id.replace(':', '_')
+    node_script = os.path.join(work_directory, node_name + '.py')
+    log_file = os.path.join(work_directory, node_name + '.log')
+
+    with open(node_script, 'w') as openfile:
+        openfile.write(source)
+
+    # Sibling modules are imported from the script directory
+
+    environment = dict(os.environ)
+    environment['PYTHONPATH'] = os.path.dirname(script) + os.pathsep + environment.get('PYTHONPATH', '')
+    environment.setdefault('MPLBACKEND', 'Agg')
+
+    start_time = time.time()
+
+    with open(log_file, 'w') as log:
+
+        completed = subprocess.run([sys.executable, node_script], cwd = work_directory, env = environment,
+                                   stdout = log, stderr = subprocess.STDOUT)
+
+    if completed.returncode != 0:
+
+        with open(log_file, 'r') as openfile:
+
+            log_tail = openfile.read()[-2000:]
+
+        raise RuntimeError(node_id + ' exited with status ' + str(completed.returncode) + ':\n' + log_tail)
+
+    return time.time() - start_time
+
+
+
+
+def run_pipeline(stages, start_date, end_date, pipeline_directory, max_workers = None, retries = 0, force = ()):
+
+    '''
+    Run the stages (see expand_stages) from start_date to end_date.
+    Nodes are run in dependency order, independent nodes in parallel
+    (max_workers processes), and nodes are skipped when their key matches
+    their last successful run (recorded in pipeline_directory's manifest)
+    and their outputs exist, unless their stage is in force. Nodes
+    depending on failed nodes are not run. Raises ValueError if nodes
+    depend on nodes that can never finish (e.g. ids not in the pipeline).
+
+    Returns the ids of nodes that ran, were skipped as up to date, and
+    failed or were not run.
+    '''
+
+    if not os.path.exists(pipeline_directory):
+
+        os.makedirs(pipeline_directory)
+
+    manifest_file = os.path.join(pipeline_directory, 'pipeline_manifest.json')
+    manifest = load_manifest(manifest_file)
+
+    nodes = expand_stages(stages, start_date, end_date)
+
+    keys = {}
+    ran = []
+    skipped = []
+    failed = []
+    done = set()
+
+    def record_success(task, result):
+
+        # Record each node as soon as it completes so an interrupted run
+        # resumes from there
+
+        node = task['node']
+
+        manifest[node['id']] = {'key': keys[node['id']], 'run_time': result,
+                                'finished': datetime.datetime.now().isoformat()}
+        save_manifest(manifest, manifest_file)
+
+    pending = list(nodes)
+
+    while len(pending) > 0:
+
+        # Nodes whose dependencies have all finished, and nodes that can
+        # never run because a dependency failed
+
+        ready = [node for node in pending if all([upstream in done for upstream in node['depends']])]
+        blocked = [node for node in pending if any([upstream in failed for upstream in node['depends']])]
+
+        for node in blocked:
+
+            print('Not running ' + node['id'] + ' (a dependency failed)')
+            failed.append(node['id'])
+            pending.remove(node)
+
+        if len(ready) == 0:
+
+            # Nothing can run and nothing failed: the remaining nodes wait
+            # on nodes that are not pending, done or failed
+
+            if len(blocked) == 0:
+
+                raise ValueError('Nodes with unsatisfiable dependencies: ' +
+                                 ', '.join([node['id'] + ' (' + ', '.join([upstream for upstream in node['depends']
+                                                                          if upstream not in done]) + ')'
+                                            for node in pending]))
+
+            continue
+
+        tasks = []
+
+        for node in ready:
+
+            pending.remove(node)
+
+            keys[node['id']] = node_key(node, [keys[upstream] for upstream in node['depends']])
+
+            entry = manifest.get(node['id'])
+
+            if (entry is not None) and (entry['key'] == keys[node['id']]) and outputs_exist(node) and \
+               (node['stage'] not in force):
+
+                print(node['id'] + ' is up to date')
+                skipped.append(node['id'])
+                done.add(node['id'])
+                continue
+
+            work_directory = os.path.join(pipeline_directory, node['stage'])
+
+            if not os.path.exists(work_directory):
+
+                os.makedirs(work_directory)
+
+            tasks.append({'key': node['id'], 'node': node, 'size': 1,
+                          'args': (node['id'], node['script'], node['parameters'], work_directory)})
+
+        if len(tasks) == 0:
+
+            continue
+
+        print('Running ' + ', '.join([task['key'] for task in tasks]))
+
+        results, failed_ids = run_tasks(tasks, run_node, max_workers = max_workers, retries = retries,
+                                        on_success = record_success)
+
+        for node_id in results:
+
+            ran.append(node_id)
+            done.add(node_id)
+
+        failed += failed_ids
+
+    return ran, skipped, failed
@@ -1,23 +1,24 @@
 #!/usr/bin/env python3
 # -*- coding: utf-8 -*-
 """
-Frequency domain seismic detection algorithm,
-uses spectrum files saved from spectrum_generation.
+Plot event spectrograms as animations,
+uses the event feature store (see event_features).
 """
 
 # Import packages
 
-import datetime
-import glob
-import os
 import numpy as np
+import obspy
 import matplotlib.pyplot as plt
 from matplotlib import cm
 import matplotlib.animation as animation
 
+from event_catalogue import find_events
+from event_features import feature_store, query_features, row_spectrogram
+
 # Set parameters
 
-## Directory to load spectrum files from
+## Event directory (event catalogue or .MSEED and trigger .csv files)
 
 #spectrum_directory = '/home/sam/spectrums/'
 #spectrum_directory = '/media/sam/Seagate Backup Plus Drive/SCIENCE/Spectrums/'
@@ -54,73 +55,58 @@ sampling_rate = 250
 
 indices = [0, 100] 
 
-files = os.listdir(spectrum_directory)
-events = []
-for afile in files:
-    if afile[-6:] == '.MSEED':
-        events.append(afile)
-        
-events.sort()
+## Pre and post event time (s) of event waveforms, feature bands (Hz) and the
+## number of worker processes (None uses all CPUs) used to calculate features
+## of events not yet in the event feature store
+
+pre_post_time = 10
+feature_bands = [[5, 10], [10, 20], [20, 50], [50, 125]]
+max_workers = None
+
+starttime = obspy.UTCDateTime(start_year + '-' + start_month + '-' + start_day)
+endtime = obspy.UTCDateTime(end_year + '-' + end_month + '-' + end_day) + 86400
+
+# Find events in the event catalogue if there is one, otherwise in event files
+
+catalogue_file, catalogue_events, events = find_events(spectrum_directory, starttime, endtime)
+
+# Load the event feature store (calculating the spectra of events not yet in it)
+
+store = feature_store(spectrum_directory, events, [catalogue_events.get(event) for event in events],
+                      stream_stations, FFT_window_length = samples / float(sampling_rate),
+                      sampling_rate = sampling_rate, bands = feature_bands, pre_post_time = pre_post_time,
+                      catalogue_file = catalogue_file, max_workers = max_workers)
+
+frequencies = np.array(store['header']['frequencies'])
                 
-# Generate trigger times
+# Plot each event's spectrograms
 
 for event in events:
             
-            spectrum_files = glob.glob(spectrum_directory + event[:-6] + '*spectrums.npy')
-            
             all_spectrums = []
             all_times = []
             plot_stations = []
             
-            for spectrum_file in spectrum_files:
-                
-                stream_file_metadata = spectrum_file.split('/')[-1].split('_')
-                station = stream_file_metadata[-2]
-                
-                if station not in stream_stations: continue
+            for row in query_features(store, stations = stream_stations, events = [event]):
                 
-                # Load the spectrum file
-            
-                spectrum_list = np.load(spectrum_file).tolist()
+                times, spectrums = row_spectrogram(store, row)
                 
-                # Join spectra lists together
+                if len(times) == 0: continue
                 
-                times = []
-                spectrums = []
-                for i in range(len(spectrum_list)):
-                    for j in range(len(spectrum_list[i])):
-                        if len(spectrum_list[i][j]) > 0:
-                            times.append([])
-                            spectrums.append([])
-                            times[-1] = (spectrum_list[i][j][0])
-                            # Miss the first frequency entry as it is not representative of
-                            # particular harmonics.
-                            spectrums[-1] = np.absolute(spectrum_list[i][j][1][1:].real)
-                            
-                # Ensure times are chronological
-                # Unsorting may result from multithreading during spectrum generation
-                times, spectrums = zip(*sorted(zip(times, spectrums)))
-                            
-                all_times.append(times)
+                all_times.append([str(obspy.UTCDateTime(t)) for t in times])
                 all_spectrums.append(np.array(spectrums))
-                plot_stations.append(station)
+                plot_stations.append(store['columns']['station'][row])
                
-            try:
-                
-                times = np.array(times)
-                spectrums = np.array(spectrums)
+            if len(all_spectrums) == 0: continue
             
-            except:
-                
-                continue
+            times = all_times[-1]
+            spectrums = all_spectrums[-1]
             
             # Plot the spectrum as an "animation" using refreshes of an imshow plot
             
             num_windows = int(float(1 / (1 - window_overlap)) * \
               (len(spectrums)) / float(window_length))
             
-            frequencies = np.fft.fftfreq(samples, 1 / sampling_rate)
-            
             fig = plt.figure(figsize = (8,8))
             
             im_list = [[] for j in range(len(all_spectrums))]
@@ -0,0 +1,149 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+NaN-aware numeric kernels for evenly sampled time series (hourly rainfall,
+event counts, GNSS velocities...): running means, finite differences,
+cumulative counts and lagged cross-correlation, as array operations.
+"""
+
+import numpy as np
+
+
+
+
+def nan_running_mean(data, half_width, centre_weight = 1):
+
+    '''
+    Running mean of data over windows of half_width samples either side of
+    each sample, skipping NaN values. The centre sample of each window is
+    counted centre_weight times. Window sums are taken from cumulative
+    sums, so the cost does not depend on the window length.
+
+    Returns an array the length of data, NaN where the window extends past
+    either end of the data or holds no values.
+    '''
+
+    data = np.asarray(data, dtype = np.float64)
+    num_samples = len(data)
+
+    means = np.full(num_samples, np.nan)
+
+    if num_samples < 2 * half_width + 1:
+
+        return means
+
+    defined = ~np.isnan(data)
+    values = np.where(defined, data, 0)
+
+    cumulative_values = np.concatenate([[0], np.cumsum(values)])
+    cumulative_counts = np.concatenate([[0], np.cumsum(defined)])
+
+    window = 2 * half_width + 1
+    centres = slice(half_width, num_samples - half_width)
+
+    sums = cumulative_values[window:] - cumulative_values[:-window] + (centre_weight - 1) * values[centres]
+    counts = cumulative_counts[window:] - cumulative_counts[:-window] + (centre_weight - 1) * defined[centres]
+
+    with np.errstate(divide = 'ignore', invalid = 'ignore'):
+
+        means[centres] = np.where(counts > 0, sums / counts, np.nan)
+
+    return means
+
+
+
+
+def forward_difference(data):
+
+    '''
+    Forward differences of data (one shorter than the data).
+    '''
+
+    return np.diff(np.asarray(data, dtype = np.float64))
+
+
+
+
+def backward_difference(data, spacing, fill_value = 0):
+
+    '''
+    Backward difference derivative of data sampled every spacing. The first
+    sample, which has no backward difference, is set to fill_value.
+    '''
+
+    data = np.asarray(data, dtype = np.float64)
+
+    derivative = np.full(len(data), float(fill_value))
+    derivative[1:] = np.diff(data) / spacing
+
+    return derivative
+
+
+
+
+def central_difference(data, spacing, fill_value = 0):
+
+    '''
+    Central difference first and second derivatives of data sampled every
+    spacing. The end samples, which have no central difference, are set to
+    fill_value.
+    '''
+
+    data = np.asarray(data, dtype = np.float64)
+
+    first = np.full(len(data), float(fill_value))
+    second = np.full(len(data), float(fill_value))
+
+    first[1:-1] = (data[2:] - data[:-2]) / (2 * spacing)
+    second[1:-1] = (data[2:] - 2 * data[1:-1] + data[:-2]) / spacing**2
+
+    return first, second
+
+
+
+
+def cumulative_counts(counts):
+
+    '''
+    Running total of counts (e.g. events or rainfall per hour).
+    '''
+
+    return np.cumsum(np.asarray(counts))
+
+
+
+
+def lagged_xcorr(data1, data2, direct_size = 10**7):
+
+    '''
+    Full cross-correlation of two evenly sampled series, returning the lag
+    (in samples, as xcorrlag in trigger_statistics_vel) and value of the
+    first maximum, or NaN for both if either series holds NaN values.
+    Correlations are calculated directly for short series and by FFT when
+    the product of the series lengths exceeds direct_size.
+    '''
+
+    data1 = np.asarray(data1, dtype = np.float64)
+    data2 = np.asarray(data2, dtype = np.float64)
+
+    if np.any(np.isnan(data1)) or np.any(np.isnan(data2)):
+
+        return np.nan, np.nan
+
+    if len(data1) * len(data2) <= direct_size:
+
+        correlation = np.correlate(data1, data2, 'full')
+
+    else:
+
+        # Same ordering as np.correlate: the last sample of data2 against
+        # the first sample of data1 comes first
+
+        num_correlation = len(data1) + len(data2) - 1
+        num_fft = 2**int(np.ceil(np.log2(num_correlation)))
+
+        correlation = np.fft.irfft(np.fft.rfft(data1, num_fft) * np.fft.rfft(data2[::-1], num_fft), num_fft)[:num_correlation]
+
+    max_index = int(np.argmax(correlation))
+
+    return len(data1) - max_index - 1, correlation[max_index]
@@ -10,10 +10,64 @@ uses spectrum files saved from spectrum_generation.
 
 import datetime
 import glob
+import os
 import numpy as np
 import obspy
 import matplotlib.pyplot as plt
 
+from detection_engine import spectrum_file_triggers, associate_triggers, cut_packed_events
+from event_catalogue import open_catalogue, add_event, remove_events
+from task_scheduler import run_tasks, ordered_saver
+
+
+
+
+def save_day_events(day, event_data):
+    
+    '''
+    Save the events of a day whose waveforms have been cut. Days are saved
+    in day order (see task_scheduler.ordered_saver), so events are numbered
+    in the same order however the days were scheduled. Catalogued events of
+    the same type and threshold from earlier runs over the day are replaced.
+    '''
+    
+    triggers, events, event_members = day_events[day]
+    
+    if catalogue is not None:
+        
+        day_start = obspy.UTCDateTime(year = day[0], julday = day[1])
+        remove_events(catalogue, day_start, day_start + 86400, event_type, trigger_threshold)
+    
+    for e in range(len(events)):
+        
+        event_triggers = triggers[event_members[e]]
+        event_stations = [stream_stations[s] for s in event_triggers['station']]
+        
+        print('Saving ' + str([obspy.UTCDateTime(events['on'][e]), obspy.UTCDateTime(events['off'][e]),
+                               event_stations, float(events['length'][e])]))
+        
+        if catalogue is not None:
+            
+            add_event(catalogue, events['on'][e], events['off'][e],
+                      [[event_stations[t], event_triggers['on'][t], event_triggers['off'][t], event_triggers['snr'][t]]
+                       for t in range(len(event_triggers))],
+                      event_type = event_type, threshold = trigger_threshold,
+                      event_stream = event_data[e])
+        
+        if (write_event_files == True) and (len(event_data[e]) > 0):
+            
+            with open(event_output_directory + str(obspy.UTCDateTime(events['on'][e])) + '.MSEED', 'wb') as openfile:
+                openfile.write(event_data[e])
+    
+    # Commit each day's events to the catalogue
+    
+    if catalogue is not None:
+        
+        catalogue.commit()
+
+
+
+
 # Set parameters
 
 ## Directory to save event files to
@@ -22,6 +76,19 @@ import matplotlib.pyplot as plt
 #event_output_directory = '/home/samto/PERSONAL_SCIENCE/EVENTS/TYPE_D/'
 event_output_directory = '/home/sam/EVENTS_IT3/TYPE_A/5/'
 
+## Event catalogue to save events, their triggers and waveforms to
+## (set to None to save only individual event files)
+
+catalogue_file = event_output_directory + 'event_catalogue.sqlite'
+
+## Also save one .MSEED file per event in the event output directory
+
+write_event_files = False
+
+## Event type recorded in the event catalogue
+
+event_type = 'A'
+
 ## Directory to load spectrum files from (all spectrum files in one folder)
 
 spectrum_directory = '/media/sam/61D05F6577F6DB39/SCIENCE/Spectrums/'
@@ -101,6 +168,12 @@ station_threshold = 3
 
 FFT_window_len = 1
 
+## Number of processes to generate triggers and cut events with
+## (None uses all CPUs), and number of retries for failed station-days
+
+max_workers = None
+retries = 2
+
 # Convert start and end dates into datetime objects, and get them as julian days in their respective years
     
 start_date = datetime.datetime.strptime(start_year + '-' + start_month + '-'+ start_day, '%Y-%m-%d')
@@ -109,11 +182,12 @@ end_date = datetime.datetime.strptime(end_year + '-' + end_month + '-'+ end_day,
 start_date_doy = start_date.timetuple().tm_yday
 end_date_doy = end_date.timetuple().tm_yday
 
-# Look through data in all streams within the processing window
+# Find the spectrum files and stream files of every station-day in the processing window
 
-years = range(int(start_year), int(start_year) + int(end_year) - int(start_year))
+years = range(int(start_year), int(end_year) + 1)
 
-times = []
+trigger_tasks = []
+day_stream_files = {}
 
 for year in years:
     
@@ -123,20 +197,16 @@ for year in years:
         elif (year == int(end_year)) and (doy > int(end_date_doy)): continue            
         else:
             
-            spectrum_files = glob.glob(spectrum_directory + '*' + str(year) + '*' + str(doy) + '*spectrums.npy')
+            # Spectrum files are named after their stream files, which end in
+            # the year and zero-padded day of the year (e.g. day 12 is 012)
+            
+            day_spectrum_files = spectrum_directory + '*.' + str(year) + '.' + '{:03d}'.format(doy) + '_spectrums'
+            spectrum_files = glob.glob(day_spectrum_files + '.npy') + glob.glob(day_spectrum_files + '.dat')
             stream_files = glob.glob(stream_root_directory + 'Y' + str(year) + '/R' + str(doy) + '.01/*')
                         
             # Apply component and station filtering
-
-            triggers = []
-            band_ratios = []
-            trigger_durations = []
-            trigger_SNRs = []
-            event_durations = []
-            event_trigger_SNRs = []
-            all_event_triggers = []
             
-            for spectrum_file in spectrum_files:
+            for spectrum_file in sorted(spectrum_files):
                 
                 stream_file_metadata = spectrum_file.split('/')[-1].split('.')
                 component = stream_file_metadata[3][-1]
@@ -145,262 +215,92 @@ for year in years:
                 if component != stream_component: continue
                 if station not in stream_stations: continue
                 
-                # Load the spectrum file
-            
-                spectrum_list = np.load(spectrum_file).tolist()
-                
-                # Join spectra lists together
-                
-                times = []
-                spectrums = []
-                for i in range(len(spectrum_list)):
-                    for j in range(len(spectrum_list[i])):
-                        if len(spectrum_list[i][j]) > 0:
-                            times.append([])
-                            spectrums.append([])
-                            times[-1] = (spectrum_list[i][j][0])
-                            # Miss the first frequency entry as it is not representative of
-                            # particular harmonics.
-                            spectrums[-1] = np.absolute(spectrum_list[i][j][1][1:].real)
-                            
-                # Ensure times are chronological
-                # Unsorting may result from multithreading during spectrum generation
-                times, spectrums = zip(*sorted(zip(times, spectrums)))
-                
-                times = np.array(times)
-                spectrums = np.array(spectrums)
-                
-                # Calculate trigger section:
+                trigger_tasks.append({'key': (year, doy, station, spectrum_file),
+                                      'args': (spectrum_file, stream_stations.index(station),
+                                               signal_bands, signal_band_weights, noise_bands, noise_band_weights,
+                                               trigger_threshold, trigger_overload),
+                                      'size': os.path.getsize(spectrum_file)})
                 
-                print('Generating triggers for station ' + station + ' on day ' + str(doy) + ' in ' + str(year))
-                
-                trigger_on = False
-                
-                # Generate first noise value
-                
-                noise = 0
+            day_stream_files[(year, doy)] = {}
+            
+            for stream_file in stream_files:
                 
-                for noise_band in noise_bands:
-                        
-                    noise += sum(abs(spectrums[0][noise_band[0] : noise_band[1]])) * noise_band_weights[noise_bands.index(noise_band)] \
-                            / (noise_band[1] - noise_band[0])
-                            
-                # Compare signal values to noise values and generate triggers
-                # Each signal value is compared to the previous "signal" value
-                # (noise value) until the signal/noise threshold is passed,
-                # at this point each successive signal value is compared to
-                # the noise value at the time of triggering. This allows long
-                # triggers to occur which is useful for separating different
-                # spectral signatures.
+                stream_file_metadata = stream_file.split('/')[-1].split('.')
                 
-                for i in range(1, len(spectrums)):
-                    
-                    midtime = times[i]
-                    spectrum = spectrums[i]
+                if stream_file_metadata[0] not in stream_stations: continue
+                if stream_file_metadata[3][-1] != stream_component: continue
                 
-                    signal = 0
-                    
-                    # Calculate band ratios (normalise by length of band)
-                    
-                    for signal_band in signal_bands:
-                        
-                        signal += sum(abs(spectrum[signal_band[0] : signal_band[1]])) * signal_band_weights[signal_bands.index(signal_band)] \
-                                    / (signal_band[1] - signal_band[0])
-                    
-                    try:
-                        
-                        band_ratio = signal / noise
-                        band_ratios.append(100 * band_ratio)
-                        
-                    except:
-                        
-                        print('Signal:noise calculation failed at index ' + str(i) + ' !')
-                        continue
-                    
-                    # Determine and save triggers
-                    
-                    if (trigger_on == False) and (trigger_overload > band_ratio >= trigger_threshold):
-                        
-                        trigger_on = True    
-                        trigger_on_index = i
-                        
-                    elif (trigger_on == True) and (band_ratio < trigger_threshold):
-        
-                        trigger_on = False
-                        noise = signal
-                        trigger_off_index = i
-                        trigger_durations.append(trigger_off_index - trigger_on_index)
-#                        print(trigger_on_index, trigger_off_index)
-#                        print(times[trigger_on_index], times[trigger_off_index])
-                        triggers.append([times[trigger_on_index],
-                                         times[trigger_off_index],
-                                         station])
-                                         
-#                        print(triggers[-1])        
-                        
-                    elif (trigger_on == False):
-                        
-                        noise = signal
-                        
-                    if band_ratio >= trigger_threshold:
-                        
-                        trigger_SNRs.append(100 * band_ratio)
-                        
-            # Sort all the day's triggers chronologically                    
-            
-            triggers.sort()
+                day_stream_files[(year, doy)].setdefault(stream_file_metadata[0], stream_file)
 
-            # Find coincident triggers and write event files
-            
-            print('Locating coincident triggers')
-        
-            last_off = 0 # Set the end time of the previous trigger
-            coincidence_triggers = []
-            
-            count = -1
-            while count < (len(triggers) - 1):
-                
-                count += 1
-                
-                event = False
+# Generate triggers for all station-days in parallel. Each worker returns
+# its station-day's triggers as a compact array.
+# Compare signal values to noise values and generate triggers
+# Each signal value is compared to the previous "signal" value
+# (noise value) until the signal/noise threshold is passed,
+# at this point each successive signal value is compared to
+# the noise value at the time of triggering. This allows long
+# triggers to occur which is useful for separating different
+# spectral signatures.
 
-                # Get the first trigger
-                 
-                on, off, station = triggers[count]
-                trigger_SNR = trigger_SNRs[count]
-                
-                # Avoid overlapping events
-                              
-                if on < last_off + interevent_time: continue
-            
-                # Check trigger duration is desired
-                
-                if not (trigger_min_len <= (off - on) <= trigger_max_len): continue
-            
-                # Prepare the event output
-                
-                event_on_time = on
-                event_stations = [station]
-                event_SNRs = [trigger_SNR]
-                event_triggers = [triggers[count]]
-                coincidence_sum = 1
-                
-                # Compare current trigger with temporally-nearby triggers
-                
-                for later_trigger in triggers[count + 1:]:
-                    
-                    lt_on, lt_off, lt_station = later_trigger
-                    lt_trigger_SNR = trigger_SNRs[triggers.index(later_trigger)]
+print('Generating triggers for ' + str(len(trigger_tasks)) + ' station-days')
 
-                    # Check trigger duration is desired
+station_day_triggers, failed = run_tasks(trigger_tasks, spectrum_file_triggers,
+                                         max_workers = max_workers, retries = retries)
 
-                    if not (trigger_min_len <= (lt_off - lt_on) <= trigger_max_len): continue
+for key in failed:
+    
+    print('Failed to generate triggers for station ' + key[2] + ' on day ' + str(key[1]) + ' in ' + str(key[0]))
 
-                    # Check triggers are appropriately temporally clustered
-                    
-                    if lt_on > off + delay_time: break
+# Merge each day's triggers in station-day order and find coincident triggers
 
-                    # Only allow one trigger per station
-        
-                    if lt_station in event_stations: continue
-
-                    # Update event data for new trigger
-                    
-                    event_stations.append(lt_station)
-                    event_triggers.append(later_trigger)
-                    event_SNRs.append(lt_trigger_SNR)
-                    coincidence_sum += 1
-                    event_off_time = max([off, lt_off])        
-                    event_length = event_off_time - event_on_time                
-                    last_off = event_off_time
-                    
-                    # If the coincidence sum is high enough, save event data
-                    
-                    if coincidence_sum >= station_threshold:
-
-                        event = True
-                        
-                if event == True:
-                    
-                        if (event_min_len < event_length < event_max_len):
-                    
-                            coincidence_triggers.append([event_on_time,
-                                    event_off_time,
-                                    event_stations,
-                                    event_length])
-        
-                            event_durations.append(event_length)
-                            event_trigger_SNRs.extend(event_SNRs)
-                            
-                            # Save trigger details for alternative uses
-                            # such as trimming streams before xcorr
-                            
-                            all_event_triggers.append(event_triggers)
-                                    
-                            print(coincidence_triggers[-1])
-                        
-            # Save event files:
-            
-#            plt.figure()
-#            plt.subplot(221)
-#            plt.hist(band_ratios, range(0, 1000))   
-#            plt.title('Band ratio distribution', fontsize = 10)
-#            plt.subplot(222)
-#            plt.hist(trigger_durations, range(0, 20))
-#            plt.title('Trigger duration distribution', fontsize = 10)
-#            plt.subplot(223)
-#            plt.hist(event_trigger_SNRs, range(0, 1000))
-#            plt.title('Event trigger band ratio distribution', fontsize = 10)
-#            plt.subplot(224)
-#            plt.hist(event_durations, range(0, 20))
-#            plt.title('Event duration distribution', fontsize = 10)
-#            plt.show()
-            
-            # Build seismic stream
-            # NOTE: contains all components and stations available in stream files
+print('Locating coincident triggers')
 
-            print('Saving event files')
+day_events = {}
 
-            # Mode I: save events with pre- and post-event time
-            # with data from all triggered stations
-            
-            # suffers from same issue as mode 2 ! seemingly random
-            # stations with very poor time cropping!!
-                
-            stream = obspy.Stream()
-                
-#            for stream_file in stream_files:
-#                    
-#                stream += obspy.read(stream_file)
-#        
-#            for coincidence_trigger in coincidence_triggers:
-#               
-#                event_stream = obspy.Stream()
-#                
-#                print('Saving ' + str(coincidence_trigger))
-#                
-#                for trace in stream:
-#                        
-#                    if (trace.stats.station in coincidence_trigger[2]) and (trace.stats.channel[-1] == stream_component):
-#
-#                        event_stream += trace.copy().trim(starttime = coincidence_trigger[0] - pre_event_time,
-#                                           endtime = coincidence_trigger[1] + post_event_time)
-#
-#                event_stream.write(event_output_directory + str(coincidence_trigger[0]) + '.MSEED',
-#                             format = 'MSEED', cencoding = 'STEIM2')
-
-#            # Mode II: save events with each stream trimmed to its trigger duration
-
-            for event_triggers in all_event_triggers:
-                
-                print('Saving ' + str(coincidence_triggers[all_event_triggers.index(event_triggers)]))
-                
-                event_stream = obspy.Stream()
-                
-                for event_trigger in event_triggers:
-                    
-                    event_stream += obspy.read(glob.glob(stream_root_directory + 'Y' + str(year) + '/R' + str(doy) + '.01/' + event_trigger[2] + '*' + stream_component + '*')[0],
-                                               starttime = event_trigger[0] - pre_post_time * FFT_window_len, endtime = event_trigger[1] + pre_post_time * FFT_window_len)
+for key in sorted(station_day_triggers):
+    
+    day_events.setdefault(key[:2], []).append(station_day_triggers[key])
+
+cut_tasks = []
+
+for day in sorted(day_events):
+    
+    triggers, events, event_members = associate_triggers(np.concatenate(day_events[day]), station_threshold,
+                                                         delay_time, interevent_time,
+                                                         trigger_min_len, trigger_max_len,
+                                                         event_min_len, event_max_len)
+    
+    day_events[day] = (triggers, events, event_members)
+    
+    if len(events) == 0: continue
+    
+    cut_tasks.append({'key': day,
+                      'args': (day_stream_files[day], triggers, event_members, stream_stations,
+                               pre_post_time * FFT_window_len),
+                      'size': len(events)})
+
+# Cut event waveforms from each day's streams in parallel, and save events
+# in chronological day order as days complete
+
+print('Saving event files')
+
+catalogue = None
+
+if catalogue_file is not None:
+    
+    catalogue = open_catalogue(catalogue_file)
+
+# Days without events have nothing to cut, but still replace earlier runs' events
+
+for day in sorted(day_events):
+    
+    if len(day_events[day][1]) == 0: save_day_events(day, [])
+
+save_success, save_failure = ordered_saver(sorted([task['key'] for task in cut_tasks]), save_day_events)
+
+cut_results, failed = run_tasks(cut_tasks, cut_packed_events, max_workers = max_workers, retries = retries,
+                                on_success = save_success, on_failure = save_failure, keep_results = False)
+
+for day in failed:
     
-                event_stream.write(event_output_directory + str(coincidence_triggers[all_event_triggers.index(event_triggers)][0]) + \
-                                   '.MSEED', format = 'MSEED', cencoding = 'STEIM2')
\ No newline at end of file
+    print('Failed to save events on day ' + str(day[1]) + ' in ' + str(day[0]))
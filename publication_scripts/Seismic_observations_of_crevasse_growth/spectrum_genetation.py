@@ -6,13 +6,17 @@ Frequency domain detection using multiple python instances.
 
 import datetime
 import glob
-import concurrent.futures
+import os
 
 import math
 import numpy as np
 import obspy
 import threading
 
+from spectrum_store import (stream_spectra, spectrum_file_name, load_manifest,
+                            save_manifest, needs_processing, journal_processed)
+from task_scheduler import run_tasks
+
 
 
 
@@ -157,6 +161,58 @@ def spectra_generator(stream_file):
 
 
 
+def streamed_spectra_generator(stream_file):
+    
+    '''
+    Calculate spectra for stream in chunks of chunk_length seconds,
+    appending them to a spectrum store so the whole stream is never
+    held in memory. All variables bar stream_file are defined prior
+    to the function call.
+    '''
+    
+    stream_spectra(stream_file, spectrum_output_directory, FFT_window_length,
+                   FFT_window_overlap, chunk_length = chunk_length)
+
+
+
+
+def spectrum_file_for(stream_file):
+    
+    '''
+    Name of the spectrum file generated for stream_file with the
+    current generation mode.
+    '''
+    
+    if streaming == True:
+        
+        return spectrum_file_name(stream_file, spectrum_output_directory)
+    
+    else:
+        
+        return spectrum_output_directory + str(stream_file.split('/')[-1]) + '_spectrums.npy'
+
+
+
+
+def record_task(task, result):
+    
+    '''
+    Record a completed stream file in the manifest's journal straight
+    away, so an interrupted run resumes from where it stopped.
+    '''
+    
+    stream_file = task['args'][0]
+    
+    # Only record stream files whose spectra were written
+    
+    if os.path.exists(spectrum_file_for(stream_file)):
+        
+        journal_processed(manifest, manifest_file, stream_file, spectrum_file_for(stream_file),
+                          FFT_window_length, FFT_window_overlap)
+
+
+
+
 # Set parameters
 
 ## Stream root directory contains individual day-long streams of each station's components
@@ -199,6 +255,26 @@ FFT_window_overlap = 0
 
 numthreads = 2
 
+## Use streaming spectrum generation (spectrum store files) rather than loading
+## whole stream files into memory (_spectrums.npy files)
+
+streaming = True
+
+## Length of stream data (s) to hold in memory at once when streaming
+
+chunk_length = 3600
+
+## Manifest of processed stream files: unchanged stream files whose spectra
+## already exist (for the same FFT parameters) are skipped
+
+manifest_file = spectrum_output_directory + 'spectrum_manifest.json'
+
+## Number of processes to use for stream files (None uses all CPUs) and
+## number of times to retry a failed stream file
+
+max_workers = None
+retries = 2
+
 # Convert start and end dates into datetime objects, and get them as julian days in their respective years
     
 start_date = datetime.datetime.strptime(start_year + '-' + start_month + '-'+ start_day, '%Y-%m-%d')
@@ -215,9 +291,21 @@ end_date = datetime.datetime.strptime(end_year + '-' + end_month + '-'+ end_day,
 start_date_doy = start_date.timetuple().tm_yday
 end_date_doy = end_date.timetuple().tm_yday
 
-# Look through data in all streams within the processing window
+# Load the manifest of already processed stream files
+
+manifest = load_manifest(manifest_file)
+
+# Fold in the journal of an interrupted run, so new journal entries start
+# on a clean line
+
+save_manifest(manifest, manifest_file)
+
+# Enumerate every (station, day, component) stream file to process
+# across the whole processing window before starting any work
 
-years = range(int(start_year), int(start_year) + int(end_year) - int(start_year))
+years = range(int(start_year), int(end_year) + 1)
+
+tasks = []
 
 for year in years:
     
@@ -228,7 +316,6 @@ for year in years:
         else:
 
             stream_files = glob.glob(stream_root_directory + 'Y' + str(year) + '/R' + str(doy) + '.01/*')
-            stream_files_to_process = []
             
             for stream_file in stream_files:
         
@@ -238,14 +325,36 @@ for year in years:
                 
                 if component != stream_component: continue
                 if station not in stream_stations: continue
-        
-                stream_files_to_process.append(stream_file)
                 
-            # Launch a separate python interpreter for each stream's processing
-            
-            print('Processing stream files:')
-            print(stream_files_to_process)
+                # Skip stream files that are already processed and unchanged
                 
-            with concurrent.futures.ProcessPoolExecutor() as executor:
+                if not needs_processing(manifest, stream_file, spectrum_file_for(stream_file),
+                                        FFT_window_length, FFT_window_overlap): continue
+        
+                tasks.append({'key': (station, year, doy, component),
+                              'args': (stream_file,),
+                              'size': os.path.getsize(stream_file)})
                 
-                executor.map(spectra_generator, stream_files_to_process)
\ No newline at end of file
+print('Found ' + str(len(tasks)) + ' stream files to process')
+
+if streaming == True:
+    
+    generator = streamed_spectra_generator
+    
+else:
+    
+    generator = spectra_generator
+    
+# Run all stream files through one process pool, largest first
+        
+results, failed = run_tasks(tasks, generator, max_workers = max_workers,
+                            retries = retries, on_success = record_task)
+
+# Fold the journalled entries into the manifest
+
+save_manifest(manifest, manifest_file)
+
+if len(failed) > 0:
+    
+    print('Spectrum generation failed for:')
+    print(failed)
@@ -10,10 +10,13 @@ uses spectrum files saved from spectrum_generation.
 import datetime
 import glob
 import numpy as np
+import obspy
 import matplotlib.pyplot as plt
 from matplotlib import cm
 import matplotlib.animation as animation
 
+from spectrum_store import read_spectra
+
 # Set parameters
 
 ## Directory to load spectrum files from
@@ -62,7 +65,7 @@ end_date_doy = end_date.timetuple().tm_yday
 
 # Look through data in all streams within the processing window
 
-years = range(int(start_year), int(start_year) + int(end_year) - int(start_year))
+years = range(int(start_year), int(end_year) + 1)
 
 times = []
 
@@ -79,7 +82,8 @@ for year in years:
         elif (year == int(end_year)) and (doy > int(end_date_doy)): continue            
         else:
             
-            spectrum_files = glob.glob(spectrum_directory + '*' + str(year) + '*' + str(doy) + '*spectrums.npy')
+            spectrum_files = glob.glob(spectrum_directory + '*' + str(year) + '*' + str(doy) + '*spectrums.npy') + \
+                             glob.glob(spectrum_directory + '*' + str(year) + '*' + str(doy) + '*spectrums.dat')
             
             all_spectrums = []
             plot_stations = []
@@ -93,28 +97,11 @@ for year in years:
                 if component != stream_component: continue
                 if station not in stream_stations: continue
                 
-                # Load the spectrum file
-            
-                spectrum_list = np.load(spectrum_file).tolist()
-                
-                # Join spectra lists together
-                
-                times = []
-                spectrums = []
-                for i in range(len(spectrum_list)):
-                    for j in range(len(spectrum_list[i])):
-                        if len(spectrum_list[i][j]) > 0:
-                            times.append([])
-                            spectrums.append([])
-                            times[-1] = (spectrum_list[i][j][0])
-                            # Miss the first frequency entry as it is not representative of
-                            # particular harmonics.
-                            spectrums[-1] = np.absolute(spectrum_list[i][j][1][1:].real)
-                            
-                # Ensure times are chronological
-                # Unsorting may result from multithreading during spectrum generation
-                times, spectrums = zip(*sorted(zip(times, spectrums)))
-                            
+                # Load the spectrum file (chronological window midtimes and spectra)
+            
+                times, spectrums = read_spectra(spectrum_file)
+                times = [obspy.UTCDateTime(t) for t in times]
+                
                 all_spectrums.append(np.array(spectrums))
                 plot_stations.append(station)
                
@@ -0,0 +1,421 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+Streaming spectrum generation and the on-disk spectrum store.
+
+Day-long (or multi-day merged) miniSEED files are read in bounded chunks
+of records, high-pass filtered with a filter state carried across chunk
+boundaries, and split into FFT windows with the window overlap carried
+across chunk boundaries. Spectra are appended to a flat binary file as
+they are generated, so memory use does not depend on record length.
+"""
+
+import io
+import json
+import os
+
+import numpy as np
+import obspy
+import scipy.signal
+from obspy.io.mseed.util import get_record_information
+
+
+
+
+def spectrum_dtype(num_frequencies):
+
+    '''
+    Record layout of a spectrum store: the window midtime (POSIX seconds)
+    followed by the complex spectrum up to the nyquist index.
+    '''
+
+    return np.dtype([('midtime', 'f8'), ('spectrum', 'c16', (num_frequencies,))])
+
+
+
+
+def spectrum_file_name(stream_file, spectrum_output_directory):
+
+    '''
+    Name of the spectrum store generated from a stream file.
+    '''
+
+    return spectrum_output_directory + str(stream_file.split('/')[-1]) + '_spectrums.dat'
+
+
+
+
+def header_file_name(spectrum_file):
+
+    '''
+    Name of the header file describing a spectrum store.
+    '''
+
+    return spectrum_file[:-4] + '.json'
+
+
+
+
+def read_stream_chunks(stream_file, chunk_length):
+
+    '''
+    Yield obspy streams of consecutive miniSEED records from stream_file,
+    each containing roughly chunk_length seconds of data. Only one chunk
+    of records is held in memory at a time.
+    '''
+
+    # Use the first record to convert the chunk length into a number of records
+
+    record_information = get_record_information(stream_file)
+    record_length = record_information['record_length']
+    record_duration = record_information['npts'] / float(record_information['samp_rate'])
+    chunk_records = max(1, int(chunk_length / record_duration))
+
+    with open(stream_file, 'rb') as openfile:
+
+        while True:
+
+            chunk = openfile.read(chunk_records * record_length)
+
+            if len(chunk) == 0: break
+
+            yield obspy.read(io.BytesIO(chunk), format = 'MSEED')
+
+
+
+
+def detrend_windows(windows):
+
+    '''
+    Demean and detrend each row of an array of data windows, as obspy's
+    'demean' and 'simple' detrends do. Returns a new array.
+    '''
+
+    window_samples = windows.shape[1]
+
+    # Demean, then remove the line through the first and last samples
+
+    windows = windows - windows.mean(axis = 1)[:, np.newaxis]
+    windows -= windows[:, :1] + np.arange(window_samples) * \
+               (windows[:, -1:] - windows[:, :1]) / float(window_samples - 1)
+
+    return windows
+
+
+
+
+def window_spectra(data, window_samples, step_samples, sampling_rate):
+
+    '''
+    Calculate the spectra of all complete FFT windows in data at once.
+    Each window is demeaned and detrended (see detrend_windows) before its
+    FFT is taken, and only the spectrum up to the nyquist index is kept.
+    '''
+
+    windows = np.lib.stride_tricks.sliding_window_view(data, window_samples)[::step_samples]
+
+    spectra = np.fft.fft(detrend_windows(windows), axis = 1)
+
+    return spectra[:, :int(sampling_rate / 2) + 1]
+
+
+
+
+def stream_spectra(stream_file, spectrum_output_directory, FFT_window_length,
+                   FFT_window_overlap, chunk_length = 3600):
+
+    '''
+    Calculate spectra for a stream file chunk by chunk and append them to
+    a spectrum store in spectrum_output_directory. The store is written
+    under a temporary name and only renamed once complete, so interrupted
+    runs never leave a partial store behind. Returns the store's name.
+    '''
+
+    spectrum_file = spectrum_file_name(stream_file, spectrum_output_directory)
+    partial_file = spectrum_file + '.part'
+
+    print('Streaming spectra for ' + stream_file)
+
+    sos = None
+    num_windows = 0
+    expected_time = None
+    sampling_rate = None
+
+    with open(partial_file, 'wb') as outfile:
+
+        for stream in read_stream_chunks(stream_file, chunk_length):
+
+            stream.sort(['starttime'])
+
+            for trace in stream:
+
+                if sos is None:
+
+                    # Set up the filter and windowing on the first trace
+
+                    sampling_rate = trace.stats.sampling_rate
+                    window_samples = int(round(FFT_window_length * sampling_rate))
+                    step_samples = max(1, int(round(window_samples * (1 - FFT_window_overlap))))
+                    num_frequencies = min(window_samples, int(sampling_rate / 2) + 1)
+                    dtype = spectrum_dtype(num_frequencies)
+
+                    # Same high-pass filter as obspy's stream.filter('highpass', ...)
+
+                    sos = scipy.signal.iirfilter(4, (1 / float(FFT_window_length)) / (0.5 * sampling_rate),
+                                                 btype = 'highpass', ftype = 'butter', output = 'sos')
+
+                if trace.stats.sampling_rate != sampling_rate: continue
+
+                # Restart the filter and the windowing at gaps and overlaps,
+                # otherwise carry both on from the previous trace
+
+                if (expected_time is None) or (abs(trace.stats.starttime - expected_time) > 0.5 / sampling_rate):
+
+                    filter_state = np.zeros((sos.shape[0], 2))
+                    carry = np.zeros(0)
+                    segment_start = trace.stats.starttime.timestamp
+                    segment_offset = 0
+
+                data, filter_state = scipy.signal.sosfilt(sos, trace.data.astype(np.float64), zi = filter_state)
+                expected_time = trace.stats.endtime + 1 / sampling_rate
+
+                buffer = np.concatenate([carry, data])
+
+                if len(buffer) < window_samples:
+
+                    carry = buffer
+                    continue
+
+                chunk_windows = (len(buffer) - window_samples) // step_samples + 1
+
+                # Append this chunk's windows to the store
+
+                records = np.zeros(chunk_windows, dtype = dtype)
+                records['midtime'] = segment_start + (segment_offset + np.arange(chunk_windows) * step_samples) / \
+                                     sampling_rate + 0.5 * FFT_window_length
+                records['spectrum'] = window_spectra(buffer, window_samples, step_samples, sampling_rate)
+                records.tofile(outfile)
+
+                num_windows += chunk_windows
+
+                # Keep the samples still needed by the next (overlapping) window
+
+                carry = buffer[chunk_windows * step_samples:]
+                segment_offset += chunk_windows * step_samples
+
+    if sos is None:
+
+        os.remove(partial_file)
+        print('No data found in ' + stream_file)
+
+        return None
+
+    header = {'stream_file': stream_file,
+              'sampling_rate': sampling_rate,
+              'FFT_window_length': FFT_window_length,
+              'FFT_window_overlap': FFT_window_overlap,
+              'num_frequencies': num_frequencies,
+              'num_windows': num_windows}
+
+    with open(header_file_name(spectrum_file), 'w') as openfile:
+        json.dump(header, openfile)
+
+    os.replace(partial_file, spectrum_file)
+
+    return spectrum_file
+
+
+
+
+def load_spectrum_store(spectrum_file):
+
+    '''
+    Memory-map a spectrum store. Returns the store's records and header.
+    '''
+
+    with open(header_file_name(spectrum_file), 'r') as openfile:
+        header = json.load(openfile)
+
+    dtype = spectrum_dtype(header['num_frequencies'])
+
+    if os.path.getsize(spectrum_file) == 0:
+
+        return np.zeros(0, dtype = dtype), header
+
+    return np.memmap(spectrum_file, dtype = dtype, mode = 'r'), header
+
+
+
+
+def read_spectra(spectrum_file):
+
+    '''
+    Load a spectrum store (.dat) or a spectrum list saved by
+    spectra_generator (.npy) as used by the detection scripts:
+    chronological window midtimes (POSIX seconds) and the absolute real
+    spectrum values without the first frequency entry.
+    '''
+
+    if spectrum_file[-4:] == '.dat':
+
+        records, header = load_spectrum_store(spectrum_file)
+
+        times = np.array(records['midtime'])
+        spectrums = np.absolute(records['spectrum'][:, 1:].real)
+
+    else:
+
+        spectrum_list = np.load(spectrum_file, allow_pickle = True).tolist()
+
+        # Join spectra lists together
+
+        times = []
+        spectrums = []
+        for i in range(len(spectrum_list)):
+            for j in range(len(spectrum_list[i])):
+                if len(spectrum_list[i][j]) > 0:
+                    times.append(spectrum_list[i][j][0].timestamp)
+                    # Miss the first frequency entry as it is not representative of
+                    # particular harmonics.
+                    spectrums.append(np.absolute(spectrum_list[i][j][1][1:].real))
+
+        times = np.array(times)
+        spectrums = np.array(spectrums)
+
+    # Ensure times are chronological
+    # Unsorting may result from multithreading during spectrum generation
+
+    order = np.argsort(times, kind = 'stable')
+
+    return times[order], spectrums[order]
+
+
+
+
+def stream_file_signature(stream_file, FFT_window_length, FFT_window_overlap):
+
+    '''
+    Describe a stream file and the spectrum parameters applied to it,
+    so changes to either can be detected between runs.
+    '''
+
+    stat = os.stat(stream_file)
+
+    return {'size': stat.st_size,
+            'mtime': stat.st_mtime,
+            'FFT_window_length': FFT_window_length,
+            'FFT_window_overlap': FFT_window_overlap}
+
+
+
+
+def load_manifest(manifest_file):
+
+    '''
+    Load the manifest of processed stream files, keyed on stream file path,
+    including entries journalled since it was last saved (see
+    journal_processed). A missing manifest is treated as empty.
+    '''
+
+    manifest = {}
+
+    if os.path.exists(manifest_file):
+
+        with open(manifest_file, 'r') as openfile:
+
+            manifest = json.load(openfile)
+
+    if os.path.exists(manifest_file + '.journal'):
+
+        with open(manifest_file + '.journal', 'r') as openfile:
+
+            for line in openfile:
+
+                # A run killed mid-write leaves a partial last line
+
+                try:
+
+                    stream_file, entry = json.loads(line)
+
+                except ValueError:
+
+                    continue
+
+                manifest[stream_file] = entry
+
+    return manifest
+
+
+
+
+def save_manifest(manifest, manifest_file):
+
+    '''
+    Write the manifest to disk, replacing the old manifest only once the
+    new one has been written completely, and clear its journal.
+    '''
+
+    with open(manifest_file + '.part', 'w') as openfile:
+        json.dump(manifest, openfile, indent = 1, sort_keys = True)
+
+    os.replace(manifest_file + '.part', manifest_file)
+
+    if os.path.exists(manifest_file + '.journal'):
+
+        os.remove(manifest_file + '.journal')
+
+
+
+
+def needs_processing(manifest, stream_file, spectrum_file, FFT_window_length, FFT_window_overlap):
+
+    '''
+    Check whether a stream file must have its spectra (re)generated: it is
+    new, it has changed size or modification time, the spectrum parameters
+    have changed, or its spectrum file is missing.
+    '''
+
+    entry = manifest.get(os.path.abspath(stream_file))
+
+    if entry is None: return True
+    if not os.path.exists(entry['spectrum_file']): return True
+    if entry['spectrum_file'] != os.path.abspath(spectrum_file): return True
+
+    signature = stream_file_signature(stream_file, FFT_window_length, FFT_window_overlap)
+
+    for key in signature:
+
+        if entry.get(key) != signature[key]: return True
+
+    return False
+
+
+
+
+def record_processed(manifest, stream_file, spectrum_file, FFT_window_length, FFT_window_overlap):
+
+    '''
+    Add a successfully processed stream file to the manifest.
+    '''
+
+    entry = stream_file_signature(stream_file, FFT_window_length, FFT_window_overlap)
+    entry['spectrum_file'] = os.path.abspath(spectrum_file)
+
+    manifest[os.path.abspath(stream_file)] = entry
+
+
+
+
+def journal_processed(manifest, manifest_file, stream_file, spectrum_file, FFT_window_length, FFT_window_overlap):
+
+    '''
+    Add a successfully processed stream file to the manifest and append
+    its entry to the manifest's journal, so progress survives an
+    interrupted run without rewriting the whole manifest for every file.
+    '''
+
+    record_processed(manifest, stream_file, spectrum_file, FFT_window_length, FFT_window_overlap)
+
+    with open(manifest_file + '.journal', 'a') as openfile:
+
+        openfile.write(json.dumps([os.path.abspath(stream_file), manifest[os.path.abspath(stream_file)]]) + '\n')
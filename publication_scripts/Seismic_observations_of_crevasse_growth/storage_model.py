@@ -0,0 +1,129 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+Crevasse water storage model, as used by trigger_statistics_vel.drainage_model:
+rain fills a store which drains at up to a maximum drainage rate, and the
+maximum drainage rate grows with drainage (by a) and relaxes (by b) towards
+its base value (Do). All parameter combinations are advanced together as
+arrays at each timestep, so whole parameter grids are simulated and scored
+against the crevassing rate at once.
+"""
+
+import numpy as np
+
+
+
+
+def drainage_steps(rainfall_data, Do, a, b):
+
+    '''
+    Advance the storage model for every combination of the parameters
+    Do (base drainage rate, mm/hr), a and b (arrays broadcast against each
+    other) over the rainfall rates (mm/hr) of each timestep.
+
+    Yields, for each timestep, the storage and the maximum drainage rate
+    used during the timestep, as arrays of the broadcast parameter shape.
+    '''
+
+    Do, a, b = np.broadcast_arrays(np.asarray(Do, dtype = np.float64),
+                                   np.asarray(a, dtype = np.float64),
+                                   np.asarray(b, dtype = np.float64))
+
+    D = np.zeros(Do.shape) # current drainage
+    S = np.zeros(Do.shape) # current storage
+    Dmax = Do.copy() # current drainage maxima
+
+    for I in rainfall_data:
+
+        # Drain the rain and as much storage as the drainage maxima allows
+        # (drainage is unchanged when there is no rainfall rate)
+
+        if not np.isnan(I):
+
+            D = np.minimum(Dmax, I + S)
+
+        S = S + I - D
+
+        yield S, Dmax
+
+        # Adjust the drainage maxima, never dropping below Do
+
+        Dmax = Dmax + a * D - b * Dmax
+        Dmax = np.where(Dmax > Do, Dmax, Do)
+
+
+
+
+def simulate_drainage(rainfall_data, Do, a, b):
+
+    '''
+    Run the storage model (see drainage_steps) and return the storage and
+    maximum drainage rate series, with shape (parameter shape..., timesteps).
+    '''
+
+    storage = []
+    drainage_maxima = []
+
+    for S, Dmax in drainage_steps(rainfall_data, Do, a, b):
+
+        storage.append(S)
+        drainage_maxima.append(Dmax)
+
+    return np.stack(storage, axis = -1), np.stack(drainage_maxima, axis = -1)
+
+
+
+
+def fit_drainage(rainfall_data, crevassing_rate, Do, a, b):
+
+    '''
+    Score every parameter combination by the Pearson correlation
+    coefficient between its modelled storage and the crevassing rate,
+    over timesteps where both are defined. Statistics are accumulated
+    while the model runs, so the storage series are never held in memory.
+
+    Returns the correlation coefficients (parameter shape, NaN where the
+    storage or crevassing rate is constant), and the maximum storage and
+    maximum drainage rate over all combinations and timesteps.
+    '''
+
+    crevassing_rate = np.asarray(crevassing_rate, dtype = np.float64)
+
+    n = 0
+    sum_S = 0
+    sum_SS = 0
+    sum_SC = 0
+    sum_C = 0
+    sum_CC = 0
+    max_S = -np.inf
+    max_D = -np.inf
+
+    for t, (S, Dmax) in enumerate(drainage_steps(rainfall_data, Do, a, b)):
+
+        max_S = max(max_S, np.nanmax(S))
+        max_D = max(max_D, np.nanmax(Dmax))
+
+        C = crevassing_rate[t]
+
+        if np.isnan(C): continue
+
+        n += 1
+        sum_S = sum_S + S
+        sum_SS = sum_SS + S * S
+        sum_SC = sum_SC + S * C
+        sum_C += C
+        sum_CC += C * C
+
+    with np.errstate(divide = 'ignore', invalid = 'ignore'):
+
+        covariance = sum_SC - sum_S * sum_C / n
+        variance_S = sum_SS - sum_S * sum_S / n
+        variance_C = sum_CC - sum_C * sum_C / n
+
+        correlations = covariance / np.sqrt(variance_S * variance_C)
+
+    # Rounding can leave tiny variances for constant storage
+
+    correlations = np.where(variance_S > 1e-12 * np.maximum(sum_SS, 1), correlations, np.nan)
+
+    return correlations, max_S, max_D
@@ -0,0 +1,253 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+Run many independent tasks (e.g. station-days) through one long-lived
+process pool, largest tasks first, with retries and progress reporting.
+"""
+
+import concurrent.futures
+import os
+import time
+
+from concurrent.futures.process import BrokenProcessPool
+
+
+
+
+def format_duration(seconds):
+
+    '''
+    Format a number of seconds as HH:MM:SS for progress reports.
+    '''
+
+    seconds = int(round(seconds))
+
+    return '{:02d}:{:02d}:{:02d}'.format(seconds // 3600, (seconds % 3600) // 60, seconds % 60)
+
+
+
+
+def report_progress(done, total, done_size, total_size, start_time):
+
+    '''
+    Print the number of completed tasks, the throughput and an estimate
+    of the remaining time (from the amount of work, not task count, as
+    tasks are run largest first).
+    '''
+
+    elapsed = time.time() - start_time
+
+    if (elapsed <= 0) or (done_size <= 0):
+
+        print('Completed ' + str(done) + '/' + str(total) + ' tasks')
+        return
+
+    rate = done / elapsed
+    eta = (total_size - done_size) * elapsed / done_size
+
+    print('Completed ' + str(done) + '/' + str(total) + ' tasks (' +
+          '{:.2f}'.format(rate * 60) + ' tasks/min, ' +
+          '{:.1f}'.format(done_size / elapsed / 1e6) + ' MB/s), elapsed ' +
+          format_duration(elapsed) + ', ETA ' + format_duration(eta))
+
+
+
+
+def run_tasks(tasks, worker, max_workers = None, retries = 2, on_success = None, on_failure = None,
+              keep_results = True):
+
+    '''
+    Run worker(*task['args']) for every task in one process pool.
+
+    tasks is a list of dictionaries with a unique 'key', the worker
+    'args' and a 'size' (e.g. input file size in bytes) used to order
+    tasks largest first and to estimate the remaining time. Failed tasks
+    are resubmitted up to retries times; if a worker process dies the
+    pool is restarted and the tasks that were running are retried one at
+    a time. on_success(task, result) is
+    called in this process as each task completes, so callers can record
+    progress (e.g. in a manifest) and resume cleanly after interruption.
+    on_failure(task, error) is called for tasks which failed every
+    attempt.
+
+    Returns the results of successful tasks keyed on task key (None for
+    each task if keep_results is False, e.g. when on_success saves large
+    results), and the keys of tasks which failed every attempt.
+    '''
+
+    tasks = sorted(tasks, key = lambda task: task['size'], reverse = True)
+
+    total = len(tasks)
+    total_size = sum([task['size'] for task in tasks])
+    done = 0
+    done_size = 0
+    results = {}
+    failed = []
+    attempts = dict([(task['key'], 0) for task in tasks])
+    start_time = time.time()
+
+    if total == 0:
+
+        return results, failed
+
+    # Only as many tasks as there are workers are handed to the pool at a
+    # time, so a worker dying (e.g. killed for running out of memory) only
+    # fails the tasks that were running when the pool broke
+
+    num_workers = max_workers if max_workers is not None else (os.cpu_count() or 1)
+
+    queue = list(tasks)
+    futures = {}
+    isolated = set()
+    executor = None
+
+    try:
+
+        while (len(queue) > 0) or (len(futures) > 0):
+
+            if executor is None:
+
+                executor = concurrent.futures.ProcessPoolExecutor(max_workers = max_workers)
+
+            broken = False
+
+            while (len(queue) > 0) and (len(futures) < num_workers):
+
+                task = queue[0]
+
+                # Tasks that were running when a pool broke are rerun on
+                # their own, so only the task killing its worker fails again
+
+                if any([futures[future]['key'] in isolated for future in futures]): break
+                if (task['key'] in isolated) and (len(futures) > 0): break
+
+                try:
+
+                    future = executor.submit(worker, *task['args'])
+
+                except BrokenProcessPool:
+
+                    broken = True
+                    break
+
+                queue.pop(0)
+                attempts[task['key']] += 1
+                futures[future] = task
+
+            finished, running = concurrent.futures.wait(futures, return_when = concurrent.futures.FIRST_COMPLETED)
+
+            broken = broken or any([isinstance(future.exception(), BrokenProcessPool) for future in finished])
+
+            if broken:
+
+                # Every task in a broken pool fails, so collect them all
+                # before starting a new pool
+
+                finished = set(futures)
+                concurrent.futures.wait(finished)
+
+            for future in finished:
+
+                task = futures.pop(future)
+
+                try:
+
+                    result = future.result()
+
+                except Exception as error:
+
+                    # Requeue failed tasks until they run out of attempts
+
+                    if isinstance(error, BrokenProcessPool):
+
+                        isolated.add(task['key'])
+
+                    if attempts[task['key']] <= retries:
+
+                        print('Task ' + str(task['key']) + ' failed (' + repr(error) + '), retrying')
+                        queue.append(task)
+
+                    else:
+
+                        print('Task ' + str(task['key']) + ' failed after ' + str(attempts[task['key']]) +
+                              ' attempts: ' + repr(error))
+                        failed.append(task['key'])
+                        done += 1
+                        done_size += task['size']
+
+                        if on_failure is not None:
+
+                            on_failure(task, error)
+
+                    continue
+
+                results[task['key']] = result if keep_results else None
+                done += 1
+                done_size += task['size']
+
+                if on_success is not None:
+
+                    on_success(task, result)
+
+                report_progress(done, total, done_size, total_size, start_time)
+
+            if broken:
+
+                print('A worker process died, restarting the process pool')
+                executor.shutdown(wait = True)
+                executor = None
+
+    except KeyboardInterrupt:
+
+        # Drop queued tasks; completed tasks have already been reported
+        # through on_success so a rerun picks up where this one stopped
+
+        print('Interrupted: cancelling ' + str(total - done) + ' remaining tasks')
+        raise
+
+    finally:
+
+        if executor is not None:
+
+            executor.shutdown(wait = True, cancel_futures = True)
+
+    return results, failed
+
+
+
+
+def ordered_saver(keys, save):
+
+    '''
+    Make on_success and on_failure callbacks for run_tasks which call
+    save(key, result) in the order of keys (e.g. days), however the tasks
+    are scheduled: a result is saved once every earlier task has been
+    saved or has failed, and is then dropped. A failed task never holds
+    back later ones.
+    '''
+
+    order = list(keys)
+    pending = {}
+    failed = set()
+
+    def flush():
+
+        while (len(order) > 0) and ((order[0] in pending) or (order[0] in failed)):
+
+            key = order.pop(0)
+
+            if key in pending:
+
+                save(key, pending.pop(key))
+
+    def on_success(task, result):
+
+        pending[task['key']] = result
+        flush()
+
+    def on_failure(task, error):
+
+        failed.add(task['key'])
+        flush()
+
+    return on_success, on_failure
@@ -0,0 +1,469 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+Matched-filter detection of repeating events: well-located catalogue
+events are used as templates and correlated against continuous day
+streams. Normalised cross-correlations of all templates with a station's
+data are calculated with one FFT of each block of the station's data,
+station correlation traces are shifted by each template's station
+moveout and stacked over the network, and stack peaks become detections
+that are added to the event catalogue alongside the spectrogram detections.
+"""
+
+import time
+
+import obspy
+import numpy as np
+
+from detection_engine import TRIGGER_DTYPE
+from event_catalogue import read_waveform, event_triggers
+from grid_transects import grid_sources, stack_grids, locate_plateaus
+
+# Detection candidates: template origin time (POSIX seconds), template
+# index, network stack value and the number of stations stacked
+
+CANDIDATE_DTYPE = np.dtype([('time', 'f8'), ('template', 'i4'), ('stack', 'f4'), ('num_stations', 'i4')])
+
+
+
+
+def well_located_events(event_directory, min_date, max_date, xvals, yvals, bearing, step,
+                        max_uncertainty, min_xcorr, stack_file = None):
+
+    '''
+    Locate the events from min_date to max_date from their GRID2D xcorr
+    value grids, with the same locator Plot_GRID2D uses by default (see
+    grid_transects.locate_plateaus), and return those with a location
+    uncertainty of at most max_uncertainty km and a maximum xcorr value of
+    at least min_xcorr, as a list of [event, location] (location as
+    [E, N, uncertainty, max value]) with the highest maximum xcorr values
+    first.
+    '''
+
+    if stack_file is None:
+
+        stack_file = event_directory + 'template_grid_stack.npy'
+
+    sources = grid_sources(event_directory, min_date, max_date)
+
+    if len(sources) == 0:
+
+        return []
+
+    grids = stack_grids(sources, stack_file)
+    locations, plateaus = locate_plateaus(grids, xvals, yvals, bearing, step)
+
+    with np.errstate(invalid = 'ignore'):
+
+        selected = np.flatnonzero((locations[:, 2] <= max_uncertainty) & (locations[:, 3] >= min_xcorr))
+
+    selected = selected[np.argsort(-locations[selected, 3], kind = 'stable')]
+
+    return [[sources[e][0], locations[e].tolist()] for e in selected]
+
+
+
+
+def prepare_stream(stream, filter_band):
+
+    '''
+    Demean, detrend and bandpass filter a stream (in place) before
+    correlation, the same way for templates and day streams.
+    '''
+
+    stream.detrend(type = 'demean')
+    stream.detrend(type = 'simple')
+    stream.filter('bandpass', freqmin = filter_band[0], freqmax = filter_band[-1])
+
+    return stream
+
+
+
+
+def build_templates(catalogue, event_ids, stations, template_lead, template_length, filter_band,
+                    sampling_rate):
+
+    '''
+    Cut templates from catalogued events: for each station with a trigger
+    (refined if available), template_length seconds of filtered waveform
+    starting template_lead seconds before the trigger on time.
+
+    Returns a dictionary of the template data (templates x stations x
+    samples, zero-mean with unit norm; zero where a station has no
+    template), which stations each template has, each station window's
+    start (in samples) after the template origin (its earliest station
+    window), and each station trigger's on time after the origin and
+    length (seconds).
+    '''
+
+    num_samples = int(round(template_length * sampling_rate))
+    lead_samples = int(round(template_lead * sampling_rate))
+
+    shape = (len(event_ids), len(stations))
+
+    templates = {'event_ids': list(event_ids),
+                 'data': np.zeros(shape + (num_samples,), dtype = np.float32),
+                 'present': np.zeros(shape, dtype = bool),
+                 'offsets': np.zeros(shape, dtype = np.int64),
+                 'trigger_offsets': np.zeros(shape),
+                 'trigger_lengths': np.zeros(shape)}
+
+    for k in range(len(event_ids)):
+
+        stream = prepare_stream(read_waveform(catalogue, event_ids[k]), filter_band)
+        starts = np.zeros(len(stations))
+
+        for station, on_time, off_time, snr in event_triggers(catalogue, event_ids[k]):
+
+            if station not in stations: continue
+
+            s = stations.index(station)
+            traces = stream.select(station = station)
+
+            if (len(traces) == 0) or (traces[0].stats.sampling_rate != sampling_rate): continue
+
+            trace = traces[0]
+
+            start = int(round((on_time - trace.stats.starttime) * sampling_rate)) - lead_samples
+
+            if (start < 0) or (start + num_samples > trace.stats.npts): continue
+
+            window = np.asarray(trace.data[start : start + num_samples], dtype = np.float64)
+            window -= window.mean()
+            norm = np.sqrt(np.sum(window ** 2))
+
+            if norm == 0: continue
+
+            templates['data'][k, s] = window / norm
+            templates['present'][k, s] = True
+            templates['trigger_lengths'][k, s] = off_time - on_time
+
+            starts[s] = trace.stats.starttime.timestamp + start / float(sampling_rate)
+            templates['trigger_offsets'][k, s] = on_time.timestamp
+
+        if not templates['present'][k].any(): continue
+
+        # Station windows and triggers relative to the template origin
+
+        origin = starts[templates['present'][k]].min()
+
+        templates['offsets'][k] = np.where(templates['present'][k],
+                                           np.round((starts - origin) * sampling_rate), 0).astype(np.int64)
+        templates['trigger_offsets'][k] = np.where(templates['present'][k],
+                                                   templates['trigger_offsets'][k] - origin, 0)
+
+    return templates
+
+
+
+
+def template_batch(templates, indices):
+
+    '''
+    Select templates (see build_templates) by index, e.g. to split them
+    between worker tasks.
+    '''
+
+    batch = dict([(name, values[indices]) for name, values in templates.items() if name != 'event_ids'])
+    batch['event_ids'] = [templates['event_ids'][k] for k in indices]
+
+    return batch
+
+
+
+
+def read_day_data(stream_files, stations, day_start, sampling_rate, filter_band):
+
+    '''
+    Read and filter each station's day stream (stream_files maps stations
+    to files) onto a common sample grid from day_start (POSIX seconds) for
+    one day, with gaps and missing data as zeros. Returns the data
+    (stations x samples, float32) and which stations have data.
+    '''
+
+    num_samples = int(round(86400 * sampling_rate))
+
+    data = np.zeros((len(stations), num_samples), dtype = np.float32)
+    available = np.zeros(len(stations), dtype = bool)
+
+    for s in range(len(stations)):
+
+        if stations[s] not in stream_files: continue
+
+        stream = obspy.read(stream_files[stations[s]])
+        stream = stream.select(station = stations[s])
+        stream.merge(fill_value = 0)
+
+        for trace in prepare_stream(stream, filter_band):
+
+            if trace.stats.sampling_rate != sampling_rate:
+
+                print('Skipping ' + stations[s] + ' data at ' + str(trace.stats.sampling_rate) + ' Hz')
+                continue
+
+            start = int(round((trace.stats.starttime.timestamp - day_start) * sampling_rate))
+
+            first = max(start, 0)
+            last = min(start + trace.stats.npts, num_samples)
+
+            if last <= first: continue
+
+            data[s, first : last] = trace.data[first - start : last - start]
+            available[s] = True
+
+    return data, available
+
+
+
+
+def correlate_block(segment, template_spectra, num_samples, fft_length):
+
+    '''
+    Normalised cross-correlation of templates (zero-mean, unit norm, given
+    as their conjugate single precision rFFTs of fft_length) with every
+    window of num_samples in a data segment of fft_length samples. All
+    templates are correlated in one batched inverse FFT. Windows with no
+    variance correlate as 0.
+
+    Returns a float32 array of shape (templates, fft_length - num_samples + 1).
+    '''
+
+    segment = np.asarray(segment, dtype = np.float64)
+    num_lags = fft_length - num_samples + 1
+
+    # Single precision transforms are about twice as fast and accurate
+    # enough for correlation coefficients
+
+    products = np.fft.irfft(np.fft.rfft(segment.astype(np.float32))[np.newaxis] * template_spectra,
+                            fft_length, axis = 1)[:, :num_lags]
+
+    # Window sums and sums of squares from (double precision) cumulative sums
+
+    cumulative = np.concatenate([[0], np.cumsum(segment)])
+    cumulative_squares = np.concatenate([[0], np.cumsum(segment ** 2)])
+
+    sums = cumulative[num_samples : num_samples + num_lags] - cumulative[:num_lags]
+    variances = cumulative_squares[num_samples : num_samples + num_lags] - cumulative_squares[:num_lags] - \
+                sums ** 2 / num_samples
+
+    # Rounding leaves tiny variances where the data is constant (e.g. gaps)
+
+    valid = variances > 1e-12 * np.max(variances, initial = 0)
+
+    scales = np.zeros(num_lags, dtype = np.float32)
+    scales[valid] = 1 / np.sqrt(variances[valid])
+
+    products *= scales
+
+    return products
+
+
+
+
+def match_day(stream_files, day_start, templates, stations, sampling_rate, filter_band, cc_threshold,
+              fft_length = 2**17, mad_step = 50):
+
+    '''
+    Process pool worker correlating a batch of templates (see
+    build_templates) with one day of continuous data (see read_day_data).
+
+    The day is processed in blocks of template origin times. In each block
+    every station's data is correlated with all templates at once, each
+    template's station correlations are shifted by its station offsets and
+    averaged over the stations with both template and data (the network
+    stack), and local stack maxima of at least cc_threshold are kept as
+    candidates. The median absolute deviation of each template's stack
+    (from every mad_step-th value) is also returned, for thresholds
+    relative to the stack noise.
+
+    Returns the candidates, the station correlations at each candidate
+    (candidates x stations), each template's stack MAD, the number of
+    stations with data and the processing time (seconds).
+    '''
+
+    start_time = time.time()
+
+    data, available = read_day_data(stream_files, stations, day_start, sampling_rate, filter_band)
+
+    template_data = templates['data']
+    num_templates, num_stations, num_samples = template_data.shape
+    num_day_samples = data.shape[1]
+
+    stacked = templates['present'] & available[np.newaxis]
+    stack_counts = stacked.sum(axis = 1)
+    offsets = templates['offsets']
+
+    max_offset = int(offsets.max()) if num_templates > 0 else 0
+
+    # Each block gives origin times for fft_length less the template length
+    # and the largest station offset, including one origin either side of
+    # the block so peaks can be found at its edges
+
+    block_length = fft_length - num_samples + 1 - max_offset - 2
+
+    if block_length < 1:
+
+        raise ValueError('fft_length is too short for the templates')
+
+    template_spectra = np.conj(np.fft.rfft(template_data, fft_length, axis = 2)).astype(np.complex64)
+
+    candidates = []
+    candidate_ccs = []
+    stack_samples = []
+
+    for block_start in range(0, num_day_samples, block_length):
+
+        block_samples = min(block_length, num_day_samples - block_start)
+
+        # Origins from first to last (inclusive) are stacked
+
+        first = max(block_start - 1, 0)
+        last = min(block_start + block_samples, num_day_samples - 1)
+
+        stack = np.zeros((num_templates, last - first + 1), dtype = np.float32)
+        station_ccs = {}
+
+        for s in np.flatnonzero(stacked.any(axis = 0)):
+
+            segment = np.zeros(fft_length)
+            segment_data = data[s, first : first + fft_length]
+            segment[:len(segment_data)] = segment_data
+
+            ccs = correlate_block(segment, template_spectra[:, s], num_samples, fft_length)
+
+            # Windows running past the end of the day's data do not correlate
+
+            ccs[:, max(num_day_samples - num_samples + 1 - first, 0):] = 0
+
+            for k in np.flatnonzero(stacked[:, s]):
+
+                stack[k] += ccs[k, offsets[k, s] : offsets[k, s] + stack.shape[1]]
+
+            station_ccs[s] = ccs
+
+        stack /= np.maximum(stack_counts, 1)[:, np.newaxis]
+
+        stack_samples.append(stack[:, block_start - first : block_start - first + block_samples : mad_step].copy())
+
+        # Local maxima above the threshold at the block's own origins
+
+        k_peaks, t_peaks = np.nonzero(stack[:, 1:-1] >= cc_threshold)
+        t_peaks += 1
+
+        values = stack[k_peaks, t_peaks]
+
+        is_peak = (values > stack[k_peaks, t_peaks - 1]) & (values >= stack[k_peaks, t_peaks + 1]) & \
+                  (first + t_peaks >= block_start) & (first + t_peaks < block_start + block_samples)
+
+        k_peaks = k_peaks[is_peak]
+        t_peaks = t_peaks[is_peak]
+
+        block_candidates = np.zeros(len(k_peaks), dtype = CANDIDATE_DTYPE)
+        block_candidates['time'] = day_start + (first + t_peaks) / float(sampling_rate)
+        block_candidates['template'] = k_peaks
+        block_candidates['stack'] = stack[k_peaks, t_peaks]
+        block_candidates['num_stations'] = stack_counts[k_peaks]
+
+        block_ccs = np.zeros((len(k_peaks), num_stations), dtype = np.float32)
+
+        for s, ccs in station_ccs.items():
+
+            block_ccs[:, s] = np.where(stacked[k_peaks, s], ccs[k_peaks, offsets[k_peaks, s] + t_peaks], 0)
+
+        candidates.append(block_candidates)
+        candidate_ccs.append(block_ccs)
+
+    stack_samples = np.concatenate(stack_samples, axis = 1)
+    stack_mads = np.median(np.abs(stack_samples - np.median(stack_samples, axis = 1, keepdims = True)), axis = 1)
+
+    return np.concatenate(candidates), np.concatenate(candidate_ccs), stack_mads, int(available.sum()), \
+           time.time() - start_time
+
+
+
+
+def decluster_detections(candidates, min_separation, existing_times = ()):
+
+    '''
+    Keep the strongest of candidates (best network stack first) that are
+    at least min_separation seconds from each other and from existing
+    event times. Returns the indices of the kept candidates in time order.
+    '''
+
+    existing_times = np.sort(np.asarray(existing_times, dtype = np.float64))
+
+    order = np.argsort(-candidates['stack'], kind = 'stable')
+    kept_times = []
+    kept = []
+
+    for c in order.tolist():
+
+        candidate_time = candidates['time'][c]
+
+        e = np.searchsorted(existing_times, candidate_time)
+
+        if ((e > 0) and (candidate_time - existing_times[e - 1] < min_separation)) or \
+           ((e < len(existing_times)) and (existing_times[e] - candidate_time < min_separation)):
+
+            continue
+
+        # Kept times are few, so a linear check is quick
+
+        if any([abs(candidate_time - kept_time) < min_separation for kept_time in kept_times]):
+
+            continue
+
+        kept_times.append(candidate_time)
+        kept.append(c)
+
+    kept = np.array(kept, dtype = np.int64)
+
+    return kept[np.argsort(candidates['time'][kept], kind = 'stable')]
+
+
+
+
+def detection_triggers(candidates, candidate_ccs, templates, station_cc_threshold):
+
+    '''
+    Station triggers of detections: for each template station whose
+    correlation at the detection is at least station_cc_threshold, the
+    template event's station trigger moved to the detection time, with
+    the station correlation (as a percentage) as its SNR.
+
+    Returns the triggers (see detection_engine.TRIGGER_DTYPE) sorted by
+    on time and, for each detection, the indices of its triggers.
+    '''
+
+    triggers = []
+    detection_stations = []
+
+    for c in range(len(candidates)):
+
+        k = candidates['template'][c]
+
+        stations = np.flatnonzero(templates['present'][k] & (candidate_ccs[c] >= station_cc_threshold))
+
+        station_triggers = np.zeros(len(stations), dtype = TRIGGER_DTYPE)
+        station_triggers['on'] = candidates['time'][c] + templates['trigger_offsets'][k, stations]
+        station_triggers['off'] = station_triggers['on'] + templates['trigger_lengths'][k, stations]
+        station_triggers['station'] = stations
+        station_triggers['snr'] = 100 * candidate_ccs[c, stations]
+
+        triggers.append(station_triggers)
+        detection_stations.append(len(stations))
+
+    if len(triggers) == 0:
+
+        return np.zeros(0, dtype = TRIGGER_DTYPE), []
+
+    triggers = np.concatenate(triggers)
+    detection_index = np.repeat(np.arange(len(candidates)), detection_stations)
+
+    order = np.argsort(triggers['on'], kind = 'stable')
+    position = np.empty(len(order), dtype = np.int64)
+    position[order] = np.arange(len(order))
+
+    event_members = [np.sort(position[detection_index == c]) for c in range(len(candidates))]
+
+    return triggers[order], event_members
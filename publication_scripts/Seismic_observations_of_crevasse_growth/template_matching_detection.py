@@ -0,0 +1,303 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+Template-matching (matched-filter) detection of repeating events,
+using well-located events from the event catalogue as templates and
+adding new detections to the same catalogue.
+"""
+
+# Import packages
+
+import datetime
+import glob
+import math
+import time
+import numpy as np
+import obspy
+
+from detection_engine import cut_packed_events
+from event_catalogue import open_catalogue, event_file_index, event_times, add_event
+from task_scheduler import run_tasks, ordered_saver
+from template_matching import well_located_events, build_templates, template_batch, match_day, \
+                              decluster_detections, detection_triggers
+
+
+
+
+def save_day_detections(day, event_data):
+
+    '''
+    Save the detections of a day whose waveforms have been cut. Days are
+    saved in day order (see task_scheduler.ordered_saver), so events are
+    numbered in the same order however the days were scheduled.
+    '''
+
+    candidates, triggers, event_members = day_detections.pop(day)
+
+    for e in range(len(event_members)):
+
+        event_triggers = triggers[event_members[e]]
+        event_stations = [stream_stations[s] for s in event_triggers['station']]
+
+        print('Saving ' + str([obspy.UTCDateTime(event_triggers['on'].min()), event_stations,
+                               float(candidates['stack'][e])]))
+
+        add_event(catalogue, event_triggers['on'].min(), event_triggers['off'].max(),
+                  [[event_stations[t], event_triggers['on'][t], event_triggers['off'][t], event_triggers['snr'][t]]
+                   for t in range(len(event_triggers))],
+                  event_type = event_type, threshold = cc_threshold, event_stream = event_data[e])
+
+    catalogue.commit()
+
+
+
+
+# Set parameters
+
+## Event directory holding the event catalogue (templates are taken from it
+## and detections are added to it) and GRID2D's xcorr value grids
+
+event_directory = '/home/sam/EVENTS_IT3/TYPE_A/4/'
+catalogue_file = event_directory + 'event_catalogue.sqlite'
+
+## Type recorded for template-matched events
+
+event_type = 'template'
+
+## Directory to load day-long streams from
+
+stream_root_directory = '/media/sam/61D05F6577F6DB39/SCIENCE/day_volumes_S/'
+
+## Seismic component and stations to use in processing
+
+stream_component = 'Z'
+stream_stations = ['TSNC1', 'TSNC3', 'TSNL2', 'TSNL3', 'TSNR2', 'TSNR3']
+
+## Start and end dates of the day-long streams to search
+
+start_year = '2016'
+start_month = '05'
+start_day = '01'
+
+end_year = '2016'
+end_month = '06'
+end_day = '01'
+
+## Time range of the events to choose templates from
+
+template_min_date = datetime.datetime(2016, 4, 21)
+template_max_date = datetime.datetime(2016, 8, 1)
+
+## Location grid (as in GRID2D and Plot_GRID2D), used to choose well-located events
+## as templates: those with a location uncertainty (km) of at most max_uncertainty
+## and a maximum xcorr value of at least min_xcorr, best first, up to max_templates
+
+xmin = 1373.0
+xmax = 1375.0
+ymin = 5163.0
+ymax = 5166.5
+xstep = 0.05
+ystep = 0.05
+
+step = 0.01
+long_axis_direction = [0.1995, 0.9799]
+bearing = math.atan(long_axis_direction[0] / long_axis_direction[1])
+
+max_uncertainty = 0.1
+min_xcorr = 0.7
+max_templates = 50
+
+## Template windows: template_length seconds starting template_lead seconds
+## before each station's trigger, filtered to filter_band (Hz)
+
+template_lead = 0.5
+template_length = 3
+filter_band = [1, 25]
+sampling_rate = 250
+
+## Detection thresholds: network-stacked correlation coefficient, and
+## multiple of the stack's median absolute deviation over the day
+
+cc_threshold = 0.4
+mad_multiple = 9
+
+## Station triggers need a correlation of at least station_cc_threshold and
+## detections need at least station_threshold station triggers
+
+station_cc_threshold = 0.3
+station_threshold = 3
+
+## Minimum time (s) between detections, and between detections and events
+## already in the catalogue (e.g. the templates themselves)
+
+min_separation = 5
+
+## Set pre and post event time (s) for event waveforms
+
+pre_post_time = 10
+
+## Number of templates correlated together in each worker task, FFT length
+## (samples) of the correlation blocks, number of worker processes (None uses
+## all CPUs) and retries for failed tasks
+
+templates_per_task = 10
+fft_length = 2**17
+max_workers = None
+retries = 1
+
+# Choose templates from the well-located catalogued events
+
+catalogue = open_catalogue(catalogue_file)
+catalogue_events = event_file_index(catalogue)
+
+gridx, gridy = np.meshgrid(np.linspace(xmin, xmax, int(round((xmax - xmin + 1) / xstep))),
+                           np.linspace(ymin, ymax, int(round((ymax - ymin + 1) / ystep))))
+
+located_events = well_located_events(event_directory, template_min_date, template_max_date,
+                                     gridx[0], gridy[:, 0], bearing, step, max_uncertainty, min_xcorr)
+
+template_ids = [catalogue_events[event] for event, location in located_events if event in catalogue_events]
+
+print('Building templates from ' + str(len(template_ids)) + ' well-located events')
+
+templates = build_templates(catalogue, template_ids, stream_stations, template_lead, template_length,
+                            filter_band, sampling_rate)
+
+usable = np.flatnonzero(templates['present'].sum(axis = 1) >= station_threshold)[:max_templates]
+templates = template_batch(templates, usable)
+
+print('Using ' + str(len(usable)) + ' templates')
+
+# Find the stream files of every day in the processing window, and split the
+# templates between tasks for each day
+
+start_date = datetime.datetime.strptime(start_year + '-' + start_month + '-'+ start_day, '%Y-%m-%d')
+end_date = datetime.datetime.strptime(end_year + '-' + end_month + '-'+ end_day, '%Y-%m-%d')
+
+match_tasks = []
+day_stream_files = {}
+
+day = start_date
+
+while day <= end_date:
+
+    year = day.year
+    doy = day.timetuple().tm_yday
+
+    stream_files = glob.glob(stream_root_directory + 'Y' + str(year) + '/R' + str(doy) + '.01/*')
+
+    day_stream_files[(year, doy)] = {}
+
+    for stream_file in stream_files:
+
+        stream_file_metadata = stream_file.split('/')[-1].split('.')
+
+        if stream_file_metadata[0] not in stream_stations: continue
+        if stream_file_metadata[3][-1] != stream_component: continue
+
+        day_stream_files[(year, doy)].setdefault(stream_file_metadata[0], stream_file)
+
+    if len(day_stream_files[(year, doy)]) > 0:
+
+        for first in range(0, len(usable), templates_per_task):
+
+            indices = np.arange(first, min(len(usable), first + templates_per_task))
+
+            match_tasks.append({'key': (year, doy, first),
+                                'args': (day_stream_files[(year, doy)], obspy.UTCDateTime(day).timestamp,
+                                         template_batch(templates, indices), stream_stations, sampling_rate,
+                                         filter_band, cc_threshold, fft_length),
+                                'size': len(indices) * len(day_stream_files[(year, doy)])})
+
+    day += datetime.timedelta(days = 1)
+
+# Correlate all template batches with all days in parallel
+
+print('Correlating ' + str(len(usable)) + ' templates with ' + str(len(day_stream_files)) + ' days')
+
+match_start = time.time()
+
+match_results, failed = run_tasks(match_tasks, match_day, max_workers = max_workers, retries = retries)
+
+match_time = time.time() - match_start
+
+for key in failed:
+
+    print('Failed to correlate templates ' + str(key[2]) + ' onwards on day ' + str(key[1]) + ' in ' + str(key[0]))
+
+# Report throughput in templates x station-days per hour (of elapsed time,
+# and of worker time)
+
+template_station_days = sum([min(templates_per_task, len(usable) - key[2]) * result[3]
+                             for key, result in match_results.items()])
+worker_time = sum([result[4] for result in match_results.values()])
+
+if match_time > 0 and worker_time > 0:
+
+    print('Throughput: ' + str(int(template_station_days * 3600 / match_time)) + ' templates x station-days per hour (' +
+          str(int(template_station_days * 3600 / worker_time)) + ' per worker hour)')
+
+# Merge each day's candidates over template batches, keep detections above the
+# thresholds that are not repeats of each other or of catalogued events, and
+# find their station triggers
+
+day_detections = {}
+cut_tasks = []
+
+for day in sorted(day_stream_files):
+
+    day_keys = [key for key in sorted(match_results) if key[:2] == day]
+
+    if len(day_keys) == 0: continue
+
+    candidates = []
+    candidate_ccs = []
+
+    for key in day_keys:
+
+        batch_candidates, batch_ccs, stack_mads, num_stations, batch_time = match_results[key]
+
+        above = batch_candidates['stack'] >= mad_multiple * stack_mads[batch_candidates['template']]
+
+        batch_candidates = batch_candidates[above]
+        batch_candidates['template'] += key[2]
+
+        candidates.append(batch_candidates)
+        candidate_ccs.append(batch_ccs[above])
+
+    candidates = np.concatenate(candidates)
+    candidate_ccs = np.concatenate(candidate_ccs)
+
+    day_start = obspy.UTCDateTime(year = day[0], julday = day[1])
+
+    existing_times = event_times(catalogue, day_start - min_separation, day_start + 86400 + min_separation)
+
+    kept = decluster_detections(candidates, min_separation, existing_times)
+
+    triggers, event_members = detection_triggers(candidates[kept], candidate_ccs[kept], templates, station_cc_threshold)
+
+    enough = [e for e in range(len(kept)) if len(event_members[e]) >= station_threshold]
+
+    print(str(len(enough)) + ' detections on day ' + str(day[1]) + ' in ' + str(day[0]))
+
+    if len(enough) == 0: continue
+
+    day_detections[day] = (candidates[kept][enough], triggers, [event_members[e] for e in enough])
+
+    cut_tasks.append({'key': day,
+                      'args': (day_stream_files[day], triggers, day_detections[day][2], stream_stations, pre_post_time),
+                      'size': len(enough)})
+
+# Cut detection waveforms from each day's streams in parallel, and save the
+# detections to the catalogue in day order
+
+print('Saving detections')
+
+save_success, save_failure = ordered_saver(sorted([task['key'] for task in cut_tasks]), save_day_detections)
+
+cut_results, failed = run_tasks(cut_tasks, cut_packed_events, max_workers = max_workers, retries = retries,
+                                on_success = save_success, on_failure = save_failure, keep_results = False)
+
+for day in failed:
+
+    print('Failed to save detections on day ' + str(day[1]) + ' in ' + str(day[0]))
@@ -0,0 +1,132 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+Travel-time and sample-shift tables for 2D location grids, cached as
+.npy files keyed on the grid, station positions, velocity and sampling
+rate. Tables are memory-mapped read-only, so a table loaded before a
+process pool is started is shared by all workers rather than being
+recomputed or pickled for each task.
+"""
+
+import hashlib
+import json
+import os
+
+import numpy as np
+
+
+
+
+def table_key(gridx, gridy, station_positions, velocity, sampling_rate = None, relative = False):
+
+    '''
+    Key identifying a table: a hash of the grid coordinates (and so its
+    bounds and steps), the station positions, the velocity, the sampling
+    rate and whether travel times are relative to the first station.
+    '''
+
+    description = {'x': np.asarray(gridx, dtype = np.float64)[0].tolist(),
+                   'y': np.asarray(gridy, dtype = np.float64)[:, 0].tolist(),
+                   'station_positions': [[float(value) for value in position[:2]] for position in station_positions],
+                   'velocity': float(velocity),
+                   'sampling_rate': sampling_rate,
+                   'relative': relative}
+
+    return hashlib.sha1(json.dumps(description, sort_keys = True).encode()).hexdigest()[:16]
+
+
+
+
+def calculate_travel_times(gridx, gridy, station_positions, velocity, relative = False):
+
+    '''
+    Travel times from every grid cell to every station, with shape
+    (rows, columns, stations) indexed like the grid. If relative, travel
+    times are relative to the first station.
+    '''
+
+    station_positions = np.asarray([position[:2] for position in station_positions], dtype = np.float64)
+
+    distances = np.sqrt((station_positions[:, 0] - np.asarray(gridx, dtype = np.float64)[:, :, np.newaxis])**2 +
+                        (station_positions[:, 1] - np.asarray(gridy, dtype = np.float64)[:, :, np.newaxis])**2)
+
+    travel_times = distances / velocity
+
+    if relative == True:
+
+        travel_times -= travel_times[:, :, :1]
+
+    return travel_times
+
+
+
+
+def save_table(table, table_file):
+
+    '''
+    Save a table, replacing any existing file only once it is complete
+    so concurrent runs never load a partial table.
+    '''
+
+    with open(table_file + '.part', 'wb') as openfile:
+        np.save(openfile, table)
+
+    os.replace(table_file + '.part', table_file)
+
+
+
+
+def travel_time_table(gridx, gridy, station_positions, velocity, sampling_rate = None,
+                      relative = False, cache_directory = None):
+
+    '''
+    Load (or calculate and cache) the travel times of every grid cell to
+    every station, and if a sampling rate is given the corresponding
+    integer sample shifts. Both have shape (rows, columns, stations) and
+    are indexed like the grid. Cached tables are memory-mapped read-only.
+    Without a cache directory the tables are calculated in memory.
+    Returns the travel times and sample shifts (None without a sampling rate).
+    '''
+
+    if cache_directory is None:
+
+        travel_times = calculate_travel_times(gridx, gridy, station_positions, velocity, relative)
+        sample_shifts = None
+
+        if sampling_rate is not None:
+
+            sample_shifts = np.round(travel_times * sampling_rate).astype(np.int64)
+
+        return travel_times, sample_shifts
+
+    if not os.path.exists(cache_directory):
+
+        os.makedirs(cache_directory)
+
+    key = table_key(gridx, gridy, station_positions, velocity, sampling_rate, relative)
+    travel_time_file = os.path.join(cache_directory, key + '_travel_times.npy')
+    shift_file = os.path.join(cache_directory, key + '_sample_shifts.npy')
+
+    if not os.path.exists(travel_time_file):
+
+        print('Calculating travel time table ' + key)
+
+        travel_times = calculate_travel_times(gridx, gridy, station_positions, velocity, relative)
+        save_table(travel_times, travel_time_file)
+
+        if sampling_rate is not None:
+
+            save_table(np.round(travel_times * sampling_rate).astype(np.int64), shift_file)
+
+    travel_times = np.load(travel_time_file, mmap_mode = 'r')
+    sample_shifts = None
+
+    if sampling_rate is not None:
+
+        if not os.path.exists(shift_file):
+
+            save_table(np.round(np.asarray(travel_times) * sampling_rate).astype(np.int64), shift_file)
+
+        sample_shifts = np.load(shift_file, mmap_mode = 'r')
+
+    return travel_times, sample_shifts
@@ -86,14 +86,18 @@ def matlab2datetime(matlab_datenum):
 
 
 #def GPS_parse(GPS_in, GPS_vel, GPS_vel_time, start_date, end_date):
-def GPS_parse(GPS_in, GPS_vdat, start_date, end_date):
+def GPS_parse(GPS_in, GPS_vdat, start_date, end_date, forcing_directory=None):
     # parse the geodetic data for input into trigger statistics
+    # with a forcing_directory the files are parsed once into a forcing store there and windows are sliced from it
     
-    import datetime
-    import math
-    import csv
-    import pylab as pl
-    import numpy as np
+    from environmental_data import read_gnss_positions, read_gnss_velocities, gnss_position_window, gnss_velocity_window
+    
+    if forcing_directory is not None:
+        from forcing_store import forcing_store
+        store=forcing_store(forcing_directory,gnss_positions=[GPS for GPS in GPS_in if GPS!=[]],gnss_velocities=GPS_vdat)
+    
+    # read positions within the date window (one row of E, N, U per time,
+    # with times in decimal julian days)
     
     GPS_out=[[] for GPS in range(len(GPS_in))]
     GPS_time=[[] for GPS in range(len(GPS_in))]
@@ -101,34 +105,10 @@ def GPS_parse(GPS_in, GPS_vdat, start_date, end_date):
     for GPS in GPS_in:
         if GPS==[]: continue
         g+=1
-        with open(GPS) as ssv:
-            l=-1
-            for line in ssv:
-                n=0
-                l+=1
-                lineout=[]
-                flineout=[[],[],[]] # extracts only position data
-                for i in range(int(len(line)/25)):
-                    if i==0:
-                        time=float(line[3:25])
-                        [odtime, stime]=[int(math.floor(time/86400.0))-366, time-86400*(int(math.floor(time/86400.0)))]
-                        jdate=((datetime.datetime.fromordinal(odtime)).timetuple()).tm_yday
-                        timefull=str(jdate)+'.'+str(stime/86400.0)[2:] #dec julian days
-                        if jdate<start_date: 
-                            n=1
-                            break
-                        if jdate>end_date: 
-                            n=1
-                            break
-                    else:
-                        pass
-                    i*=25
-                    lineout.append(float(line[3+i:25+i]))
-                if n==1: continue
-                timeout=timefull
-                [flineout[0], flineout[1], flineout[2]]=[lineout[1], lineout[2], lineout[3]] # just take positions
-                GPS_out[g].append(flineout)
-                GPS_time[g].append(float(timeout))
+        if forcing_directory is not None:
+            GPS_time[g], GPS_out[g] = gnss_position_window(store['samples']['gnss_positions_'+str(g)], start_date, end_date)
+        else:
+            GPS_time[g], GPS_out[g] = read_gnss_positions(GPS, start_date, end_date)
 
     # get velocity value and time
     
@@ -139,25 +119,10 @@ def GPS_parse(GPS_in, GPS_vdat, start_date, end_date):
     g=-1
     for GPS in GPS_vdat:
         g+=1
-        # from HJH
-        v_data=np.genfromtxt(GPS,dtype=None,names=['time','v','vmin','vmax'])
-        vel_mdatenum=v_data['time']/86400.0
-        vel_pdatenum_obj=[matlab2datetime(ii) for ii in vel_mdatenum]
-        vel_pdatenum=[datetime.datetime.strftime(ii,'%Y-%m-%d %H:%M:%S') for ii in vel_pdatenum_obj]
-        vdatenum=(pl.datestr2num(vel_pdatenum))
-        v = v_data['v']*86400.0
-#        vmin = v_data['vmin']*86400.0
-#        vmax = v_data['vmax']*86400.0
-        # now shape it into my format...
-        for day in range(len(vdatenum)):
-            [odtime, stime]=[int(vdatenum[day]), (vdatenum[day]-(int(vdatenum[day])))]#*86400.0]
-            jdate=((datetime.datetime.fromordinal(odtime)).timetuple()).tm_yday
-            if jdate<start_date: continue
-            if jdate>end_date: continue
-            GPS_vel_time_out[g].append(float(str(jdate)+'.'+str(stime)[2:]))
-            GPS_vel_out[g].append(float(v[day]))
-            GPS_vel_unc[g].append(86400.0*abs(v_data['vmax'][day]-v_data['vmin'][day])/2)
-            GPS_rel_unc[g].append(100*GPS_vel_unc[g][-1]/float(GPS_vel_out[g][-1]))
+        if forcing_directory is not None:
+            GPS_vel_time_out[g], GPS_vel_out[g], GPS_vel_unc[g], GPS_rel_unc[g] = gnss_velocity_window(store['samples']['gnss_velocities_'+str(g)], start_date, end_date)
+        else:
+            GPS_vel_time_out[g], GPS_vel_out[g], GPS_vel_unc[g], GPS_rel_unc[g] = read_gnss_velocities(GPS, start_date, end_date)
                 
     # GPS vel is horizontal velocity to ~ 90% confidence
         
@@ -166,27 +131,36 @@ def GPS_parse(GPS_in, GPS_vdat, start_date, end_date):
 
 
 
-def lake_level(lake_level_data, year, start_date, end_date):
+def lake_level(lake_level_data, year, start_date, end_date, forcing_directory=None):
 
     import numpy as np
     import datetime
     import csv
     
     # get lake level data into format and timeseries window
+    # with a forcing_directory the file is parsed once into a forcing store there and the window is sliced from it
     
     lakedata=[]
     laketime=[]
-    with open(lake_level_data) as csvfile:
-        for line in csv.reader(csvfile):
-            [time, level] = [line[0], line[3]]
-            time=datetime.datetime.strptime(time,'%Y-%m-%d %H:%M:%S')
-            jday=(time.timetuple()).tm_yday
-            if time.timetuple()[0]!=year: continue
-            if jday<start_date: continue
-            if jday>end_date: continue
-            hour=(time.timetuple()[3]+time.timetuple()[4]/60.0+time.timetuple()[5]/3600.0) # add in /24.0 for not binning
-            lakedata.append(float(level))
-            laketime.append(str(jday)+'.'+str(hour)) # add in [2:] for hour if not binning
+    if forcing_directory is not None:
+        from forcing_store import forcing_store
+        from environmental_data import lake_level_window
+        store=forcing_store(forcing_directory,lake_level=lake_level_data)
+        jdays,hours,levels=lake_level_window(store['samples']['lake_level'],year,start_date,end_date)
+        lakedata=levels.tolist()
+        laketime=[str(jday)+'.'+str(hour) for jday,hour in zip(jdays.tolist(),hours.tolist())]
+    else:
+        with open(lake_level_data) as csvfile:
+            for line in csv.reader(csvfile):
+                [time, level] = [line[0], line[3]]
+                time=datetime.datetime.strptime(time,'%Y-%m-%d %H:%M:%S')
+                jday=(time.timetuple()).tm_yday
+                if time.timetuple()[0]!=year: continue
+                if jday<start_date: continue
+                if jday>end_date: continue
+                hour=(time.timetuple()[3]+time.timetuple()[4]/60.0+time.timetuple()[5]/3600.0) # add in /24.0 for not binning
+                lakedata.append(float(level))
+                laketime.append(str(jday)+'.'+str(hour)) # add in [2:] for hour if not binning
             
     # bin into hour
     hlast=0 # assume it begins at 0 hour
@@ -302,24 +276,19 @@ def backwards_difference(y,delx):
     ### Takes a single function value and finds its first derivative using the backwards difference
     ### Specify the function (y) and the spacing between its indendent variable (delx)
     
-    dy=[]
-    c=1
-    dy.append(0) #there is no derivative at the first value
-    for value in y:
-        dy.append((y[c]-y[c-1])/delx) #calculates the backwards difference at every x
-        c+=1
-        if c==len(y):
-            break
-    return dy
+    from series_kernels import backward_difference
+    
+    return backward_difference(y,delx).tolist() #there is no derivative at the first value (0)
         
     
     
     
-def chosen_rainfall(start_date,end_date,year,rainfall_times,rainfall_data):
+def chosen_rainfall(start_date,end_date,year,rainfall_times,rainfall_data,forcing_directory=None):
     ### Takes two .csv files (tab delimited) of hours in days (ordinal, here taken as the MATLAB format, and in UTC time)
     ### -> save('temp_data','temp','-ascii','-double','-tabs') is the MATLAB command <-
     ### and hourly mm precipitation of rainfall and converts it into two variables: julian dates.hours for the window and the data within the window
     ### NOTE: the .hours is trimmed to the 7th index for funcitonality with other scripts - minimal data is lost
+    ### NOTE: with a forcing_directory the rainfall is parsed once into an hourly forcing store there and windows are sliced from it
 
     import csv
     import datetime
@@ -328,6 +297,27 @@ def chosen_rainfall(start_date,end_date,year,rainfall_times,rainfall_data):
     import numpy as np
     import matplotlib.pyplot as plt
     
+    if forcing_directory is not None:
+        from forcing_store import forcing_store, forcing_window
+        
+        # take the window and the day before it (for the first daily sum) from the store
+        
+        store=forcing_store(forcing_directory,rainfall=(rainfall_times,rainfall_data))
+        dec_days,window=forcing_window(store,year,start_date-1,end_date,['rainfall'])
+        num_hours=24*(end_date-start_date+1)
+        
+        julian_rain_dec_days=[float("{0:.8f}".format(day)) for day in dec_days[24:]]
+        trimmed_rainfall_data=window['rainfall'][24:].tolist()
+        total_mm=np.nansum(window['rainfall'][24:])
+        print('Total mm of rainfall during the chosen period is '+str(total_mm)+' mm.')
+        
+        # daily rainfall records the rainfall for the day preceeding (01:00 to 24:00)
+        
+        odrain_jdays=list(range(start_date,end_date+1))
+        drain=np.nansum(window['rainfall'][1:num_hours+1].reshape(-1,24),axis=1).tolist()
+        
+        return julian_rain_dec_days,trimmed_rainfall_data, odrain_jdays, drain
+    
     csv.field_size_limit(sys.maxsize)
     
     # parse rainfall data
@@ -456,9 +446,17 @@ def diurnal_event_statistics(start_date,end_date,event_directory,delay_time):
     
     files=[]
             
-    # load in files
+    # load in files (event names from the event catalogue if there is one)
+    
+    from event_catalogue import find_catalogue, open_catalogue, event_file_index
     
-    files=os.listdir(event_directory)
+    catalogue_file=find_catalogue(event_directory)
+    if catalogue_file is not None:
+        catalogue=open_catalogue(catalogue_file)
+        files=list(event_file_index(catalogue))
+        catalogue.close()
+    else:
+        files=os.listdir(event_directory)
     files.sort()
 
     # only allow .MSEED files to be in the event list    
@@ -602,12 +600,13 @@ def time_reconciler(hourly_event_sum,hourly_event_hours,dec_julian_days,start_da
     #(or just all decimal julian days for the window length)
     
     hourly_event_sum_all_hours=[0]*(((end_date-start_date)*24)+24)
+    day_index=dict([(day,d) for d,day in enumerate(dec_julian_days)]) # position of each decimal julian day
     h_in_d=0
     i=0 #index counter
     for h in hourly_event_hours:
         if float(h)>end_date: break
         h=float("{0:.8f}".format(float(h)))#[:9] #trim string
-        h_in_d=dec_julian_days.index(h)
+        h_in_d=day_index[h]
         hourly_event_sum_all_hours[h_in_d]=hourly_event_sum[i]
         i+=1
 
@@ -620,135 +619,62 @@ def time_reconciler(hourly_event_sum,hourly_event_hours,dec_julian_days,start_da
 def event_counter(start_date,end_date,event_directory,delay_time):
     ### Takes event names in a directory and counts the total number on a given day (for a single year)
     
-    import datetime
     import os
-    from obspy import UTCDateTime
     import numpy as np
-    import matplotlib.pyplot as plt
-    import math
+    from event_rates import event_name_times, decluster, day_of_year, hour_ending
     
     #import and organise event "meta"data and strip event dates and hours from it    
-    
-    #prepares empty lists for later appending
-    
-    files=[]
-    ttimes=[]
             
-    # load in files
+    # load in files (event names from the event catalogue if there is one)
+    
+    from event_catalogue import find_catalogue, open_catalogue, event_file_index
     
-    files=os.listdir(event_directory)
+    catalogue_file=find_catalogue(event_directory)
+    if catalogue_file is not None:
+        catalogue=open_catalogue(catalogue_file)
+        files=list(event_file_index(catalogue))
+        catalogue.close()
+    else:
+        files=os.listdir(event_directory)
     files.sort()
 
-    # only allow .MSEED files to be in the event list    
+    # only allow .MSEED files with a parseable event time to be in the event list    
     
-    i=0
-    for e in range(len(files)):
-        try:
-            if files[i][-6:]=='.MSEED':
-                i+=1
-            else:
-                files.pop(files.index(files[i]))
-        except:
-            files.pop(files.index(files[i]))
+    files=np.array([f for f in files if f[-6:]=='.MSEED'],dtype=str)
+    times,parsed=event_name_times(files)
+    files=files[parsed]
+    times=times[parsed]
     
     #removes successive events (stops statistical skewing due to many triggers for one long event)
-    s=1 #successor counter
-    n=0 #index counter
-    r=0 #count number of entries removed
-    for i,j in zip(files,files[1:]): #for current and next entry in zip
-        try: 
-            if s==1:
-                first_event_time=UTCDateTime(i[:-7])
-                second_event_time=UTCDateTime(j[:-7])
-            elif s>1:
-                second_event_time=UTCDateTime(j[:-7])
-    
-            if (first_event_time+delay_time)>=second_event_time:
-                files.pop(n+1) #remove the successor
-                first_event_time=second_event_time #adapt the remover event time to make it the same as the first
-                s+=1
-            else:
-                s=1
-                n+=1
-            r+=1
-        except:
-            pass
-        
-    popped=0
-    flast=0
-    for f in range(len(files)): #strips file names of their days and hours
-       if popped==1: f=flast # backshift due to a lost index
-       if f==len(files): break # this loop is complete - force exit
-       popped=0
-       event_file=files[f]
-              
-       try:
-            date=datetime.datetime.strptime(event_file[:10],'%Y-%m-%d')
-            datett=date.timetuple()
-            jdate=datett.tm_yday
-            
-            # only load data up to the end date
-            if jdate<start_date:
-                files.pop(files.index(event_file))
-                popped=1
-                flast=f # necessary reset to override the for loop indexing ( a differently named variable would probably be better! )
-                continue
-            elif jdate>end_date:
-                files.pop(files.index(event_file))
-                popped=1
-                flast=f
-                continue 
-
-            #events binned by the hour following...
-            hour=math.ceil(float(event_file[11:13])+(float(event_file[14:16]))/60+(float(event_file[17:26]))/3600)
-            hour=(float(hour)/24) #convert hours into decimal days
-            ttimes=np.append(ttimes,str((float(jdate)+hour))) #special event time format for hourly events (format: julian_date.hour)
-       except:
-            #print('I do not think that is a event file.')
-            continue #otherwise ignore it
-    ttimes=np.sort(ttimes)  
-    ttimes_all=ttimes # all event times ...
-    ttimes_unique=np.unique(ttimes) #collapses array into days.hours 
-
-    #put all event times through an indexing routine to count the number of events in a given hour       
-       
-    idates=range((end_date-start_date+1)) #establishes index days
-    ihours=range(24)
-    numtrigdhr=0 #initialise
-    events_per_hour=np.zeros(len(ttimes_unique)) #a list of zeros corresponding to the index days and their hours
-
-    for entry in ttimes: #looks at each day.hour in the list of julian dates and hours taken from files
-        if numtrigdhr>1: #skip the events that have been removed (but haven't in the iterator)
-            numtrigdhr-=1
-            continue
-            
-        m=0 #event match off
-        date=int(entry[:3]) #reiterates date every time the inner loop(s) finishes, same for hour
-        hour=int(round((float(entry[3:]))*24)) #reinflate hour (0-23)
-        d=0 #clear day count
-        h=0 #clear hour count
-        
-        for idate in idates: #look through all index dates
-            idate+=start_date #set each index date into the date window of interest
-            if date==idate: #if the date from the event file matches the index date
-                for ihour in ihours: #then look at all index hours
-                
-                    if hour==ihour: #if the hour from the event file matches the index hour
-                        dh=np.where(ttimes_unique==(str(date)+entry[3:]))[0]
-                        dhr=np.where(ttimes==(str(date)+entry[3:]))[0]
-                        numtrigdhr=len(dhr)
-                        events_per_hour[dh]+=len(dhr) #then increment the number of events at the index position representing the given date and hour from the event file
-                        ttimes=np.delete(ttimes,dhr) #then remove that value - it has been found
-                        m=1 #event match on
-                        break #match found - now look at the next entry
-                    else:
-                        h+=1 #otherwise increment the hour counter and check the next hour                    
-                if m==1:
-                    break #continue the break
-            else:
-                d+=1 #otherwise increment the day counter and check the next day
-        if m==1:
-            continue #finish the break
+    #NOTE: an event is removed if it is within delay_time of the event before it, removed or not
+    keep=decluster(times,delay_time)
+    files=files[keep]
+    times=times[keep]
+    
+    # only keep events from the start date to the end date
+    jdates=day_of_year(times)[0]
+    window=(jdates>=start_date)&(jdates<=end_date)
+    files=files[window].tolist()
+    jdates=jdates[window]
+    
+    #events binned by the hour following, as decimal days (format: julian_date.hour)
+    #NOTE: events in the last hour of a day fall into hour 0 of the next day
+    hour_bins=24*jdates+hour_ending(times[window])
+    ttimes_all=hour_bins//24+(hour_bins%24)/24.0 # all event times ...
+    
+    #count the number of events in each hour with events
+    if len(hour_bins)>0:
+        first_bin=hour_bins.min()
+        bin_counts=np.bincount(hour_bins-first_bin)
+        occupied_bins=np.flatnonzero(bin_counts)
+        events_per_hour=bin_counts[occupied_bins].astype(float)
+        occupied_bins+=first_bin
+        # hours past the end date are not counted
+        events_per_hour[occupied_bins//24>end_date]=0
+        ttimes_unique=occupied_bins//24+(occupied_bins%24)/24.0 #collapses array into days.hours 
+    else:
+        events_per_hour=np.zeros(0)
+        ttimes_unique=np.zeros(0)
             
     #sub-routine to count the total number of events in the events_per_hour file (QC)        
     
@@ -763,32 +689,14 @@ def event_counter(start_date,end_date,event_directory,delay_time):
 def smooth_data(data,symmetric_smooth_range):
     # smooth data by taking a running mean from a data point out to the data 1/2 the smooth range away
     # NOTE: the symmetric_smooth_range must be even - it is the number of data points to sample on either side of the central data
-    import numpy as np
-    smooth_data=[0 for x in range(len(data))] 
-    for smooth_cen in range(len(data)):
-        missing=0
-        smooth_cen+=symmetric_smooth_range # skip to the first viable option (and so on)
-        if smooth_cen==len(data)-symmetric_smooth_range: break # leave before the smoothing fails
-        if str(data[smooth_cen])!='nan':
-            s=data[smooth_cen] # data sum (starting with central data point)
-        else:
-            s=0
-            missing=1
-        for r in range(symmetric_smooth_range): # look at data on either side of the central data point
-            # add this data to the sum
-            if str(data[smooth_cen-r])!='nan':
-                s+=data[smooth_cen-r]
-            else:
-                missing+=1
-            if str(data[smooth_cen+r])!='nan':
-                s+=data[smooth_cen+r]
-            else:
-                missing+=1
-        # append the mean to the smoothed data list
-        try:
-            smooth_data[smooth_cen]=(s/(2*symmetric_smooth_range+1-missing))
-        except:
-            smooth_data[smooth_cen]=np.nan
+    # NOTE: as before, the central data point is counted three times and the window reaches
+    # symmetric_smooth_range-1 data points either side of it, skipping nans
+    from series_kernels import nan_running_mean
+    if symmetric_smooth_range<1: return [float(x) for x in data]
+    smooth_data=nan_running_mean(data,symmetric_smooth_range-1,centre_weight=3).tolist()
+    # leave the data too close to either end as 0
+    for smooth_cen in list(range(symmetric_smooth_range))+list(range(len(data)-symmetric_smooth_range,len(data))):
+        if 0<=smooth_cen<len(data): smooth_data[smooth_cen]=0
     
     return smooth_data
             
@@ -797,19 +705,13 @@ def smooth_data(data,symmetric_smooth_range):
         
 def central_difference(u,dx):
     # find the first and second derivatives using the central difference
+    # (central difference is not defined for start or end point, which are left as 0)
     
-    du=[]
-    d2u=[]
-    for j in range(len(u)):
-        if j==0 or j==(len(u)-1): #central difference is not defined for start or end point
-            du.append(0) #no data value
-            d2u.append(0) #no data value
-            continue
-        else:
-            du.append(((u[j+1]-u[j-1])/(2*dx))) #defined as the absolute value to make later computation easier
-            d2u.append((u[j+1]-(2*u[j])+u[j-1])/(dx**2))
+    from series_kernels import central_difference as central_difference_kernel
+    
+    du,d2u=central_difference_kernel(u,dx)
             
-    return du,d2u
+    return du.tolist(),d2u.tolist()
 
 
 
@@ -817,20 +719,9 @@ def accumulate_data(events_per_hour):
     
     # calculate cumulture event # at hourly resolution
     
-    c=1
-    count=1
-    cumulative_events=[]
-    cumulative_events.append(events_per_hour[0]) #pre-set the first entry so subsequent entries can add it to their value
-    for entry in events_per_hour: #look at every entry in the list of event counts per hour
-        cumulative_events.append(events_per_hour[c]+cumulative_events[c-1]) #add the event count for a given hour to all of those preceeding
-        c+=1 #increment the position in the list
-        if c==len(events_per_hour): #when the index reaches the end of the list terminate the loop
-            break
-        count+=events_per_hour[c] #increment the number of events by the number in that hour
-    
-    return cumulative_events
-    
+    from series_kernels import cumulative_counts
     
+    return cumulative_counts(events_per_hour).tolist()
     
     
 def accumulate_events(filenames):
@@ -871,249 +762,166 @@ def roundtocell(x, cellsize):
     
 def xcorrlag(dat1,dat2,spacing):
     #HJH code
-    import numpy as np
+    from series_kernels import lagged_xcorr
     # time series at equal spacing
     # INPUTS    dat1 time series 1
     #           dat2 time series 2
     #           spacing dt (must be equal)
-
-    cc = np.correlate(dat1,dat2,"full")
-    
-    breaker=0
-    for entry in cc:
-        if str(entry)=='nan':
-            breaker=1
-            break
-    if breaker==1: return np.nan, np.nan
-    
-#    print cc
-#    print len(cc)
-    maxcorr = max(cc)
-    mi = [i for i, j in enumerate(cc) if j == maxcorr] # max index
     # zero lag at len(dat1) (if both vectors same length)
     # len(cc) = len(dat1)+len(dat2)-1 when cc "full"
-    # max correlation
-    
-#    lagtime=mi[0] # number of samples from the start of the window
-    
-#    if ccmode == "rain":
-    lagtime=(len(dat1)-mi[0]-1) # in hours
-#    elif ccmode == "lake":
-#        lagtime=spacing*(len(lakei)-mi[0]-1)
+    # returns lag (in samples, i.e. hours for hourly data) and max correlation,
+    # or nans if either series has nans
 
-    return lagtime, maxcorr
+    return lagged_xcorr(dat1,dat2)
 
 
 
 
-def drainage_model(outdir, start_date,end_date,rainfall_times, rainfall_data, crevassing_times, crevassing_rate):
+def drainage_model(outdir, start_date,end_date,rainfall_times, rainfall_data, crevassing_times, crevassing_rate, plot_models='best'):
     
     import matplotlib.pyplot as plt
     import numpy as np
     
+    from storage_model import fit_drainage, simulate_drainage
+    
     # model that tries to match rising crevassing peaks with parameters
     # simple version assumes infinite storage maxima over time
     # and that the glacial drainage system cannot overflow into the crevasse
     
     # drainage rate is in mm/hr:
-        
-    Do_S_all=[[] for x in np.linspace(0.1,2,20)]
-    b_S_all=[[] for x in np.linspace(0.01,0.25,25)]
-    a_S_all=[[] for x in np.linspace(0.01,0.25,25)]
-    
-    Do_D_all=[[] for x in np.linspace(0.1,2,20)]
-    b_D_all=[[] for x in np.linspace(0.01,0.25,25)]
-    a_D_all=[[] for x in np.linspace(0.01,0.25,25)]
-    
-    di=-1
-    for Do in np.linspace(0.1,2,20):
-        di+=1
-        ai=-1
-        for a in np.linspace(0.01,0.25,25):
-            ai+=1
-            bi=-1
-            for b in np.linspace(0.01,0.25,25):
-                bi+=1
-                print('Model parameters are: '+str(Do)+' , '+str(a)+' , '+str(b))
-                # initialise model:
-                I=0 # current input
-                D=0 # current drainage
-                S=0 # current storage
-                Sl=0 # previous storage
-                Dmax=Do # current drainage maxima
-                
-                # calculate storage over all times:
-                S_all=[0 for x in range(len(rainfall_times))]
-                D_all=[0 for x in range(len(rainfall_times))]
-                for t in range(len(rainfall_times)):
-                    I=rainfall_data[t] # input is rainfall
-                    # calculate drainage
-                    if I<Dmax: # rain rate is less than drainage rate
-                        if Sl==0: # there is no storage
-                            D=I
-                        elif Sl>=(Dmax-I): # storage is sufficient to fill to maximum
-                            Ds=Dmax-I
-                            D=I+Ds
-                        elif Sl<(Dmax-I): # storage is insufficient "
-                            Ds=Sl
-                            D=I+Ds
-                    elif I>=Dmax: # rain rate is more than drainage rate
-                        D=Dmax
-                    # calculate storage
-                    S=Sl+I-D
-                    S_all[t]=S # register this to a time
-                    D_all[t]=Dmax
-                    # now save the storage and drainage maxima to last time step
-                    Sl=S
-                    Dmaxl=Dmax
-                    # adjust the drainage maxima
-                    if (Dmaxl+a*D-b*Dmaxl)>Do:
-                        Dmax=Dmaxl+a*D-b*Dmaxl
-                    else:
-                        Dmax=Do
-        
-                b_S_all[bi]=S_all
-                b_D_all[bi]=D_all
-            a_S_all[ai]=b_S_all
-            a_D_all[ai]=b_D_all
-        Do_S_all[di]=a_S_all
-        Do_D_all[di]=a_D_all
-
-    # now compare all storage to the crevassing rate
-    
-    # find storage maximum for consistent plotting
-    all_storage=[]
-    for s1 in Do_S_all:
-        for s2 in s1:
-            for s3 in s2:
-                all_storage=all_storage+s3
-    s_t_max=max(all_storage)
-    
-    all_drainage=[]
-    for d1 in Do_D_all:
-        for d2 in d1:
-            for d3 in d2:
-                all_drainage=all_drainage+d3
-    d_t_max=max(all_drainage)
     
     # reference lists for titles etc.
         
     a_all=np.linspace(0.01,0.25,25)
     b_all=np.linspace(0.01,0.25,25)
     d_all=np.linspace(0.1,2,20)
+    
+    # run the model for all (Do, a, b) together and score each parameter set
+    # by the correlation between its storage and the crevassing rate
+    
+    fit_surface,s_t_max,d_t_max=fit_drainage(rainfall_data,crevassing_rate,d_all[:,None,None],a_all[None,:,None],b_all[None,None,:])
+    
+    np.save(outdir+'/STORAGE/fit_surface.npy',fit_surface)
+    
+    if np.all(np.isnan(fit_surface)):
+        best_fit=None
+        print('No model storage correlates with the crevassing rate')
+    else:
+        best_fit=np.unravel_index(np.nanargmax(fit_surface),fit_surface.shape)
+        print('Best fit model parameters are: '+str(d_all[best_fit[0]])+' , '+str(a_all[best_fit[1]])+' , '+str(b_all[best_fit[2]])+
+              ' (correlation '+str(fit_surface[best_fit])+')')
+    
+    # plot the best fit model, or all models ('all') for manual comparison
+    
+    if plot_models=='all':
+        plot_sets=[(di,ai,bi) for di in range(len(d_all)) for ai in range(len(a_all)) for bi in range(len(b_all))]
+    elif (plot_models=='best') and (best_fit is not None):
+        plot_sets=[best_fit]
+    else:
+        plot_sets=[]
                 
-    di=-1
-    for Do_S_t in Do_S_all:
-        di+=1
-        Do_D_t=Do_D_all[di]
-        ai=-1
-        for a_S_t in Do_S_t:
-            ai+=1
-            a_D_t=Do_D_t[ai]
-            bi=-1
-            for S_t in a_S_t:
-                bi+=1
-                b_D_t=a_D_t[bi]
-                print('Model parameters for this plot are: '+str(d_all[di])+' , '+str(a_all[ai])+' , '+str(b_all[bi]))
-                
-                # this is super crude, but literally just plot them for manual comparison
-                rain_major_ticks=np.arange(0,roundtocell(int(max(rainfall_data)),5),5)
-                rain_minor_ticks=np.arange(0,roundtocell(int(max(rainfall_data)),5),1)
-                drainage_major_ticks=np.arange(0,roundtocell(int(d_t_max),20),20)
-                drainage_minor_ticks=np.arange(0,roundtocell(int(d_t_max),20),10)
-                storage_major_ticks=np.arange(0,roundtocell(int(s_t_max),20),20)
-                storage_minor_ticks=np.arange(0,roundtocell(int(s_t_max),20),10)
-                events_major_ticks=np.arange(0,roundtocell(max(crevassing_rate),5)+5,5)
-                events_minor_ticks=np.arange(0,roundtocell(max(crevassing_rate),5)+5,1)
-                decimal_days_major_ticks=np.arange(start_date,end_date,1)
-                decimal_days_minor_ticks=np.arange(start_date,end_date,24)
+    for di,ai,bi in plot_sets:
+        S_t,b_D_t=simulate_drainage(rainfall_data,d_all[di],a_all[ai],b_all[bi])
+        print('Model parameters for this plot are: '+str(d_all[di])+' , '+str(a_all[ai])+' , '+str(b_all[bi]))
+        
+        # this is super crude, but literally just plot them for manual comparison
+        rain_major_ticks=np.arange(0,roundtocell(int(max(rainfall_data)),5),5)
+        rain_minor_ticks=np.arange(0,roundtocell(int(max(rainfall_data)),5),1)
+        drainage_major_ticks=np.arange(0,roundtocell(int(d_t_max),20),20)
+        drainage_minor_ticks=np.arange(0,roundtocell(int(d_t_max),20),10)
+        storage_major_ticks=np.arange(0,roundtocell(int(s_t_max),20),20)
+        storage_minor_ticks=np.arange(0,roundtocell(int(s_t_max),20),10)
+        events_major_ticks=np.arange(0,roundtocell(max(crevassing_rate),5)+5,5)
+        events_minor_ticks=np.arange(0,roundtocell(max(crevassing_rate),5)+5,1)
+        decimal_days_major_ticks=np.arange(start_date,end_date,1)
+        decimal_days_minor_ticks=np.arange(start_date,end_date,24)
             
-                #plotting...
+        #plotting...
         #        bar_width=0.2 # use this for all-time plot
-                bar_width=0.02 # use this for zooming in
-                line_width=1
-                
-                plt.figure(figsize=(11.69,8.27))
-                plt.subplot(411)
-                ax1=plt.gca() 
-                
-                ax1.bar(rainfall_times,rainfall_data,color='b',width=bar_width,lw=line_width)
-                ax1.set_ylabel('Rain Rate\n(mm $hr^-1$)',fontsize=10, labelpad=25)
-                ax1.set_xticks(decimal_days_major_ticks)
-                ax1.set_xticks(decimal_days_minor_ticks,minor='True')
-                ax1.set_xlim(start_date,end_date)
-                ax1.set_yticks(rain_major_ticks)
-                ax1.set_yticks(rain_minor_ticks,minor='True')
-                ax1.set_ylim(0,roundtocell(max(rainfall_data),5))
-                ax1.tick_params(axis='both',which='major',labelsize=10)
-                ax1.tick_params(axis='x',which='minor',labelsize=None)
-                ax1.get_yaxis().set_label_coords(-0.06,0.5)
-                ax1.grid(which='major',alpha=0.5)
-                ax1.grid(which='minor',alpha=0.25)
-                
-                plt.subplot(412, sharex=ax1)
-                ax2=plt.gca()
-                
-                ax2.bar(rainfall_times,b_D_t,color='green',width=bar_width,lw=line_width)
-                ax2.set_ylabel('Drainage Rate\n(mm $hr^-1$)',fontsize=10, labelpad=25)
-                ax2.set_xticks(decimal_days_major_ticks)
-                ax2.set_xticks(decimal_days_minor_ticks,minor='True')
-                ax2.set_xlim(start_date,end_date)
-                ax2.set_yticks(drainage_major_ticks)
-                ax2.set_yticks(drainage_minor_ticks,minor='True')
-                ax2.set_ylim(0,roundtocell(int(d_t_max),20))
-                ax2.tick_params(axis='both',which='major',labelsize=10)
-                ax2.tick_params(axis='x',which='minor',labelsize=None)
-                ax2.get_yaxis().set_label_coords(-0.06,0.5)
-                ax2.grid(which='major',alpha=0.5)
-                ax2.grid(which='minor',alpha=0.25)
-                
-                plt.subplot(413, sharex=ax1)
-                ax3=plt.gca()
-                
-                ax3.bar(rainfall_times,S_t,color='purple',width=bar_width,lw=line_width)
-                ax3.set_ylabel('Storage\n(mm)',fontsize=10, labelpad=25)
-                ax3.set_xticks(decimal_days_major_ticks)
-                ax3.set_xticks(decimal_days_minor_ticks,minor='True')
-                ax3.set_xlim(start_date,end_date)
-                ax3.set_yticks(storage_major_ticks)
-                ax3.set_yticks(storage_minor_ticks,minor='True')
-                ax3.set_ylim(0,roundtocell(s_t_max,20))
-                ax3.tick_params(axis='both',which='major',labelsize=10)
-                ax3.tick_params(axis='x',which='minor',labelsize=None)
-                ax3.get_yaxis().set_label_coords(-0.06,0.5)
-                ax3.grid(which='major',alpha=0.5)
-                ax3.grid(which='minor',alpha=0.25)
-                
-                plt.subplot(414, sharex=ax1)
-                ax4=plt.gca()
-                
+        bar_width=0.02 # use this for zooming in
+        line_width=1
+        
+        plt.figure(figsize=(11.69,8.27))
+        plt.subplot(411)
+        ax1=plt.gca() 
+        
+        ax1.bar(rainfall_times,rainfall_data,color='b',width=bar_width,lw=line_width)
+        ax1.set_ylabel('Rain Rate\n(mm $hr^-1$)',fontsize=10, labelpad=25)
+        ax1.set_xticks(decimal_days_major_ticks)
+        ax1.set_xticks(decimal_days_minor_ticks,minor='True')
+        ax1.set_xlim(start_date,end_date)
+        ax1.set_yticks(rain_major_ticks)
+        ax1.set_yticks(rain_minor_ticks,minor='True')
+        ax1.set_ylim(0,roundtocell(max(rainfall_data),5))
+        ax1.tick_params(axis='both',which='major',labelsize=10)
+        ax1.tick_params(axis='x',which='minor',labelsize=None)
+        ax1.get_yaxis().set_label_coords(-0.06,0.5)
+        ax1.grid(which='major',alpha=0.5)
+        ax1.grid(which='minor',alpha=0.25)
+        
+        plt.subplot(412, sharex=ax1)
+        ax2=plt.gca()
+        
+        ax2.bar(rainfall_times,b_D_t,color='green',width=bar_width,lw=line_width)
+        ax2.set_ylabel('Drainage Rate\n(mm $hr^-1$)',fontsize=10, labelpad=25)
+        ax2.set_xticks(decimal_days_major_ticks)
+        ax2.set_xticks(decimal_days_minor_ticks,minor='True')
+        ax2.set_xlim(start_date,end_date)
+        ax2.set_yticks(drainage_major_ticks)
+        ax2.set_yticks(drainage_minor_ticks,minor='True')
+        ax2.set_ylim(0,roundtocell(int(d_t_max),20))
+        ax2.tick_params(axis='both',which='major',labelsize=10)
+        ax2.tick_params(axis='x',which='minor',labelsize=None)
+        ax2.get_yaxis().set_label_coords(-0.06,0.5)
+        ax2.grid(which='major',alpha=0.5)
+        ax2.grid(which='minor',alpha=0.25)
+        
+        plt.subplot(413, sharex=ax1)
+        ax3=plt.gca()
+        
+        ax3.bar(rainfall_times,S_t,color='purple',width=bar_width,lw=line_width)
+        ax3.set_ylabel('Storage\n(mm)',fontsize=10, labelpad=25)
+        ax3.set_xticks(decimal_days_major_ticks)
+        ax3.set_xticks(decimal_days_minor_ticks,minor='True')
+        ax3.set_xlim(start_date,end_date)
+        ax3.set_yticks(storage_major_ticks)
+        ax3.set_yticks(storage_minor_ticks,minor='True')
+        ax3.set_ylim(0,roundtocell(s_t_max,20))
+        ax3.tick_params(axis='both',which='major',labelsize=10)
+        ax3.tick_params(axis='x',which='minor',labelsize=None)
+        ax3.get_yaxis().set_label_coords(-0.06,0.5)
+        ax3.grid(which='major',alpha=0.5)
+        ax3.grid(which='minor',alpha=0.25)
+        
+        plt.subplot(414, sharex=ax1)
+        ax4=plt.gca()
+        
 #                print crevassing_rate
 #                print rainfall_times
 #                print len(crevassing_rate)
 #                print len(rainfall_times)
-                
-                ax4.bar(rainfall_times,crevassing_rate,color='r',width=bar_width,lw=line_width)
-                ax4.set_xlabel('Julian Day (2016)', fontsize=10, labelpad=25)
-                ax4.set_ylabel('Crevassing Event Count\n(number $hr^-1$)',fontsize=10, labelpad=25)
-                ax4.set_xticks(decimal_days_major_ticks)
-                ax4.set_xticks(decimal_days_minor_ticks,minor='True')
-                ax4.set_xlim(start_date,end_date)
-                ax4.set_yticks(events_major_ticks)
-                ax4.set_yticks(events_minor_ticks,minor='True')
-                ax4.set_ylim(0,roundtocell(max(crevassing_rate),5)+5)
-                ax4.tick_params(axis='both',which='major',labelsize=10)
-                ax4.tick_params(axis='x',which='minor',labelsize=None)
-                ax4.get_xaxis().set_label_coords(0.5,-0.11)
-                ax4.get_yaxis().set_label_coords(-0.06,0.5)
-                ax4.grid(which='major',alpha=0.5)
-                ax4.grid(which='minor',alpha=0.25)      
-                
-                ax1.set_title('Crevasse Storage Model Results\n Do = '+str(d_all[di])+ ', a = '+str(a_all[ai])+', b = '+str(b_all[bi]), fontsize=16, y=1.03)
-                
-                plt.savefig(outdir+'/STORAGE/'+str(d_all[di])+'_'+str(a_all[ai])+'_'+str(b_all[bi])+'_mmPhr.pdf',format='pdf',dpi=300)
-                plt.close('all')
-                
+        
+        ax4.bar(rainfall_times,crevassing_rate,color='r',width=bar_width,lw=line_width)
+        ax4.set_xlabel('Julian Day (2016)', fontsize=10, labelpad=25)
+        ax4.set_ylabel('Crevassing Event Count\n(number $hr^-1$)',fontsize=10, labelpad=25)
+        ax4.set_xticks(decimal_days_major_ticks)
+        ax4.set_xticks(decimal_days_minor_ticks,minor='True')
+        ax4.set_xlim(start_date,end_date)
+        ax4.set_yticks(events_major_ticks)
+        ax4.set_yticks(events_minor_ticks,minor='True')
+        ax4.set_ylim(0,roundtocell(max(crevassing_rate),5)+5)
+        ax4.tick_params(axis='both',which='major',labelsize=10)
+        ax4.tick_params(axis='x',which='minor',labelsize=None)
+        ax4.get_xaxis().set_label_coords(0.5,-0.11)
+        ax4.get_yaxis().set_label_coords(-0.06,0.5)
+        ax4.grid(which='major',alpha=0.5)
+        ax4.grid(which='minor',alpha=0.25)      
+        
+        ax1.set_title('Crevasse Storage Model Results\n Do = '+str(d_all[di])+ ', a = '+str(a_all[ai])+', b = '+str(b_all[bi]), fontsize=16, y=1.03)
+        
+        plt.savefig(outdir+'/STORAGE/'+str(d_all[di])+'_'+str(a_all[ai])+'_'+str(b_all[bi])+'_mmPhr.pdf',format='pdf',dpi=300)
+        plt.close('all')
+        
 #from scipy import signal
 #signals=[signal.gaussian(24, 6, sym=True)[i] for i in range(len(signal.gaussian(24, 6, sym=True)))]
 #drainage_model('/Volumes/arc_02/taylorsa/gaussianmodel', 0,3,range(0,72),[0,0,0,0,0,0]+signals+[0,0,0,0,0,0,0,0,0,0,0,0,0,0,0,0,0,0,0,0,0,0,0,0,0,0,0,0,0,0,0,0,0,0,0,0,0,0,0,0,0,0], range(0,72), 24*[0]+[2,4,8,16,4,2]+42*[0])
@@ -1157,6 +965,7 @@ def run_event_statistics():
     
     rainfall_times='/media/sam/61D05F6577F6DB39/SCIENCE/rainfall_data/rainfall_hours'
     rainfall_data='/media/sam/61D05F6577F6DB39/SCIENCE/rainfall_data/rainfall_hours_data' 
+    forcing_directory='/media/sam/61D05F6577F6DB39/SCIENCE/forcing_store/' # forcing store (built on first use)
 #    temperature_times='/Volumes/arc_01/taylorsa/rainfall_data/temp_hours'
 #    temperature_data='/Volumes/arc_01/taylorsa/rainfall_data/temp_data'
 #    lake_level_data='/Volumes/arc_01/FIELD_DATA/TASMAN_LAKE/tasman_lake_level.csv'
@@ -1165,7 +974,7 @@ def run_event_statistics():
     
     # lake level data
     
-#    lake_times, lake_roc, lake_levels = lake_level(lake_level_data, year, start_date, end_date)
+#    lake_times, lake_roc, lake_levels = lake_level(lake_level_data, year, start_date, end_date, forcing_directory)
     
     # GPS processing and plotting addition...
                                            
@@ -1185,7 +994,7 @@ def run_event_statistics():
     
     GPS_in=[GPS1_path, GPS2_path]
     GPS_vdat=[GPS1_vpath, GPS2_vpath]
-    GPS_out, GPS_time, GPS_vel, GPS_vel_time, GPS_vel_unc = GPS_parse(GPS_in, GPS_vdat, start_date, end_date)
+    GPS_out, GPS_time, GPS_vel, GPS_vel_time, GPS_vel_unc = GPS_parse(GPS_in, GPS_vdat, start_date, end_date, forcing_directory)
     strains=strain_rate(GPS_out, GPS_vel)
     
 #    print GPS_vel_unc
@@ -1238,7 +1047,7 @@ def run_event_statistics():
 
     # calculate the rainfall in each hour and each day
 
-    dec_julian_days,rainfall_data, julian_days, day_rainfall=chosen_rainfall(start_date,end_date,year,rainfall_times,rainfall_data)
+    dec_julian_days,rainfall_data, julian_days, day_rainfall=chosen_rainfall(start_date,end_date,year,rainfall_times,rainfall_data,forcing_directory)
     
     # calculate the number of events occuring in each hour
     
@@ -1784,6 +1593,7 @@ def run_event_statistics_windows(outdir, event_directory,window_start_date,windo
     
     rainfall_times='/Volumes/arc_01/taylorsa/rainfall_data/rainfall_hours'
     rainfall_data='/Volumes/arc_01/taylorsa/rainfall_data/rainfall_hours_data' 
+    forcing_directory='/Volumes/arc_01/taylorsa/forcing_store/' # hourly forcing store (built on first use)
     temperature_times='/Volumes/arc_01/taylorsa/rainfall_data/temp_hours'
     temperature_data='/Volumes/arc_01/taylorsa/rainfall_data/temp_data'
     
@@ -1802,7 +1612,7 @@ def run_event_statistics_windows(outdir, event_directory,window_start_date,windo
 
     # calculate the rainfall in each hour and each day
 
-    dec_julian_days,rainfall_data, julian_days, day_rainfall=chosen_rainfall(window_start_date,window_end_date,year,rainfall_times,rainfall_data)
+    dec_julian_days,rainfall_data, julian_days, day_rainfall=chosen_rainfall(window_start_date,window_end_date,year,rainfall_times,rainfall_data,forcing_directory)
     
     # calculate the number of events occuring in each hour
     
@@ -2021,10 +1831,11 @@ def run_event_statistics_catalogue(event_directory,subplot):
     delay_time=0
     rainfall_times='/Volumes/arc_01/taylorsa/rainfall_data/rainfall_hours'
     rainfall_data='/Volumes/arc_01/taylorsa/rainfall_data/rainfall_hours_data' 
+    forcing_directory='/Volumes/arc_01/taylorsa/forcing_store/' # hourly forcing store (built on first use)
     
 #    diurnal_event_statistics(start_date,end_date,event_directory,delay_time)
     
-    dec_julian_days,rainfall_data, julian_days, day_rainfall=chosen_rainfall(start_date,end_date,year,rainfall_times,rainfall_data)
+    dec_julian_days,rainfall_data, julian_days, day_rainfall=chosen_rainfall(start_date,end_date,year,rainfall_times,rainfall_data,forcing_directory)
     
     hourly_event_sum,hourly_event_hours,files,all_times=event_counter(start_date,end_date,event_directory,delay_time)
     
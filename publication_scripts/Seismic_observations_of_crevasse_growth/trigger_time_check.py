@@ -9,26 +9,51 @@ import obspy
 import matplotlib.pyplot as plt
 import datetime
 
+from event_catalogue import find_catalogue, open_catalogue, query_events, read_waveform, event_triggers
+
 event_directory = '/home/sam/EVENTS_IT3/TYPE_A/4/'
 
-seismic_event_files = glob.glob(event_directory + '*MSEED')
-trigger_time_files = glob.glob(event_directory + '*csv')
+## Time range of events to check when using an event catalogue (None for all events)
+
+starttime = None
+endtime = None
+
+# Use the event catalogue if there is one, otherwise the event .MSEED and .csv files
+
+catalogue_file = find_catalogue(event_directory)
 
-seismic_event_files.sort()
-trigger_time_files.sort()
+if catalogue_file is not None:
+    
+    catalogue = open_catalogue(catalogue_file)
+    seismic_events = [row[0] for row in query_events(catalogue, starttime, endtime)]
+    
+else:
+    
+    seismic_events = glob.glob(event_directory + '*MSEED')
+    seismic_events.sort()
 
-for e in range(len(seismic_event_files)):
+for e in range(len(seismic_events)):
     
-    event = obspy.read(seismic_event_files[e])
+    # Load the event and its trigger rows (station, on time, off time)
     
-    with open(seismic_event_files[e][:-6] + '.csv', 'r') as openfile:
+    if catalogue_file is not None:
         
-        rc = 0  
-        for row in openfile:
-            rc += 1
+        event = read_waveform(catalogue, seismic_events[e])
+        trigger_rows = [[str(trigger[0]), str(trigger[1]), str(trigger[2])]
+                        for trigger in event_triggers(catalogue, seismic_events[e])]
+        
+    else:
+        
+        event = obspy.read(seismic_events[e])
+        
+        with open(seismic_events[e][:-6] + '.csv', 'r') as openfile:
+            
+            trigger_rows = [row.split(',') for row in openfile]
+    
+    rc = len(trigger_rows)
     
     if rc < 3:
-        print('Less than 3 re-triggers for event ' + seismic_event_files[e])
+        print('Less than 3 re-triggers for event ' + str(seismic_events[e]))
         continue
 
     mintime = obspy.UTCDateTime('9999-01-01T00:00:00').datetime
@@ -49,20 +74,18 @@ for e in range(len(seismic_event_files)):
 #        print(start, mintime, timediff)
         station = trace.stats.station
 
-        with open(seismic_event_files[e][:-6] + '.csv', 'r') as openfile:
-            
-            for row in openfile:
+        for row in trigger_rows:
     
-                if row.split(',')[0] == station:
-                    sample = 250 * (obspy.UTCDateTime(row.split(',')[1], iso8601=True).datetime - start).total_seconds() + timediff
-                    off_sample = 250 * (obspy.UTCDateTime(row.split(',')[2], iso8601=True).datetime - start).total_seconds() + timediff
-                    plt.subplot(int(str(len(event)) + '1' + str(c)))
-                    plt.plot(data, color = 'black')
-                    plt.axvline(sample, color = 'red')
-                    plt.axvline(off_sample, color = 'red')
-                    plotted = True
-                    
-                    break
+            if row[0] == station:
+                sample = 250 * (obspy.UTCDateTime(row[1], iso8601=True).datetime - start).total_seconds() + timediff
+                off_sample = 250 * (obspy.UTCDateTime(row[2], iso8601=True).datetime - start).total_seconds() + timediff
+                plt.subplot(int(str(len(event)) + '1' + str(c)))
+                plt.plot(data, color = 'black')
+                plt.axvline(sample, color = 'red')
+                plt.axvline(off_sample, color = 'red')
+                plotted = True
+                
+                break
         
     if plotted == True:
         